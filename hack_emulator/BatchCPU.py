@@ -0,0 +1,160 @@
+#! /bin/python3
+# Lockstep batch emulation of the Hack CPU : one ROM run over many data memories at once, with NumPy
+
+import sys, os
+import time
+import numpy as np
+
+from HackCPU import ALU, RAM_SIZE, ROM_SIZE, PC_MASK, load_rom, find_halt_loops
+
+# Control bits of a C-instruction 111a cccc ccdd djjj : a (A or M), zx nx zy ny f no (ALU)
+A_BIT = 0x1000
+ZX_BIT = 0x0800
+NX_BIT = 0x0400
+ZY_BIT = 0x0200
+NY_BIT = 0x0100
+F_BIT = 0x0080
+NO_BIT = 0x0040
+
+
+class BatchCPU:
+
+    def __init__(self, rom, n_instances, ram_size=RAM_SIZE):
+        """Initiate <n_instances> computers running the same program, <rom> being a list of 16-bit instructions or a
+        .hack/.binhack path. Their data memories are the rows of self.RAM (n_instances x ram_size), the addresses at or
+        above <ram_size> being out of reach (a smaller RAM for programs that only use its first words)"""
+        if isinstance(rom, str):
+            rom = load_rom(rom)
+        if len(rom) > ROM_SIZE:
+            raise Exception(f"Program too large for the ROM : {len(rom)} instructions")
+        self.rom = list(rom)
+        for instruction in self.rom:
+            if instruction & 0x8000 and (instruction >> 6) & 0x7F not in ALU:
+                raise Exception(f"Invalid computation in instruction {instruction:016b}")
+        self.halt_loops = find_halt_loops(self.rom)
+        # Whether an instance at a given PC has halted : at the A-instruction entering a halt loop, as in HackCPU (the
+        # jump of the loop can be reached with another value of A, and past the end of the program the PC wraps around)
+        self.halt_at = np.zeros(ROM_SIZE, dtype=bool)
+        for address in self.halt_loops:
+            self.halt_at[address] = True
+        self.n_instances = n_instances
+        self.ram_size = ram_size
+        self.RAM = np.zeros((n_instances, ram_size), dtype=np.int16)
+        self.reset()
+
+    def reset(self):
+        """Reset the registers and the cycle counters of all the instances, the data memories are left as is"""
+        self.A = np.zeros(self.n_instances, dtype=np.uint16)
+        self.D = np.zeros(self.n_instances, dtype=np.uint16)
+        self.PC = np.zeros(self.n_instances, dtype=np.int64)
+        self.cycles = np.zeros(self.n_instances, dtype=np.int64)
+        self.halted = np.zeros(self.n_instances, dtype=bool)
+        self.steps = 0
+
+    def run(self, max_cycles):
+        """Run the instances until they halt (entry of a halt loop, see find_halt_loops) or have executed <max_cycles>
+        more instructions. At each step, the instances at the lowest PC execute their instruction together
+        (the others wait for them, so that the instances that diverged on a branch join again) and the number
+        of steps is returned. As in HackCPU, the ROM past the end of the program is filled with @0 instructions and
+        the PC wraps around after its last address"""
+        ram = self.RAM.view(np.uint16)
+        rom = self.rom
+        n_rom = len(rom)
+        halt_at = self.halt_at
+        a, d, pc, cycles, halted = self.A, self.D, self.PC, self.cycles, self.halted
+        end_cycles = cycles + max_cycles
+        n_steps = 0
+
+        halted |= halt_at[pc]
+        running = ~halted & (cycles < end_cycles)
+        while running.any():
+            p = int(pc[running].min())
+            index = np.flatnonzero(running & (pc == p))
+            n_steps += 1
+
+            if p >= n_rom:
+                # Past the end of the program : the @0 instructions up to the end of the ROM are run at once
+                n_zeros = np.minimum(ROM_SIZE - p, end_cycles[index] - cycles[index])
+                cycles[index] += n_zeros
+                a[index] = 0
+                pc[index] = (p + n_zeros) % ROM_SIZE
+                running[index] = cycles[index] < end_cycles[index]
+                continue
+
+            instruction = rom[p]
+            cycles[index] += 1
+
+            if instruction & 0x8000 == 0:
+                # A-instruction
+                a[index] = instruction
+                next_pc = (p + 1) % ROM_SIZE
+
+            else:
+                addresses = a[index]
+                if instruction & (A_BIT | 0b1000) and int(addresses.max()) >= self.ram_size:
+                    raise Exception(f"Address {int(addresses.max())} out of the RAM of the batch ({self.ram_size} words) at PC {p}")
+
+                # ALU : x is D, y is A or M
+                x = d[index]
+                y = ram[index, addresses] if instruction & A_BIT else addresses
+                if instruction & ZX_BIT:
+                    x = np.zeros_like(x)
+                if instruction & NX_BIT:
+                    x = ~x
+                if instruction & ZY_BIT:
+                    y = np.zeros_like(y)
+                if instruction & NY_BIT:
+                    y = ~y
+                out = x + y if instruction & F_BIT else x & y
+                if instruction & NO_BIT:
+                    out = ~out
+
+                # M and the jump target are both given by A before the instruction
+                if instruction & 0b001000:
+                    ram[index, addresses] = out
+                if instruction & 0b010000:
+                    d[index] = out
+                if instruction & 0b100000:
+                    a[index] = out
+
+                # The jump target is A masked to the 15 bits of the PC
+                jump = instruction & 0b111
+                if jump == 0b111:
+                    next_pc = addresses.astype(np.int64) & PC_MASK
+                elif jump:
+                    negative = out >= 0x8000
+                    zero = out == 0
+                    taken = ((jump & 0b100 != 0) & negative) | ((jump & 0b010 != 0) & zero) | ((jump & 0b001 != 0) & ~negative & ~zero)
+                    next_pc = np.where(taken, addresses.astype(np.int64) & PC_MASK, (p + 1) % ROM_SIZE)
+                else:
+                    next_pc = (p + 1) % ROM_SIZE
+
+            pc[index] = next_pc
+            halted[index] = halt_at[pc[index]]
+            running[index] = ~halted[index] & (cycles[index] < end_cycles[index])
+
+        self.steps += n_steps
+        return n_steps
+
+
+if __name__ == "__main__":
+
+    # Run a program on random values of R0 and R1 and show the throughput
+    if len(sys.argv) not in [3, 4]:
+        print(f"Usage : {sys.argv[0]} <prog.hack | prog.binhack> <n_instances> [max R0/R1 value]")
+        exit()
+
+    n_instances = int(sys.argv[2])
+    max_value = int(sys.argv[3]) if len(sys.argv) == 4 else 100
+
+    batch = BatchCPU(sys.argv[1], n_instances)
+    seeds = np.random.default_rng(0).integers(0, max_value + 1, size=(n_instances, 2))
+    batch.RAM[:, 0:2] = seeds
+    t0 = time.perf_counter()
+    n_steps = batch.run(1_000_000)
+    elapsed = time.perf_counter() - t0
+
+    print(f"{n_instances} instances, {int(batch.cycles.sum())} cycles in {n_steps} steps, {elapsed:.3f} s"
+          f" ({batch.cycles.sum()/elapsed/1e6:.2f} M instructions/s), {int(batch.halted.sum())} halted")
+    for i in range(min(n_instances, 5)):
+        print(f"  R0={seeds[i, 0]} R1={seeds[i, 1]} -> RAM[0:3] = {batch.RAM[i, 0:3].tolist()} in {batch.cycles[i]} cycles")
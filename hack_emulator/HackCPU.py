@@ -0,0 +1,517 @@
+#! /bin/python3
+# Emulator of the Hack CPU, running the .hack / .binhack programs produced by my_assembler.py
+
+import sys, os
+import time
+import mmap
+import zlib
+import struct
+import numpy as np
+
+# Size of the instruction memory and of the data memory (addressable by an A-instruction)
+ROM_SIZE = 32768
+RAM_SIZE = 32768
+
+# The PC addresses the ROM with its 15 low bits, a jump to A >= ROM_SIZE landing at A & PC_MASK
+PC_MASK = ROM_SIZE - 1
+
+# Header of a checkpoint : magic, version, PC, A, D, cycles, CRC32 of the ROM it was taken on and number of RAM words
+# saved (up to the last non-zero one, the others being zeros), followed by the RAM as little-endian 16-bit words
+CHECKPOINT_MAGIC = b"HKCK"
+CHECKPOINT_VERSION = 1
+CHECKPOINT_HEADER = struct.Struct("<4sIHHHQII")
+
+# Computation of the ALU for each a-bit + c-bits code of a C-instruction, as a function of (D, A, RAM)
+# All values are kept as unsigned 16-bit integers
+ALU = {
+    0b0101010 : lambda d, a, ram: 0,
+    0b0111111 : lambda d, a, ram: 1,
+    0b0111010 : lambda d, a, ram: 0xFFFF,
+    0b0001100 : lambda d, a, ram: d,
+    0b0110000 : lambda d, a, ram: a,
+    0b0001101 : lambda d, a, ram: d ^ 0xFFFF,
+    0b0110001 : lambda d, a, ram: a ^ 0xFFFF,
+    0b0001111 : lambda d, a, ram: -d & 0xFFFF,
+    0b0110011 : lambda d, a, ram: -a & 0xFFFF,
+    0b0011111 : lambda d, a, ram: (d + 1) & 0xFFFF,
+    0b0110111 : lambda d, a, ram: (a + 1) & 0xFFFF,
+    0b0001110 : lambda d, a, ram: (d - 1) & 0xFFFF,
+    0b0110010 : lambda d, a, ram: (a - 1) & 0xFFFF,
+    0b0000010 : lambda d, a, ram: (d + a) & 0xFFFF,
+    0b0010011 : lambda d, a, ram: (d - a) & 0xFFFF,
+    0b0000111 : lambda d, a, ram: (a - d) & 0xFFFF,
+    0b0000000 : lambda d, a, ram: d & a,
+    0b0010101 : lambda d, a, ram: d | a,
+    0b1110000 : lambda d, a, ram: ram[a],
+    0b1110001 : lambda d, a, ram: ram[a] ^ 0xFFFF,
+    0b1110011 : lambda d, a, ram: -ram[a] & 0xFFFF,
+    0b1110111 : lambda d, a, ram: (ram[a] + 1) & 0xFFFF,
+    0b1110010 : lambda d, a, ram: (ram[a] - 1) & 0xFFFF,
+    0b1000010 : lambda d, a, ram: (d + ram[a]) & 0xFFFF,
+    0b1010011 : lambda d, a, ram: (d - ram[a]) & 0xFFFF,
+    0b1000111 : lambda d, a, ram: (ram[a] - d) & 0xFFFF,
+    0b1000000 : lambda d, a, ram: d & ram[a],
+    0b1010101 : lambda d, a, ram: d | ram[a]
+}
+
+# For each jump code, whether the jump is taken when the ALU output is (negative, zero, positive)
+JUMP = [
+    (False, False, False),
+    (False, False, True),
+    (False, True, False),
+    (False, True, True),
+    (True, False, False),
+    (True, False, True),
+    (True, True, False),
+    (True, True, True)
+]
+
+# Same computations as Python expressions, for the compilation of the basic blocks ({a} and {m} being substituted)
+ALU_EXPRESSION = {
+    0b0101010 : "0",
+    0b0111111 : "1",
+    0b0111010 : "0xFFFF",
+    0b0001100 : "d",
+    0b0110000 : "{a}",
+    0b0001101 : "d ^ 0xFFFF",
+    0b0110001 : "{a} ^ 0xFFFF",
+    0b0001111 : "-d & 0xFFFF",
+    0b0110011 : "-{a} & 0xFFFF",
+    0b0011111 : "(d + 1) & 0xFFFF",
+    0b0110111 : "({a} + 1) & 0xFFFF",
+    0b0001110 : "(d - 1) & 0xFFFF",
+    0b0110010 : "({a} - 1) & 0xFFFF",
+    0b0000010 : "(d + {a}) & 0xFFFF",
+    0b0010011 : "(d - {a}) & 0xFFFF",
+    0b0000111 : "({a} - d) & 0xFFFF",
+    0b0000000 : "d & {a}",
+    0b0010101 : "d | {a}",
+    0b1110000 : "{m}",
+    0b1110001 : "{m} ^ 0xFFFF",
+    0b1110011 : "-{m} & 0xFFFF",
+    0b1110111 : "({m} + 1) & 0xFFFF",
+    0b1110010 : "({m} - 1) & 0xFFFF",
+    0b1000010 : "(d + {m}) & 0xFFFF",
+    0b1010011 : "(d - {m}) & 0xFFFF",
+    0b1000111 : "({m} - d) & 0xFFFF",
+    0b1000000 : "d & {m}",
+    0b1010101 : "d | {m}"
+}
+
+# Jump conditions as Python expressions on the ALU output x
+JUMP_EXPRESSION = [
+    None,
+    "0 < x < 0x8000",
+    "x == 0",
+    "x < 0x8000",
+    "x >= 0x8000",
+    "x != 0",
+    "x == 0 or x >= 0x8000",
+    "True"
+]
+
+# Target of a C-instruction with a single destination
+SINGLE_DEST = {
+    0b001 : "ram[{a}]",
+    0b010 : "d",
+    0b100 : "a"
+}
+
+
+def load_hack(path):
+    """Read a .hack file (text, one 16-bit instruction per line) and return the list of the instructions"""
+    with open(path, "r") as fd_in:
+        return [int(line, 2) for line in fd_in if line.strip()]
+
+
+def map_binhack(path, n_instructions=None):
+    """Memory-map a .binhack file (packed big-endian 16-bit instructions) and return it as a read-only NumPy array of
+    dtype >u2 without copy : the pages are read on demand and shared by all the processes mapping the file
+    With <n_instructions>, the file must hold this number of instructions, possibly followed by a zero padding (eg up to
+    the ROM size), and only the instructions are returned"""
+    size = os.path.getsize(path)
+    if size % 2:
+        raise Exception(f"{path} : odd size ({size} bytes), not a sequence of 16-bit instructions")
+    if n_instructions is not None and size < 2 * n_instructions:
+        raise Exception(f"{path} : {size // 2} instructions, {n_instructions} expected")
+    if size == 0:
+        # An empty file can't be mapped
+        return np.zeros(0, dtype=">u2")
+
+    with open(path, "rb") as fd_in:
+        # The mapping stays valid after the file is closed, and as long as the array is referenced
+        buffer = mmap.mmap(fd_in.fileno(), 0, access=mmap.ACCESS_READ)
+    words = np.frombuffer(buffer, dtype=">u2")
+
+    if n_instructions is not None:
+        if words[n_instructions:].any():
+            first = n_instructions + int(np.flatnonzero(words[n_instructions:])[0])
+            raise Exception(f"{path} : non-zero word at address {first}, past the {n_instructions} instructions")
+        words = words[:n_instructions]
+    return words
+
+
+def load_binhack(path):
+    """Read a .binhack file (packed big-endian 16-bit instructions) and return the list of the instructions"""
+    return map_binhack(path).tolist()
+
+
+def load_rom(path):
+    """Read a .hack or a .binhack file and return the list of the instructions"""
+    if path.endswith(".binhack"):
+        return load_binhack(path)
+    return load_hack(path)
+
+
+def decode(instruction):
+    """Decode a 16-bit instruction once and for all into a (comp, dest, jump, value) tuple :
+    - A-instruction : (None, 0, 0, value)
+    - C-instruction : (ALU function, dest bits, jump bits, 0)"""
+    if instruction & 0x8000 == 0:
+        return (None, 0, 0, instruction)
+    comp = (instruction >> 6) & 0x7F
+    if comp not in ALU:
+        raise Exception(f"Invalid computation in instruction {instruction:016b}")
+    return (ALU[comp], (instruction >> 3) & 0b111, instruction & 0b111, 0)
+
+
+def find_jump_targets(rom):
+    """Return the set of the static jump targets of a program : values loaded in A right before a jump instruction"""
+    targets = set()
+    for i in range(len(rom) - 1):
+        if rom[i] & 0x8000 == 0 and rom[i+1] & 0x8000 and rom[i+1] & 0b111:
+            targets.add(rom[i])
+    return targets
+
+
+def find_halt_loops(rom):
+    """Return the set of the addresses of the halt loops of a program : an A-instruction loading its own address followed by
+    an unconditional jump without destination (the infinite loop ending the Hack programs, eg (END) @END 0;JMP)"""
+    return {i for i in range(len(rom) - 1) if rom[i] == i and rom[i+1] & 0xE03F == 0xE007}
+
+
+def compile_block(rom, start, leaders):
+    """Compile the basic block starting at <start> into a Python function (ram, a, d) -> (a, d, next pc)
+    The block ends with the first jump instruction, before the next leader or at the end of the program
+    Return the function and the number of instructions of the block"""
+    lines = ["def block(ram, a, d):"]
+    known_a = None # Value of A when known at compilation time (after an A-instruction)
+    pc = start
+    ends_with_jump = False
+
+    while pc < len(rom):
+        instruction = rom[pc]
+        pc += 1
+
+        if instruction & 0x8000 == 0:
+            # A-instruction : the assignment is delayed until A is needed dynamically
+            known_a = instruction
+
+        else:
+            comp = (instruction >> 6) & 0x7F
+            dest = (instruction >> 3) & 0b111
+            jump = instruction & 0b111
+            if comp not in ALU_EXPRESSION:
+                raise Exception(f"Invalid computation in instruction {instruction:016b}")
+
+            a_expr = "a" if known_a is None else str(known_a)
+            expression = ALU_EXPRESSION[comp].format(a=a_expr, m=f"ram[{a_expr}]")
+            if jump:
+                # The jump target is masked to the ROM addresses, the constants of the A-instructions being below ROM_SIZE
+                target = a_expr if known_a is not None else f"{a_expr} & {PC_MASK}"
+                # The computation is kept when it reads M, as the access may be out of the RAM
+                if dest or jump != 0b111 or comp & 0x40:
+                    lines.append(f"    x = {expression}")
+                if dest & 0b001:
+                    lines.append(f"    ram[{a_expr}] = x")
+                if dest & 0b010:
+                    lines.append("    d = x")
+                # The jump target is A before the instruction, the exit value of A being x if A is a destination
+                a_exit = "x" if dest & 0b100 else a_expr
+                if jump == 0b111:
+                    lines.append(f"    return {a_exit}, d, {target}")
+                else:
+                    lines.append(f"    return {a_exit}, d, ({target}) if {JUMP_EXPRESSION[jump]} else {pc % ROM_SIZE}")
+                ends_with_jump = True
+                break
+
+            if dest in SINGLE_DEST:
+                # Single destination : direct assignment
+                lines.append(f"    {SINGLE_DEST[dest].format(a=a_expr)} = {expression}")
+            elif dest:
+                # M is written at the address given by A before the instruction
+                lines.append(f"    x = {expression}")
+                if dest & 0b001:
+                    lines.append(f"    ram[{a_expr}] = x")
+                if dest & 0b010:
+                    lines.append("    d = x")
+                if dest & 0b100:
+                    lines.append("    a = x")
+            if dest & 0b100:
+                known_a = None
+
+        if pc in leaders:
+            break
+
+    if not ends_with_jump:
+        # Fall through to the next block
+        a_exit = "a" if known_a is None else str(known_a)
+        lines.append(f"    return {a_exit}, d, {pc % ROM_SIZE}")
+
+    namespace = {}
+    exec(compile("\n".join(lines), f"<block {start}>", "exec"), namespace)
+    return namespace["block"], pc - start
+
+
+class HackCPU:
+
+    def __init__(self, rom=None, jit=False, profile=False, fast_forward=True):
+        """Initiate the computer with an empty data memory, <rom> being a list of 16-bit instructions or a .hack/.binhack path
+        With <jit>, straight-line runs of instructions are compiled into Python functions and cached by start address
+        With <profile>, the executed instructions are counted per ROM address (see profile_counts), the program being
+        run by basic blocks : each entry in a block counts once for all its instructions
+        With <fast_forward>, the execution stops when the program enters a halt loop (see find_halt_loops) and the
+        remaining cycles are skipped, the registers being set as if the loop had run (see run)"""
+        self.RAM = np.zeros(RAM_SIZE, dtype=np.int16)
+        self.jit = jit
+        self.profile = profile
+        self.fast_forward = fast_forward
+        self.halt_loops = set()
+        self.rom = []
+        self.program = []
+        self.blocks = {}
+        self.leaders = set()
+        self.block_entries = {}
+        self.partial_counts = np.zeros(ROM_SIZE, dtype=np.int64)
+        self.rom_checksum = zlib.crc32(b"")
+        self.reset()
+        if rom is not None:
+            self.load(rom)
+
+    def load(self, rom):
+        """Load a program (list of 16-bit instructions or path to a .hack/.binhack file) and pre-decode its instructions"""
+        if isinstance(rom, str):
+            rom = load_rom(rom)
+        if len(rom) > ROM_SIZE:
+            raise Exception(f"Program too large for the ROM : {len(rom)} instructions")
+        self.rom = list(rom)
+        self.program = [decode(instruction) for instruction in self.rom]
+        self.halt_loops = find_halt_loops(self.rom) if self.fast_forward else set()
+        for address in self.halt_loops:
+            # A-instruction marked by a dest field (unused otherwise) : entry of a halt loop
+            self.program[address] = (None, 1, 0, address)
+        self.blocks = {}
+        self.leaders = find_jump_targets(self.rom)
+        self.block_entries = {}
+        self.partial_counts[:] = 0
+        self.rom_checksum = zlib.crc32(np.array(self.rom, dtype="<u2").tobytes())
+        self.reset()
+
+    def reset(self):
+        """Reset the registers, the data memory is left as is"""
+        self.A = 0
+        self.D = 0
+        self.PC = 0
+        self.cycles = 0
+        self.halt_cycle = None
+
+    def step(self):
+        """Execute a single instruction"""
+        return self.run(1)
+
+    def run(self, max_cycles):
+        """Run <max_cycles> cycles and return the number of executed instructions, the cycles spent in a halt loop being
+        skipped (fast-forward mode). self.cycles counts all the cycles, and self.halt_cycle is the cycle at which the
+        program entered a halt loop (None if it has not)"""
+        ram_view = self.RAM.view(np.uint16)
+        ram = ram_view.tolist()
+        a, d, pc = self.A, self.D, self.PC & PC_MASK
+
+        try:
+            if self.jit or self.profile:
+                a, d, pc, idle = self._execute_blocks(ram, a, d, pc, max_cycles)
+            else:
+                a, d, pc, idle = self._execute(ram, a, d, pc, max_cycles)
+        except IndexError:
+            # M accessed with A beyond the data memory, in any mode
+            raise Exception(f"RAM address out of range (A >= {RAM_SIZE})")
+        finally:
+            ram_view[:] = ram
+
+        if idle:
+            # Halt loop at pc : A is set to pc, then the loop alternates between pc and pc + 1 and nothing else changes
+            if self.halt_cycle is None:
+                self.halt_cycle = self.cycles + max_cycles - idle
+            if self.profile:
+                self.partial_counts[pc] += (idle + 1) // 2
+                self.partial_counts[pc + 1] += idle // 2
+            a = pc
+            pc += idle % 2
+
+        self.A, self.D, self.PC = a, d, pc
+        self.cycles += max_cycles
+        return max_cycles - idle
+
+    def _execute(self, ram, a, d, pc, max_cycles):
+        """Interpreter loop, on the registers and on the data memory as a list of unsigned integers
+        Return the registers and the number of cycles left when the program entered a halt loop (0 if it has not)"""
+        program = self.program
+        n_program = len(program)
+        remaining = max_cycles
+
+        while remaining > 0:
+
+            if pc >= n_program:
+                if pc == ROM_SIZE:
+                    # After the last address of the ROM
+                    pc = 0
+                    continue
+                # Past the end of the program the ROM is filled with zeros, ie @0 instructions
+                n_zeros = min(remaining, ROM_SIZE - pc)
+                remaining -= n_zeros
+                a = 0
+                pc = (pc + n_zeros) % ROM_SIZE
+                continue
+
+            comp, dest, jump, value = program[pc]
+            remaining -= 1
+
+            if comp is None:
+                if dest:
+                    # Entry of a halt loop, not executed
+                    return a, d, pc, remaining + 1
+                # A-instruction
+                a = value
+                pc += 1
+                continue
+
+            # C-instruction : M and the jump target are both given by A before the instruction
+            out = comp(d, a, ram)
+            target = a
+            if dest:
+                if dest & 0b001:
+                    ram[a] = out
+                if dest & 0b010:
+                    d = out
+                if dest & 0b100:
+                    a = out
+
+            if jump and JUMP[jump][0 if out & 0x8000 else 1 if out == 0 else 2]:
+                pc = target & PC_MASK
+            else:
+                pc += 1
+
+        return a, d, pc, 0
+
+    def _execute_blocks(self, ram, a, d, pc, max_cycles):
+        """Execution loop over the compiled basic blocks, the remaining cycles being interpreted when a whole block doesn't fit
+        Return the registers and the number of cycles left when the program entered a halt loop (0 if it has not)"""
+        blocks = self.blocks
+        halt_loops = self.halt_loops
+        n_program = len(self.program)
+        remaining = max_cycles
+        # Profiling : entries in the blocks, and straight runs of instructions executed out of a block
+        entries = self.block_entries if self.profile else None
+
+        while remaining > 0:
+            if pc in halt_loops:
+                return a, d, pc, remaining
+            block = blocks.get(pc)
+
+            if block is None:
+                if pc >= n_program:
+                    # Run the empty ROM up to the wrap around
+                    n_zeros = min(remaining, ROM_SIZE - pc)
+                    if entries is not None:
+                        self.partial_counts[pc:pc + n_zeros] += 1
+                    a, d, pc, _ = self._execute(ram, a, d, pc, n_zeros)
+                    remaining -= n_zeros
+                    continue
+                block = blocks[pc] = compile_block(self.rom, pc, self.leaders)
+
+            function, length = block
+            if length > remaining:
+                # The jump ending the block is not reached
+                if entries is not None:
+                    self.partial_counts[pc:pc + remaining] += 1
+                return self._execute(ram, a, d, pc, remaining)
+
+            if entries is not None:
+                entries[pc] = entries.get(pc, 0) + 1
+            a, d, pc = function(ram, a, d)
+            remaining -= length
+
+        return a, d, pc, 0
+
+    def checkpoint(self):
+        """State of the computer (PC, A, D, cycles and data memory) as an immutable bytes buffer, that can be restored
+        any number of times (see restore) : the forks of a state each copy it into their own RAM"""
+        nonzero = np.flatnonzero(self.RAM)
+        n_words = int(nonzero[-1]) + 1 if nonzero.size else 0
+        header = CHECKPOINT_HEADER.pack(CHECKPOINT_MAGIC, CHECKPOINT_VERSION, self.PC, self.A, self.D, self.cycles,
+                                        self.rom_checksum, n_words)
+        return header + self.RAM[:n_words].astype("<i2", copy=False).tobytes()
+
+    def restore(self, checkpoint):
+        """Restore a state saved by checkpoint (bytes or any buffer, eg read_checkpoint), taken on the same program
+        The data memory is set by a single buffer copy"""
+        if len(checkpoint) < CHECKPOINT_HEADER.size:
+            raise Exception("Not a checkpoint of the Hack CPU")
+        magic, version, pc, a, d, cycles, rom_checksum, n_words = CHECKPOINT_HEADER.unpack_from(checkpoint)
+        if magic != CHECKPOINT_MAGIC:
+            raise Exception("Not a checkpoint of the Hack CPU")
+        if version != CHECKPOINT_VERSION:
+            raise Exception(f"Checkpoint version {version}, {CHECKPOINT_VERSION} expected")
+        if rom_checksum != self.rom_checksum:
+            raise Exception("Checkpoint taken on another program")
+        if len(checkpoint) < CHECKPOINT_HEADER.size + 2 * n_words or n_words > RAM_SIZE:
+            raise Exception("Truncated checkpoint")
+        self.RAM[:n_words] = np.frombuffer(checkpoint, dtype="<i2", count=n_words, offset=CHECKPOINT_HEADER.size)
+        self.RAM[n_words:] = 0
+        self.PC, self.A, self.D, self.cycles = pc, a, d, cycles
+        self.halt_cycle = None
+
+    def profile_counts(self):
+        """Number of executions of each ROM address since the program was loaded (profiling mode), as an array of ROM_SIZE integers"""
+        counts = self.partial_counts.copy()
+        for start, n in self.block_entries.items():
+            counts[start:start + self.blocks[start][1]] += n
+        return counts
+
+
+def write_checkpoint(cpu, filename):
+    """Save the state of a computer in a checkpoint file"""
+    with open(filename + ".tmp", "wb") as fd_out:
+        fd_out.write(cpu.checkpoint())
+    os.replace(filename + ".tmp", filename)
+
+
+def read_checkpoint(filename):
+    """Memory-map a checkpoint file, to be restored with HackCPU.restore : the pages are read on demand and shared by
+    all the processes mapping the file, each restore copying them in the RAM of its own computer"""
+    if os.path.getsize(filename) == 0:
+        # An empty file can't be mapped
+        raise Exception(f"{filename} : not a checkpoint of the Hack CPU")
+    with open(filename, "rb") as fd_in:
+        return mmap.mmap(fd_in.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+if __name__ == "__main__":
+
+    # Run a program for a given number of cycles and show the throughput
+    if len(sys.argv) not in [2, 3]:
+        print(f"Usage : {sys.argv[0]} <prog.hack | prog.binhack> [n_cycles]")
+        exit()
+
+    n_cycles = int(sys.argv[2]) if len(sys.argv) == 3 else 1_000_000
+
+    cpu = HackCPU(sys.argv[1])
+    t0 = time.perf_counter()
+    executed = cpu.run(n_cycles)
+    elapsed = time.perf_counter() - t0
+
+    print(f"{n_cycles} cycles in {elapsed:.3f} s ({executed/elapsed/1e6:.2f} M instructions/s)")
+    if cpu.halt_cycle is not None:
+        print(f"Halted at cycle {cpu.halt_cycle}, {n_cycles - executed} cycles skipped")
+    print(f"PC={cpu.PC} A={cpu.A} D={cpu.D}")
+    print(f"RAM[0:16] = {cpu.RAM[:16].tolist()}")
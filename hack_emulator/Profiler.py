@@ -0,0 +1,160 @@
+#! /bin/python3
+# Profiler of the Hack programs : executed instructions per ROM address, folded to the assembly labels and to the VM functions and lines
+
+import sys, os
+import time
+import numpy as np
+
+from HackCPU import HackCPU, load_rom
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(REPO_DIR, "project6_assembler"))
+sys.path.append(os.path.join(REPO_DIR, "project8_vm_part2"))
+
+from my_assembler import Assembler
+from VMTranslator import CodeWriter, translate_file, translate_directory, list_vm_files
+
+# Pointers set for the VM programs without bootstrap code, as in the test scripts of project 7
+VM_POINTERS = {
+    0 : 256,  # SP
+    1 : 300,  # LCL
+    2 : 400,  # ARG
+    3 : 3000, # THIS
+    4 : 3010  # THAT
+}
+
+
+def fold(counts, starts, names, before="(no source)"):
+    """Sum the counts of the ROM addresses by region, region i starting at address starts[i] (sorted) and named names[i]
+    Return a dict {name : count}, the addresses before the first region being counted as <before>"""
+    owners = np.searchsorted(starts, np.arange(len(counts)), side="right") - 1
+    sums = np.bincount(owners + 1, weights=counts, minlength=len(names) + 1)
+    folded = {}
+    for name, count in zip([before] + list(names), sums):
+        if count:
+            folded[name] = folded.get(name, 0) + int(count)
+    return folded
+
+
+def fold_to_labels(counts, labels_table):
+    """Executed instructions per label of the assembler (labels_table : {label : address}), each address counting for
+    the last label at or before it. The labels at the same address are shown together"""
+    by_address = {}
+    for label, address in labels_table.items():
+        by_address.setdefault(address, []).append(label)
+    starts = sorted(by_address)
+    return fold(counts, starts, [" / ".join(by_address[address]) for address in starts], before="(before the first label)")
+
+
+def read_vm_lines(vm_files):
+    """Lines of the VM files, by file name (without suffix and path)"""
+    lines = {}
+    for path in vm_files:
+        with open(path, "r") as fd_in:
+            lines[os.path.basename(path)[:-3]] = [line.split("//")[0].strip() for line in fd_in]
+    return lines
+
+
+def vm_regions(source_map, vm_lines):
+    """ROM start address of each entry of a SourceMap, with the function, the line and the command of the entry"""
+    starts, functions, lines, commands = [], [], [], []
+    for i in range(len(source_map)):
+        filename, line, function, _, (start, _) = source_map.entry(i)
+        filename = filename[:-3]
+        starts.append(start)
+        functions.append(function or f"({filename})")
+        if line:
+            text = vm_lines[filename][line - 1]
+            words = text.split()
+            lines.append(f"{filename}.vm:{line} {text}")
+            # push/pop are told apart by segment, the other commands by keyword
+            commands.append(" ".join(words[:2]) if words[0] in ["push", "pop"] else words[0])
+        else:
+            lines.append(functions[-1])
+            commands.append(functions[-1])
+    return np.array(starts, dtype=np.int64), functions, lines, commands
+
+
+def collapsed_stacks(counts, starts, frames):
+    """Flamegraph collapsed stacks : one "frame;frame;... count" line per region with executed instructions"""
+    folded = fold(counts, starts, [";".join(f.replace(";", ",") for f in stack) for stack in frames])
+    return [f"{stack} {count}" for stack, count in sorted(folded.items(), key=lambda item: -item[1])]
+
+
+def translate_for_profiling(path):
+    """Translate a VM file or directory, keeping the source map. Return the assembly commands, the SourceMap and the VM files"""
+    vm_files = list_vm_files(path)
+    name = os.path.basename(os.path.normpath(path))
+    code_writer = CodeWriter(name[:-3] if name.endswith(".vm") else name, None, source_map=True)
+    if os.path.isdir(path):
+        translate_directory(path, code_writer, processes=1)
+    else:
+        translate_file(path, code_writer)
+    return code_writer.asm_commands, code_writer.sourceMap(), vm_files
+
+
+def print_top(title, folded, total, n):
+    """Print the <n> entries with the most executed instructions"""
+    print(f"{title} :")
+    for name, count in sorted(folded.items(), key=lambda item: -item[1])[:n]:
+        print(f"  {count:>12} {100*count/max(total, 1):6.2f}%  {name}")
+
+
+if __name__ == "__main__":
+
+    # Profile a program (VM file or directory, assembly or binary) for a number of cycles
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("-")]
+    options = [arg for arg in sys.argv[1:] if arg.startswith("-")]
+    if len(args) not in [1, 2] or any(not option.startswith("-n=") for option in options):
+        print(f"Usage : {sys.argv[0]} <prog.vm | progDirectory | prog.asm | prog.hack | prog.binhack> [n_cycles] [-n=<top N>]")
+        exit()
+    path = args[0].rstrip("/")
+    n_cycles = int(args[1]) if len(args) == 2 else 1_000_000
+    top_n = int(options[0][3:]) if options else 20
+
+    source_map = None
+    labels_table = {}
+    if path.endswith(".vm") or os.path.isdir(path):
+        asm_commands, source_map, vm_files = translate_for_profiling(path)
+        assembler = Assembler()
+        rom = assembler.assemble_lines(asm_commands)
+        labels_table = assembler.labels_table
+    elif path.endswith(".asm"):
+        assembler = Assembler()
+        rom = assembler.assemble_file(path)
+        labels_table = assembler.labels_table
+    else:
+        rom = load_rom(path)
+
+    cpu = HackCPU(rom, profile=True)
+    if path.endswith(".vm") or (os.path.isdir(path) and not os.path.exists(os.path.join(path, "Sys.vm"))):
+        for address, value in VM_POINTERS.items():
+            cpu.RAM[address] = value
+
+    t0 = time.perf_counter()
+    cpu.run(n_cycles)
+    elapsed = time.perf_counter() - t0
+    counts = cpu.profile_counts()[:len(rom)]
+    past_end = n_cycles - int(counts.sum())
+    print(f"{n_cycles} cycles profiled in {elapsed:.3f} s ({past_end} past the end of the program)\n")
+
+    if labels_table:
+        print_top("Assembly labels", fold_to_labels(counts, labels_table), n_cycles, top_n)
+
+    if source_map is None:
+        by_label = fold_to_labels(counts, labels_table)
+        stacks = [f"{label} {count}" for label, count in sorted(by_label.items(), key=lambda item: -item[1])]
+    else:
+        starts, functions, lines, commands = vm_regions(source_map, read_vm_lines(vm_files))
+        print()
+        print_top("VM functions", fold(counts, starts, functions), n_cycles, top_n)
+        print()
+        print_top("VM commands", fold(counts, starts, commands), n_cycles, top_n)
+        print()
+        print_top("VM lines", fold(counts, starts, lines), n_cycles, top_n)
+        stacks = collapsed_stacks(counts, starts, [[function, line] for function, line in zip(functions, lines)])
+
+    fileout = (os.path.join(path, os.path.basename(path)) if os.path.isdir(path) else os.path.splitext(path)[0]) + ".folded"
+    with open(fileout, "w") as fd_out:
+        fd_out.write("\n".join(stacks) + "\n")
+    print(f"\nCollapsed stacks written in {fileout}")
@@ -0,0 +1,173 @@
+#! /bin/python3
+# Headless screen of the Hack computer : decoding of the memory-mapped screen into a bitmap, PNG/PGM dumps of the frames
+# and comparison with golden images
+
+import sys, os
+import time
+import zlib
+import struct
+import numpy as np
+
+from HackCPU import HackCPU
+
+# The screen is mapped from SCREEN : 256 rows of 32 words, the pixel (r, c) being the bit c % 16 (the least significant
+# bit being the leftmost pixel) of the word SCREEN + 32*r + c//16, 1 for black
+SCREEN_ADDRESS = 16384
+SCREEN_HEIGHT = 256
+SCREEN_WIDTH = 512
+SCREEN_WORDS = SCREEN_HEIGHT * SCREEN_WIDTH // 16
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+def decode_screen(ram):
+    """Bitmap of the screen (array of 256x512 uint8, 1 for black) from the data memory of the computer
+    The words are read as little-endian bytes, so that a single unpackbits in little bit order gives the pixels in order"""
+    words = np.asarray(ram[SCREEN_ADDRESS:SCREEN_ADDRESS + SCREEN_WORDS]).view(np.uint16)
+    data = words.astype("<u2", copy=False).view(np.uint8)
+    return np.unpackbits(data, bitorder="little").reshape(SCREEN_HEIGHT, SCREEN_WIDTH)
+
+
+def write_pgm(bitmap, filename):
+    """Save a bitmap as a binary PGM image (black 0, white 255)"""
+    height, width = bitmap.shape
+    with open(filename, "wb") as fd_out:
+        fd_out.write(f"P5\n{width} {height}\n255\n".encode())
+        fd_out.write(((1 - bitmap) * 255).astype(np.uint8).tobytes())
+
+
+def _png_chunk(kind, data):
+    """PNG chunk : length, type, data and CRC of the type and data"""
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+
+def write_png(bitmap, filename):
+    """Save a bitmap as a PNG image of 1-bit grayscale pixels (0 being black, the most significant bit the leftmost pixel)"""
+    height, width = bitmap.shape
+    rows = np.packbits(1 - bitmap, axis=1)
+    # Each row starts with its filter type : 0, no filter
+    scanlines = np.hstack([np.zeros((height, 1), dtype=np.uint8), rows])
+    with open(filename, "wb") as fd_out:
+        fd_out.write(PNG_SIGNATURE)
+        fd_out.write(_png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 1, 0, 0, 0, 0)))
+        fd_out.write(_png_chunk(b"IDAT", zlib.compress(scanlines.tobytes())))
+        fd_out.write(_png_chunk(b"IEND", b""))
+
+
+def write_frame(bitmap, filename):
+    """Save a bitmap as a .png or a .pgm image, by file extension"""
+    if filename.endswith(".png"):
+        write_png(bitmap, filename)
+    elif filename.endswith(".pgm"):
+        write_pgm(bitmap, filename)
+    else:
+        raise Exception(f"{filename} : .png or .pgm image expected")
+
+
+def read_pgm(filename):
+    """Read a binary PGM image as a bitmap (1 for the pixels darker than the middle gray)"""
+    with open(filename, "rb") as fd_in:
+        data = fd_in.read()
+    fields = data.split(maxsplit=4)
+    if len(fields) < 5 or fields[0] != b"P5":
+        raise Exception(f"{filename} : not a binary PGM image")
+    width, height, max_value = int(fields[1]), int(fields[2]), int(fields[3])
+    if max_value > 255:
+        raise Exception(f"{filename} : 16-bit PGM images are not supported")
+    pixels = np.frombuffer(fields[4][:width * height], dtype=np.uint8)
+    if pixels.size != width * height:
+        raise Exception(f"{filename} : truncated PGM image")
+    return (pixels.reshape(height, width) < (max_value + 1) // 2).astype(np.uint8)
+
+
+def read_png(filename):
+    """Read a PNG image of 1-bit grayscale pixels without filters (as written by write_png) as a bitmap"""
+    with open(filename, "rb") as fd_in:
+        data = fd_in.read()
+    if not data.startswith(PNG_SIGNATURE):
+        raise Exception(f"{filename} : not a PNG image")
+    offset = len(PNG_SIGNATURE)
+    header, idat = None, b""
+    while offset < len(data):
+        length, kind = struct.unpack_from(">I4s", data, offset)
+        chunk = data[offset + 8:offset + 8 + length]
+        if kind == b"IHDR":
+            header = struct.unpack(">IIBBBBB", chunk)
+        elif kind == b"IDAT":
+            idat += chunk
+        offset += 12 + length
+    if header is None or header[2:] != (1, 0, 0, 0, 0):
+        raise Exception(f"{filename} : only the non-interlaced 1-bit grayscale PNG images are supported")
+    width, height = header[:2]
+    scanlines = np.frombuffer(zlib.decompress(idat), dtype=np.uint8).reshape(height, -1)
+    if scanlines[:, 0].any():
+        raise Exception(f"{filename} : only the PNG images without filters are supported")
+    return 1 - np.unpackbits(scanlines[:, 1:], axis=1)[:, :width]
+
+
+def read_frame(filename):
+    """Read a .png or a .pgm image as a bitmap"""
+    if filename.endswith(".png"):
+        return read_png(filename)
+    if filename.endswith(".pgm"):
+        return read_pgm(filename)
+    raise Exception(f"{filename} : .png or .pgm image expected")
+
+
+def compare_frames(bitmap, golden):
+    """Compare a bitmap with a golden one : None if they are equal, else (number of differing pixels, bounding box
+    (first row, first column, last row, last column) of the differences)"""
+    if bitmap.shape != golden.shape:
+        raise Exception(f"Bitmap of shape {bitmap.shape}, golden image of shape {golden.shape}")
+    rows, columns = np.nonzero(bitmap != golden)
+    if rows.size == 0:
+        return None
+    return rows.size, (int(rows.min()), int(columns.min()), int(rows.max()), int(columns.max()))
+
+
+def snapshot_frames(cpu, n_frames, cycles_per_frame):
+    """Run the program of <cpu> and yield the bitmap of the screen every <cycles_per_frame> cycles, <n_frames> times"""
+    for _ in range(n_frames):
+        cpu.run(cycles_per_frame)
+        yield decode_screen(cpu.RAM)
+
+
+if __name__ == "__main__":
+
+    # Run a program for a number of cycles, then save its screen or compare it with a golden image
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    options = dict(arg[2:].split("=", 1) for arg in sys.argv[1:] if arg.startswith("--") and "=" in arg)
+    if len(args) not in [1, 2] or len(options) != len([arg for arg in sys.argv[1:] if arg.startswith("--")]) \
+            or any(option not in ["save", "golden", "ram"] for option in options):
+        print(f"Usage : {sys.argv[0]} <prog.hack | prog.binhack> [n_cycles] [--save=<image.png|pgm>] [--golden=<image.png|pgm>] [--ram=<address>:<value>,...]")
+        print("  --save : write the screen at the end of the run")
+        print("  --golden : compare the screen at the end of the run with a golden image")
+        print("  --ram : values set in the RAM before the run (eg the arguments of the program)")
+        exit()
+
+    n_cycles = int(args[1]) if len(args) == 2 else 1_000_000
+    cpu = HackCPU(args[0], jit=True)
+    for setting in options.get("ram", "").split(","):
+        if setting:
+            address, value = setting.split(":")
+            cpu.RAM[int(address)] = int(value)
+
+    t0 = time.perf_counter()
+    cpu.run(n_cycles)
+    t1 = time.perf_counter()
+    bitmap = decode_screen(cpu.RAM)
+    t2 = time.perf_counter()
+    print(f"{n_cycles} cycles in {t1 - t0:.3f} s, screen decoded in {(t2 - t1)*1e6:.0f} us ({int(bitmap.sum())} black pixels)")
+
+    if "save" in options:
+        write_frame(bitmap, options["save"])
+        print(f"Screen written in {options['save']}")
+
+    if "golden" in options:
+        difference = compare_frames(bitmap, read_frame(options["golden"]))
+        if difference is None:
+            print(f"Screen identical to {options['golden']}")
+        else:
+            n_pixels, (top, left, bottom, right) = difference
+            print(f"Screen differs from {options['golden']} : {n_pixels} pixels in rows {top}-{bottom}, columns {left}-{right}")
+            exit(1)
@@ -0,0 +1,159 @@
+#! /bin/python3
+# Source maps of the Hack programs : origin (file and line) of each range of assembly lines and of ROM addresses,
+# saved in a compact binary sidecar file (<output file>.map) next to the .asm written by VMTranslator.py
+# or the .hack written by my_assembler.py
+
+import sys, os
+import struct
+from array import array
+from bisect import bisect_right
+
+# Header of a source map file : magic, version, number of entries, of assembly lines, of instructions (ROM size),
+# number of file names and size of the names block (file names then function names, separated by "\n")
+SOURCE_MAP_MAGIC = b"HKSM"
+SOURCE_MAP_VERSION = 1
+SOURCE_MAP_HEADER = struct.Struct("<4sIIIIII")
+
+# Type codes of the columns, in the order they are written after the names (little-endian)
+SOURCE_MAP_COLUMNS = [
+    ("file_index", "H"),      # index in self.files
+    ("function_index", "i"),  # index in self.functions, -1 outside of any function
+    ("line", "I"),            # line in the source file (0 for generated code, eg the bootstrap)
+    ("asm_line", "I"),        # first assembly line of the entry (from 1)
+    ("rom_address", "I")      # first ROM address of the entry
+]
+
+
+class SourceMap:
+
+    def __init__(self):
+        """Empty source map. The entries are in the order of the program : entry i covers the assembly lines
+        [asm_line[i], asm_line[i+1]) and the ROM addresses [rom_address[i], rom_address[i+1]), the last one
+        ending at n_asm_lines + 1 and n_instructions"""
+        self.files = []
+        self.functions = []
+        self.file_indices = {}
+        self.function_indices = {}
+        for name, typecode in SOURCE_MAP_COLUMNS:
+            setattr(self, name, array(typecode))
+        self.n_asm_lines = 0
+        self.n_instructions = 0
+
+    def __len__(self):
+        return len(self.line)
+
+    def addEntry(self, filename, line, function, asm_line, rom_address):
+        """Add an entry : the code from the assembly line <asm_line> and the ROM address <rom_address> comes from
+        the line <line> of <filename>, in <function> (None outside of any function)"""
+        if filename not in self.file_indices:
+            self.file_indices[filename] = len(self.files)
+            self.files.append(filename)
+        if function is not None and function not in self.function_indices:
+            self.function_indices[function] = len(self.functions)
+            self.functions.append(function)
+        self.file_index.append(self.file_indices[filename])
+        self.function_index.append(-1 if function is None else self.function_indices[function])
+        self.line.append(line)
+        self.asm_line.append(asm_line)
+        self.rom_address.append(rom_address)
+
+    def entry(self, i):
+        """Entry i as a (file, line, function, (first asm line, last asm line + 1), (first ROM address, last ROM address + 1)) tuple"""
+        last = i + 1 == len(self)
+        asm_end = self.n_asm_lines + 1 if last else self.asm_line[i + 1]
+        rom_end = self.n_instructions if last else self.rom_address[i + 1]
+        function = self.functions[self.function_index[i]] if self.function_index[i] >= 0 else None
+        return (self.files[self.file_index[i]], self.line[i], function, (self.asm_line[i], asm_end), (self.rom_address[i], rom_end))
+
+    def lookup(self, address):
+        """Entry of the instruction at the ROM address <address> (see entry), None if it is not in the map"""
+        if not 0 <= address < self.n_instructions:
+            return None
+        # The entries without instruction (eg a VM label) share their address with the next one, the last one is taken
+        i = bisect_right(self.rom_address, address) - 1
+        return self.entry(i) if i >= 0 else None
+
+    def addressRanges(self, filename, line):
+        """ROM address ranges (first, last + 1) of the code coming from the line <line> of <filename>"""
+        if filename not in self.file_indices:
+            return []
+        file_index = self.file_indices[filename]
+        ranges = []
+        for i in range(len(self)):
+            if self.file_index[i] == file_index and self.line[i] == line:
+                _, _, _, _, rom_range = self.entry(i)
+                if rom_range[0] < rom_range[1]:
+                    ranges.append(rom_range)
+        return ranges
+
+
+def write_source_map(source_map, filename):
+    """Save a source map in its binary format : header, names, then the columns as little-endian arrays"""
+    names = "\n".join(source_map.files + source_map.functions).encode()
+    with open(filename + ".tmp", "wb") as fd_out:
+        fd_out.write(SOURCE_MAP_HEADER.pack(SOURCE_MAP_MAGIC, SOURCE_MAP_VERSION, len(source_map), source_map.n_asm_lines,
+                                            source_map.n_instructions, len(source_map.files), len(names)))
+        fd_out.write(names)
+        for name, _ in SOURCE_MAP_COLUMNS:
+            column = getattr(source_map, name)
+            if sys.byteorder == "big":
+                column = array(column.typecode, column)
+                column.byteswap()
+            column.tofile(fd_out)
+    os.replace(filename + ".tmp", filename)
+
+
+def read_source_map(filename):
+    """Load a source map saved by write_source_map"""
+    with open(filename, "rb") as fd_in:
+        data = fd_in.read()
+    if len(data) < SOURCE_MAP_HEADER.size:
+        raise Exception(f"{filename} : not a source map")
+    magic, version, n_entries, n_asm_lines, n_instructions, n_files, names_size = SOURCE_MAP_HEADER.unpack_from(data)
+    if magic != SOURCE_MAP_MAGIC:
+        raise Exception(f"{filename} : not a source map")
+    if version != SOURCE_MAP_VERSION:
+        raise Exception(f"{filename} : source map version {version}, {SOURCE_MAP_VERSION} expected")
+
+    source_map = SourceMap()
+    offset = SOURCE_MAP_HEADER.size
+    names = data[offset:offset + names_size].decode().split("\n") if names_size else []
+    offset += names_size
+    source_map.files, source_map.functions = names[:n_files], names[n_files:]
+    source_map.file_indices = {name : i for i, name in enumerate(source_map.files)}
+    source_map.function_indices = {name : i for i, name in enumerate(source_map.functions)}
+    source_map.n_asm_lines = n_asm_lines
+    source_map.n_instructions = n_instructions
+
+    for name, typecode in SOURCE_MAP_COLUMNS:
+        column = array(typecode)
+        size = n_entries * column.itemsize
+        if offset + size > len(data):
+            raise Exception(f"{filename} : truncated source map")
+        column.frombytes(data[offset:offset + size])
+        if sys.byteorder == "big":
+            column.byteswap()
+        setattr(source_map, name, column)
+        offset += size
+    return source_map
+
+
+if __name__ == "__main__":
+
+    # Print the entries of a source map, or the origin of a ROM address
+    if len(sys.argv) not in [2, 3]:
+        print(f"Usage : {sys.argv[0]} <prog.asm.map | prog.hack.map> [ROM address]")
+        exit()
+
+    source_map = read_source_map(sys.argv[1])
+    if len(sys.argv) == 3:
+        entry = source_map.lookup(int(sys.argv[2]))
+        if entry is None:
+            print(f"Address {sys.argv[2]} not in the source map")
+            exit()
+        entries = [entry]
+    else:
+        entries = [source_map.entry(i) for i in range(len(source_map))]
+
+    for filename, line, function, (asm_start, asm_end), (rom_start, rom_end) in entries:
+        print(f"{filename}:{line:<6} asm {asm_start:>7}-{asm_end - 1:<7} ROM {rom_start:>6}-{rom_end - 1:<6} {function or ''}")
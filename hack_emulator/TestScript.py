@@ -0,0 +1,391 @@
+#! /bin/python3
+# Runner of the nand2tetris test scripts (.tst) : the tested program is executed in-process and its output compared to the .cmp file
+
+import sys, os
+import re
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+from HackCPU import HackCPU, load_rom
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(REPO_DIR, "project6_assembler"))
+sys.path.append(os.path.join(REPO_DIR, "project8_vm_part2"))
+
+from my_assembler import Assembler
+from VMInterpreter import VMInterpreter, SEGMENT_POINTER, SEGMENT_BASE
+from VMTranslator import CodeWriter, translate_file, translate_directory
+
+# Directories holding the test scripts of the VM translator projects
+DEFAULT_TEST_DIRS = [
+    os.path.join(REPO_DIR, "project7_vm_part1"),
+    os.path.join(REPO_DIR, "project8_vm_part2")
+]
+
+# Separators and words of the test script language (comments being removed beforehand)
+TOKEN_PATTERN = re.compile(r"[{},;!]|[^\s{},;!]+")
+COMMENT_PATTERN = re.compile(r"//[^\n]*|/\*.*?\*/", re.DOTALL)
+
+# Output-list item, eg RAM[256]%D1.6.1 : variable, format, left padding, width, right padding
+OUTPUT_ITEM_PATTERN = re.compile(r"^(?P<var>[^%]+)(?:%(?P<fmt>[BDXS])(?P<left>\d+)\.(?P<width>\d+)\.(?P<right>\d+))?$")
+
+# Variable with an index, eg RAM[256]
+INDEXED_VAR_PATTERN = re.compile(r"^(?P<name>[\w.]+)\[(?P<index>-?\d+)\]$")
+
+# Simulation steps, that can be run by batches when repeated
+STEP_COMMANDS = ["ticktock", "vmstep"]
+
+
+def parse_script(source):
+    """Parse a test script into a list of commands, each command being a list of words,
+    except the repeat loops given as ["repeat", n, [commands]]"""
+    tokens = TOKEN_PATTERN.findall(COMMENT_PATTERN.sub(" ", source))
+    commands, i = _parse_commands(tokens, 0)
+    if i != len(tokens):
+        raise Exception("Unexpected '}' in the test script")
+    return commands
+
+
+def _parse_commands(tokens, i):
+    """Parse the commands from tokens[i] up to a closing brace or the end, return them and the index of the next token"""
+    commands = []
+    words = []
+    while i < len(tokens):
+        token = tokens[i]
+        if token == "}":
+            break
+        i += 1
+        if token in [",", ";", "!"]:
+            if words:
+                commands.append(words)
+            words = []
+        elif token == "{":
+            if len(words) != 2 or words[0] != "repeat":
+                raise Exception(f"Unsupported block : {' '.join(words)}")
+            body, i = _parse_commands(tokens, i)
+            if i == len(tokens):
+                raise Exception("Missing '}' in the test script")
+            i += 1
+            commands.append(["repeat", int(words[1]), body])
+            words = []
+        else:
+            words.append(token)
+    if words:
+        commands.append(words)
+    return commands, i
+
+
+def parse_int(text):
+    """Read an integer of a test script, decimal or in the %X / %B notations"""
+    if text.startswith("%X"):
+        return int(text[2:], 16)
+    if text.startswith("%B"):
+        return int(text[2:], 2)
+    if text.startswith("%D"):
+        return int(text[2:])
+    return int(text)
+
+
+def to_signed(value):
+    """Convert a 16-bit value to a signed integer"""
+    value &= 0xFFFF
+    return value - 0x10000 if value & 0x8000 else value
+
+
+def translate_vm_program(directory, name, shared=False, vm_optimizer=None, register_cache=False):
+    """Translate the VM program tested by a script into a list of assembly commands : the whole directory with the
+    bootstrap code when it has a Sys.vm file, else the file <name>.vm (through the optimizing pass of <vm_optimizer> if given)"""
+    code_writer = CodeWriter(name, None, shared=shared, register_cache=register_cache)
+    if os.path.exists(os.path.join(directory, "Sys.vm")):
+        translate_directory(directory, code_writer, processes=1, vm_optimizer=vm_optimizer)
+    else:
+        if shared:
+            code_writer.writeSharedRoutines()
+        translate_file(os.path.join(directory, f"{name}.vm"), code_writer, vm_optimizer)
+    return code_writer.asm_commands
+
+
+class CPUMachine:
+
+    def __init__(self, directory, script_name):
+        """Machine executing the Hack programs of a test script, the default program being <script_name>.asm"""
+        self.directory = directory
+        self.default_program = script_name
+        self.cpu = None
+
+    def load(self, program=None):
+        """Load a .asm (assembled in-process), .hack or .binhack program, the default program being translated
+        from the VM files of the directory when it has not been built"""
+        if program is None:
+            candidates = [self.default_program + suffix for suffix in [".asm", ".hack", ".binhack"]]
+            existing = [c for c in candidates if os.path.exists(os.path.join(self.directory, c))]
+            if not existing and any(f.endswith(".vm") for f in os.listdir(self.directory)):
+                asm_commands = translate_vm_program(self.directory, self.default_program)
+                self.cpu = HackCPU(Assembler().assemble_lines(asm_commands))
+                return
+            program = existing[0] if existing else " / ".join(candidates)
+        path = os.path.join(self.directory, program)
+        if not os.path.exists(path):
+            raise Exception(f"Program not found : {program}")
+        if path.endswith(".asm"):
+            rom = Assembler().assemble_file(path)
+        else:
+            rom = load_rom(path)
+        self.cpu = HackCPU(rom)
+
+    def step(self, command, n):
+        """Run <n> simulation steps"""
+        if command != "ticktock":
+            raise Exception(f"Unsupported command on the CPU emulator : {command}")
+        self.cpu.run(n)
+
+    def get(self, var):
+        """Value of a variable of the test script : RAM[i], A, D, PC or time"""
+        match = INDEXED_VAR_PATTERN.match(var)
+        if match and match.group("name") == "RAM":
+            return int(self.cpu.RAM[int(match.group("index"))])
+        match var:
+            case "A" : return to_signed(self.cpu.A)
+            case "D" : return to_signed(self.cpu.D)
+            case "PC" : return self.cpu.PC
+            case "time" : return self.cpu.cycles
+        raise Exception(f"Unknown variable : {var}")
+
+    def set(self, var, value):
+        """Set a variable of the test script : RAM[i], A, D or PC"""
+        match = INDEXED_VAR_PATTERN.match(var)
+        if match and match.group("name") == "RAM":
+            self.cpu.RAM[int(match.group("index"))] = to_signed(value)
+            return
+        match var:
+            case "A" : self.cpu.A = value & 0xFFFF
+            case "D" : self.cpu.D = value & 0xFFFF
+            case "PC" : self.cpu.PC = value
+            case _ : raise Exception(f"Unknown variable : {var}")
+
+
+class VMMachine:
+
+    def __init__(self, directory, script_name):
+        """Machine executing the VM programs of a test script, the default program being the whole directory"""
+        self.directory = directory
+        self.vm = None
+
+    def load(self, program=None):
+        """Load a .vm file or, by default, all the .vm files of the directory"""
+        path = self.directory if program is None else os.path.join(self.directory, program)
+        if not os.path.exists(path):
+            raise Exception(f"Program not found : {program}")
+        self.vm = VMInterpreter(path)
+
+    def step(self, command, n):
+        """Run <n> simulation steps"""
+        if command != "vmstep":
+            raise Exception(f"Unsupported command on the VM emulator : {command}")
+        self.vm.run(n)
+
+    def _address(self, var):
+        """RAM address of a variable of the test script : RAM[i], sp, local, argument, this, that or <segment>[i]"""
+        if var == "sp":
+            return 0
+        if var in SEGMENT_POINTER:
+            return SEGMENT_POINTER[var]
+        match = INDEXED_VAR_PATTERN.match(var)
+        if match:
+            name, index = match.group("name"), int(match.group("index"))
+            if name == "RAM":
+                return index
+            if name in SEGMENT_POINTER:
+                return (int(self.vm.RAM[SEGMENT_POINTER[name]]) + index) & 0xFFFF
+            if name in SEGMENT_BASE:
+                return SEGMENT_BASE[name] + index
+        raise Exception(f"Unknown variable : {var}")
+
+    def get(self, var):
+        """Value of a variable of the test script"""
+        return int(self.vm.RAM[self._address(var)])
+
+    def set(self, var, value):
+        """Set a variable of the test script"""
+        self.vm.RAM[self._address(var)] = to_signed(value)
+
+
+def format_value(value, fmt, width):
+    """Format a value of the output list : %D decimal, %X hexadecimal, %B binary, %S string"""
+    match fmt:
+        case "D" : return str(value).rjust(width)
+        case "X" : return f"{value & 0xFFFF:04X}".rjust(width)
+        case "B" : return f"{value & 0xFFFF:016b}".rjust(width)
+        case _ : return str(value).ljust(width)
+
+
+def uses_command(commands, name):
+    """Return boolean if the command <name> appears in the commands (including in the repeat loops)"""
+    for command in commands:
+        if command[0] == name or (command[0] == "repeat" and uses_command(command[2], name)):
+            return True
+    return False
+
+
+class ScriptRunner:
+
+    def __init__(self, path):
+        """Runner of a single test script"""
+        self.path = path
+        self.directory = os.path.dirname(os.path.abspath(path))
+        self.script_name = os.path.basename(path)[:-len(".tst")]
+        self.output = []
+        self.output_list = []
+        self.compare_to = None
+        self.machine = None
+
+    def run(self):
+        """Execute the script and return its output lines"""
+        with open(self.path, "r") as fd_in:
+            commands = parse_script(fd_in.read())
+
+        # Scripts of the VM emulator are run on the VM interpreter, the others on the CPU emulator
+        machine = VMMachine if uses_command(commands, "vmstep") else CPUMachine
+        self.machine = machine(self.directory, self.script_name)
+        if not any(command[0] == "load" for command in commands):
+            self.machine.load()
+
+        self._execute(commands)
+        return self.output
+
+    def _execute(self, commands):
+        """Execute a list of commands"""
+        for command in commands:
+            name = command[0]
+
+            if name == "repeat":
+                _, n, body = command
+                if body and all(c == body[0] and c[0] in STEP_COMMANDS for c in body):
+                    # Repeated simulation steps are run as a single batch
+                    self.machine.step(body[0][0], n * len(body))
+                else:
+                    for _ in range(n):
+                        self._execute(body)
+
+            elif name in STEP_COMMANDS:
+                self.machine.step(name, 1)
+
+            elif name == "load":
+                self.machine.load(command[1] if len(command) > 1 else None)
+
+            elif name == "compare-to":
+                self.compare_to = command[1]
+
+            elif name == "set":
+                self.machine.set(command[1], parse_int(command[2]))
+
+            elif name == "output-list":
+                self._setOutputList(command[1:])
+
+            elif name == "output":
+                values = [
+                    " " * left + format_value(self.machine.get(var), fmt, width)[-width:] + " " * right
+                    for var, fmt, left, width, right in self.output_list
+                ]
+                self.output.append("|" + "|".join(values) + "|")
+
+            elif name in ["output-file", "echo", "clear-echo"]:
+                pass
+
+            else:
+                raise Exception(f"Unsupported command : {' '.join(map(str, command))}")
+
+    def _setOutputList(self, items):
+        """Set the output list and write its header line"""
+        self.output_list = []
+        header = []
+        for item in items:
+            match = OUTPUT_ITEM_PATTERN.match(item)
+            if match is None:
+                raise Exception(f"Invalid output-list item : {item}")
+            var = match.group("var")
+            if match.group("fmt"):
+                fmt = match.group("fmt")
+                left, width, right = int(match.group("left")), int(match.group("width")), int(match.group("right"))
+            else:
+                fmt, left, width, right = "D", 1, 6, 1
+            self.output_list.append((var, fmt, left, width, right))
+
+            # The variable name is centered on the whole column, and truncated if needed
+            column = left + width + right
+            name = var[:column]
+            pad = column - len(name)
+            header.append(" " * (pad // 2) + name + " " * (pad - pad // 2))
+        self.output.append("|" + "|".join(header) + "|")
+
+    def compare(self):
+        """Compare the output to the .cmp file, return None if they match or the description of the first difference
+        (whitespaces are ignored, and a '*' in the .cmp file matches any character)"""
+        if self.compare_to is None:
+            return None
+        with open(os.path.join(self.directory, self.compare_to), "r") as fd_in:
+            expected = [line for line in fd_in.read().splitlines() if line.strip()]
+
+        for i, (out, cmp) in enumerate(zip(self.output, expected), 1):
+            out_compact, cmp_compact = "".join(out.split()), "".join(cmp.split())
+            if len(out_compact) != len(cmp_compact) or any(c != "*" and c != o for o, c in zip(out_compact, cmp_compact)):
+                return f"line {i} : expected {cmp.strip()} got {out}"
+        if len(self.output) != len(expected):
+            return f"{len(self.output)} output lines, {len(expected)} expected"
+        return None
+
+
+def run_script(path):
+    """Run a test script and return (path, status, message, elapsed time), status being among PASS, FAIL, ERROR"""
+    t0 = time.perf_counter()
+    runner = ScriptRunner(path)
+    try:
+        runner.run()
+        difference = runner.compare()
+    except Exception as e:
+        return (path, "ERROR", str(e), time.perf_counter() - t0)
+    if difference is None:
+        return (path, "PASS", "", time.perf_counter() - t0)
+    return (path, "FAIL", difference, time.perf_counter() - t0)
+
+
+def find_scripts(paths):
+    """List the .tst files given directly or found (recursively) in the given directories"""
+    scripts = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in sorted(os.walk(path)):
+                scripts += [os.path.join(root, f) for f in sorted(files) if f.endswith(".tst")]
+        else:
+            scripts.append(path)
+    return scripts
+
+
+def run_scripts(scripts, processes=None):
+    """Run test scripts in parallel on a pool of <processes> workers (all the cores by default), results being kept in order"""
+    if processes == 1:
+        return [run_script(script) for script in scripts]
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        return list(pool.map(run_script, scripts))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Run nand2tetris test scripts and compare their output to the .cmp files")
+    parser.add_argument("paths", nargs="*", default=DEFAULT_TEST_DIRS, help=".tst files or directories (project 7 and 8 by default)")
+    parser.add_argument("-j", "--processes", type=int, default=None, help="number of worker processes (all the cores by default)")
+    args = parser.parse_args()
+
+    t0 = time.perf_counter()
+    results = run_scripts(find_scripts(args.paths), args.processes)
+    elapsed = time.perf_counter() - t0
+
+    for path, status, message, duration in results:
+        print(f"{status:<5} {os.path.relpath(path)} ({duration*1e3:.0f} ms) {message}")
+
+    counts = {status : sum(1 for r in results if r[1] == status) for status in ["PASS", "FAIL", "ERROR"]}
+    print(f"{counts['PASS']} passed, {counts['FAIL']} failed, {counts['ERROR']} errors in {elapsed:.2f} s")
+
+    if counts["FAIL"] or counts["ERROR"]:
+        exit(1)
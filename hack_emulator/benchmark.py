@@ -0,0 +1,371 @@
+#! /bin/python3
+# Benchmarks of the Hack CPU emulator on the example programs
+
+import sys, os
+import time
+import random
+import tempfile
+import numpy as np
+
+from HackCPU import HackCPU, load_rom, map_binhack, write_checkpoint, read_checkpoint, ALU, RAM_SIZE, ROM_SIZE
+from Screen import decode_screen, snapshot_frames, write_png, SCREEN_ADDRESS, SCREEN_HEIGHT, SCREEN_WIDTH
+from BatchCPU import BatchCPU
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PONG = os.path.join(REPO_DIR, "project6_assembler", "binaries", "Pong.binhack")
+sys.path.append(os.path.join(REPO_DIR, "project6_assembler"))
+sys.path.append(os.path.join(REPO_DIR, "project8_vm_part2"))
+
+from my_assembler import Assembler
+from VMTranslator import CodeWriter, translate_file
+from TestScript import translate_vm_program, parse_script
+
+
+def timeit(func, *args, repeat=3):
+    """Return the best wall time (in seconds) over <repeat> calls of func(*args)"""
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def run_naive(rom, n_cycles):
+    """Straightforward interpreter decoding the fields of every instruction at each cycle (reference for the comparisons)"""
+    ram = [0] * RAM_SIZE
+    a = d = pc = 0
+    for _ in range(n_cycles):
+        instruction = rom[pc] if pc < len(rom) else 0
+        if instruction & 0x8000 == 0:
+            a = instruction
+            pc += 1
+            continue
+        m = ram[a] if instruction & 0x1000 else a
+        x, y = d, m
+        # ALU control bits : zx nx zy ny f no
+        if instruction & 0x0800: x = 0
+        if instruction & 0x0400: x ^= 0xFFFF
+        if instruction & 0x0200: y = 0
+        if instruction & 0x0100: y ^= 0xFFFF
+        out = (x + y) & 0xFFFF if instruction & 0x0080 else x & y
+        if instruction & 0x0040: out ^= 0xFFFF
+        target = a
+        if instruction & 0x0008: ram[a] = out
+        if instruction & 0x0010: d = out
+        if instruction & 0x0020: a = out
+        negative, zero = out & 0x8000, out == 0
+        if ((instruction & 0b100 and negative) or (instruction & 0b010 and zero)
+                or (instruction & 0b001 and not negative and not zero)):
+            pc = target
+        else:
+            pc += 1
+    return ram
+
+
+def run_cpu(rom, n_cycles, jit):
+    """Run a program on a fresh HackCPU"""
+    cpu = HackCPU(rom, jit=jit)
+    cpu.run(n_cycles)
+    return cpu
+
+
+# Execution modes of the HackCPU : interpreter, basic blocks, profiling
+CPU_MODES = [
+    {},
+    {"jit" : True},
+    {"profile" : True}
+]
+
+
+def run_mode(rom, n_cycles, mode):
+    """Final state (PC, A, D, RAM) of a run of a fresh HackCPU in the mode <mode>, or the message of the error it raised"""
+    cpu = HackCPU(rom, **mode)
+    try:
+        cpu.run(n_cycles)
+    except Exception as e:
+        return str(e)
+    return (cpu.PC, cpu.A, cpu.D, cpu.RAM.tobytes())
+
+
+def check_pc_wrap_around():
+    """Regression checks of the PC in all the modes : a jump to A >= ROM_SIZE lands at A & PC_MASK, and the PC wraps
+    around after the last ROM address (the run used to never return)"""
+    programs = [
+        # @0, A=!A, 0;JMP : jump to 0xFFFF, ie to the last ROM address, past the end of the program
+        ("jump to 0xFFFF", [0, 0b1110110001100000, 0b1110101010000111], 102, (2, 0xFFFF)),
+        # A full ROM of @0 instructions
+        ("full ROM", [0] * ROM_SIZE, 70_000, (70_000 % ROM_SIZE, 0))
+    ]
+    for name, rom, n_cycles, expected in programs:
+        for mode in CPU_MODES:
+            cpu = HackCPU(rom, **mode)
+            cpu.run(n_cycles)
+            if (cpu.PC, cpu.A) != expected:
+                raise Exception(f"{name} {mode} : PC={cpu.PC} A={cpu.A} after {n_cycles} cycles, {expected} expected")
+
+
+def check_execution_modes(n_programs=300, length=24, n_cycles=500):
+    """Regression check : the interpreter, basic blocks and profiling modes end in the same state, or raise the same
+    error, on random programs (jumps anywhere, accesses out of the RAM...) and on M;JMP out of the RAM"""
+    rng = random.Random(0)
+    comps = sorted(ALU)
+    programs = [[0b1110111010100000, 0b1111110000000111]] # A=-1, M;JMP : the out of range read is not skipped
+    for _ in range(n_programs):
+        rom = []
+        for _ in range(length):
+            if rng.random() < 0.4:
+                rom.append(rng.choice([rng.randrange(length), rng.randrange(1 << 15)]))
+            else:
+                rom.append(0b111 << 13 | rng.choice(comps) << 6 | rng.randrange(8) << 3 | rng.randrange(8))
+        programs.append(rom)
+
+    for rom in programs:
+        states = [run_mode(rom, n_cycles, mode) for mode in CPU_MODES]
+        if any(state != states[0] for state in states[1:]):
+            raise Exception(f"The execution modes differ on the program {rom}")
+
+
+def check_batch_runs(n_instances=3, ram_size=16):
+    """Regression checks of BatchCPU against HackCPU : a run split in two calls of run (the cycle limit used to be
+    absolute), a jump into the jump of a halt loop with another A (used to halt), past the end of the program (used
+    to halt, the PC wraps around) and a halt loop"""
+    programs = [
+        # @R0, M=M+1 : then @0 up to the end of the ROM, and again from 0
+        ("past the end", [0, 0b1111110111001000], 100_000, False),
+        # @R0, M=M+1, @5, A=0;JMP (to 5 with A=0), @4, 0;JMP (halt loop at 4, not entered)
+        ("halt loop jump", [0, 0b1111110111001000, 5, 0b1110101010100111, 4, 0b1110101010000111], 1_000, False),
+        # @R0, M=M+1, @2, 0;JMP (halt loop at 2)
+        ("halt loop", [0, 0b1111110111001000, 2, 0b1110101010000111], 1_000, True)
+    ]
+    for name, rom, n_cycles, halts in programs:
+        batch = BatchCPU(rom, n_instances, ram_size)
+        batch.RAM[:, 0] = np.arange(n_instances)
+        batch.run(n_cycles // 2)
+        batch.run(n_cycles - n_cycles // 2)
+        for i in range(n_instances):
+            cpu = HackCPU(rom)
+            cpu.RAM[0] = i
+            cpu.run(int(batch.cycles[i]))
+            if ((cpu.PC, cpu.A, cpu.D) != (batch.PC[i], batch.A[i], batch.D[i]) or (cpu.RAM[:ram_size] != batch.RAM[i]).any()
+                    or batch.halted[i] != halts or (not halts and batch.cycles[i] != n_cycles)):
+                raise Exception(f"{name} : BatchCPU and HackCPU differ on instance {i} after {batch.cycles[i]} cycles")
+
+
+def bench_interpreters():
+    """Compare the throughput of the naive interpreter, of the pre-decoded interpreter and of the basic-block
+    compilation on Pong (the compiled mode is timed on a longer run, including the compilation of the blocks)"""
+    rom = load_rom(PONG)
+
+    runs = [
+        ("naive interpreter", 1_000_000, lambda n: run_naive(rom, n)),
+        ("pre-decoded interpreter", 3_000_000, lambda n: run_cpu(rom, n, False)),
+        ("basic blocks (jit)", 20_000_000, lambda n: run_cpu(rom, n, True))
+    ]
+
+    print("Pong")
+    reference = None
+    for name, n_cycles, run in runs:
+        throughput = n_cycles / timeit(run, n_cycles) / 1e6
+        reference = reference or throughput
+        print(f"  {name:<24} : {n_cycles:>10} cycles | {throughput:6.2f} M instructions/s | x{throughput/reference:.1f}")
+
+
+def bench_rom_loading(scale=64):
+    """Compare reading a multi-MB .binhack image (Pong repeated <scale> times) into memory and memory-mapping it"""
+    image = np.tile(np.fromfile(PONG, dtype=">u2"), scale)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "image.binhack")
+        image.tofile(path)
+
+        t_read = timeit(np.fromfile, path, ">u2")
+        t_map = timeit(map_binhack, path)
+        t_map_sum = timeit(lambda: int(map_binhack(path, len(image)).sum()))
+
+    print(f".binhack image of {image.nbytes/2**20:.1f} MB")
+    print(f"  read : {t_read*1e3:7.3f} ms | mmap : {t_map*1e3:7.3f} ms (x{t_read/t_map:.0f}) | mmap + checked length + sum : {t_map_sum*1e3:7.3f} ms")
+
+
+def decode_screen_naive(ram):
+    """Bitmap of the screen computed pixel by pixel (reference for the comparisons)"""
+    bitmap = np.zeros((SCREEN_HEIGHT, SCREEN_WIDTH), dtype=np.uint8)
+    for row in range(SCREEN_HEIGHT):
+        for column in range(SCREEN_WIDTH):
+            word = int(ram[SCREEN_ADDRESS + 32 * row + column // 16])
+            bitmap[row, column] = (word >> (column % 16)) & 1
+    return bitmap
+
+
+def bench_screen_snapshots(n_frames=200, cycles_per_frame=50_000, warmup=6_000_000):
+    """Time the decoding of the screen, pixel by pixel and vectorized, and the cost of a snapshot every
+    <cycles_per_frame> cycles on a Pong run (basic blocks mode) once it has drawn its screen"""
+    cpu = HackCPU(PONG, jit=True)
+    cpu.run(warmup)
+    bitmap = decode_screen(cpu.RAM)
+    if not (decode_screen_naive(cpu.RAM) == bitmap).all():
+        raise Exception("The vectorized decoding differs from the pixel by pixel one")
+
+    t_naive = timeit(decode_screen_naive, cpu.RAM, repeat=1)
+    t_vectorized = timeit(decode_screen, cpu.RAM, repeat=20)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        t_png = timeit(write_png, bitmap, os.path.join(tmp_dir, "frame.png"), repeat=20)
+
+    t0 = time.perf_counter()
+    cpu.run(n_frames * cycles_per_frame)
+    t_run = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    for _ in snapshot_frames(cpu, n_frames, cycles_per_frame):
+        pass
+    t_snapshots = time.perf_counter() - t0
+
+    print(f"Pong screen ({int(bitmap.sum())} black pixels)")
+    print(f"  decoding : pixel by pixel {t_naive*1e3:8.2f} ms | unpackbits {t_vectorized*1e6:6.1f} us (x{t_naive/t_vectorized:.0f}) | PNG dump {t_png*1e3:5.2f} ms")
+    print(f"  {n_frames} frames of {cycles_per_frame} cycles : run {t_run:5.2f} s | run + snapshots {t_snapshots:5.2f} s"
+          f" (decoding {n_frames*t_vectorized/t_snapshots:.1%} of the time)")
+
+
+def batch_programs(n_instances):
+    """Programs of the batch benchmark : (name, ROM, RAM size, initial RAM of the instances, RAM words checked, expected values)
+    - Mult (project 4) : res = R0 * R1
+    - Max (project 6) : R2 = max(R0, R1), on values whose difference fits in 16 bits
+    - BasicLoop (translated from project 8, without bootstrap) : push the sum of 1..ARG[0]"""
+    rng = np.random.default_rng(0)
+    programs = []
+
+    assembler = Assembler()
+    rom = assembler.assemble_file(os.path.join(REPO_DIR, "project4_machine_language", "Mult.asm"))
+    res = assembler.symbol_table.getAddress("res")
+    seeds = rng.integers(0, 100, size=(n_instances, 2))
+    programs.append(("Mult", rom, 32, seeds, res, (seeds[:, 0] * seeds[:, 1]) & 0xFFFF))
+
+    rom = Assembler().assemble_file(os.path.join(REPO_DIR, "project6_assembler", "assembly_examples", "Max.asm"))
+    # R0 - R1 overflows for values of opposite signs further apart, and Max.asm then gives the wrong one
+    seeds = rng.integers(-16384, 16384, size=(n_instances, 2))
+    programs.append(("Max", rom, 32, seeds, 2, seeds.max(axis=1)))
+
+    code_writer = CodeWriter("BasicLoop", None)
+    translate_file(os.path.join(REPO_DIR, "project8_vm_part2", "BasicLoop", "BasicLoop.vm"), code_writer)
+    # Halt loop at the end (past the end of the program, the PC would wrap around to the start)
+    rom = Assembler().assemble_lines(code_writer.asm_commands + ["(END)", "@END", "0;JMP"])
+    # The loop is run before its test : ARG[0] = 0 would count down from 65535
+    n = rng.integers(1, 100, size=n_instances)
+    ram = np.zeros((n_instances, 401), dtype=np.int64)
+    ram[:, 0:3] = [256, 300, 400] # SP, LCL, ARG
+    ram[:, 400] = n
+    programs.append(("BasicLoop", rom, 512, ram, 256, n * (n + 1) // 2))
+    return programs
+
+
+def bench_batch(n_instances=10_000, n_sequential=200):
+    """Compare the lockstep batch emulation of <n_instances> inputs with sequential runs on HackCPU (timed on
+    <n_sequential> of them), the results being checked against the expected ones and against HackCPU"""
+    print(f"Batch of {n_instances} inputs")
+    for name, rom, ram_size, seeds, checked, expected in batch_programs(n_instances):
+        batch = BatchCPU(rom, n_instances, ram_size)
+
+        def run_batch():
+            batch.reset()
+            batch.RAM[:] = 0
+            batch.RAM[:, :seeds.shape[1]] = seeds
+            return batch.run(1_000_000)
+
+        t_batch = timeit(run_batch, repeat=1)
+        n_steps = batch.steps
+        if not batch.halted.all() or (batch.RAM[:, checked] != expected.astype(np.int16)).any():
+            raise Exception(f"{name} : wrong results in batch mode")
+
+        def run_sequential():
+            for i in range(n_sequential):
+                cpu = HackCPU(rom)
+                cpu.RAM[:seeds.shape[1]] = seeds[i]
+                cpu.run(int(batch.cycles[i]))
+                if cpu.RAM[checked] != batch.RAM[i, checked] or cpu.PC != batch.PC[i]:
+                    raise Exception(f"{name} : batch and sequential runs differ on input {i}")
+
+        t_sequential = timeit(run_sequential, repeat=1) / n_sequential
+        print(f"  {name:<10} {int(batch.cycles.sum()):9} cycles in {n_steps:5} steps : batch {t_batch:6.3f} s"
+              f" | sequential {t_sequential*1e3:6.3f} ms per run | batch = {t_batch/t_sequential:5.0f} sequential runs"
+              f" (x{n_instances*t_sequential/t_batch:.0f})")
+
+
+def bench_checkpoints(n_forks=20, warmup=6_000_000, n_cycles=100_000):
+    """Time <n_forks> runs of <n_cycles> cycles forked from a checkpoint of Pong after <warmup> cycles (basic blocks
+    mode), against runs re-executing the warmup, and check that a fork ends in the same state as a run from the start"""
+    cpu = HackCPU(PONG, jit=True)
+    cpu.run(warmup)
+    t_checkpoint = timeit(cpu.checkpoint, repeat=20)
+    checkpoint = cpu.checkpoint()
+
+    def run_forks(restore):
+        for _ in range(n_forks):
+            restore()
+            cpu.run(n_cycles)
+
+    def rerun():
+        cpu.reset()
+        cpu.RAM[:] = 0
+        cpu.run(warmup)
+
+    t_rerun = timeit(run_forks, rerun, repeat=1) / n_forks
+    reference = cpu.checkpoint()
+    t_forks = timeit(run_forks, lambda: cpu.restore(checkpoint), repeat=1) / n_forks
+    if cpu.checkpoint() != reference:
+        raise Exception("A fork of the checkpoint differs from a run from the start")
+    t_restore = timeit(cpu.restore, checkpoint, repeat=20)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "Pong.ckpt")
+        write_checkpoint(cpu, path)
+        t_file = timeit(lambda: cpu.restore(read_checkpoint(path)), repeat=20)
+        size = os.path.getsize(path)
+
+    print(f"Pong checkpoint after {warmup} cycles ({len(checkpoint)} bytes, file of {size} bytes)")
+    print(f"  checkpoint {t_checkpoint*1e6:6.1f} us | restore {t_restore*1e6:6.1f} us | restore from the file {t_file*1e6:6.1f} us")
+    print(f"  run of {n_cycles} cycles : from the start {t_rerun:6.3f} s | forked from the checkpoint {t_forks:6.3f} s (x{t_rerun/t_forks:.0f})")
+
+
+def script_cycles(script):
+    """Number of ticktock steps of a test script"""
+    with open(script, "r") as fd_in:
+        commands = parse_script(fd_in.read())
+    return sum(command[1] * len(command[2]) for command in commands if command[0] == "repeat") \
+        + sum(1 for command in commands if command[0] == "ticktock")
+
+
+def bench_halt_fast_forward(programs=("FibonacciElement", "NestedCall", "StaticsTest"), scale=1000):
+    """Time the test programs of project 8 run for the number of cycles of their test script and for <scale> times
+    more, with and without fast-forward of the halt loops (interpreter mode, as in the test scripts)"""
+    print(f"Cycles of the test scripts (x1 | x{scale}), run without | with fast-forward of the halt loops")
+    for name in programs:
+        directory = os.path.join(REPO_DIR, "project8_vm_part2", name)
+        rom = Assembler().assemble_lines(translate_vm_program(directory, name))
+        budget = script_cycles(os.path.join(directory, f"{name}.tst"))
+        results = []
+        for n_cycles in [budget, scale * budget]:
+            states = []
+            for fast_forward in [False, True]:
+                cpu = HackCPU(rom, fast_forward=fast_forward)
+                t0 = time.perf_counter()
+                cpu.run(n_cycles)
+                results.append(time.perf_counter() - t0)
+                states.append((cpu.A, cpu.D, cpu.PC, cpu.cycles, cpu.RAM.tobytes()))
+            if states[0] != states[1]:
+                raise Exception(f"{name} : the fast-forward changes the state after {n_cycles} cycles")
+        t_plain, t_fast, t_plain_scaled, t_fast_scaled = results
+        print(f"  {name:<17} halted at cycle {cpu.halt_cycle:6} of {budget:6}"
+              f" | x1 : {t_plain*1e3:8.2f} ms | {t_fast*1e3:6.2f} ms (x{t_plain/t_fast:.1f})"
+              f" | x{scale} : {t_plain_scaled*1e3:8.2f} ms | {t_fast_scaled*1e3:6.2f} ms (x{t_plain_scaled/t_fast_scaled:.0f})")
+
+
+if __name__ == "__main__":
+
+    check_pc_wrap_around()
+    check_execution_modes()
+    check_batch_runs()
+    bench_interpreters()
+    bench_rom_loading()
+    bench_screen_snapshots()
+    bench_batch()
+    bench_checkpoints()
+    bench_halt_fast_forward()
@@ -0,0 +1,250 @@
+#! /bin/python3
+# Benchmarks of the assembler on the example programs
+
+import sys, os
+import re
+import time
+import shutil
+import subprocess
+import tempfile
+import numpy as np
+
+from my_assembler import SymbolTable, Assembler, IncrementalAssembler, tokenize, write_hack, write_binhack, COMP_CODE, DEST_CODE, JUMP_CODE
+from my_disassembler import load_words, disassemble, instruction_stats
+
+EXAMPLES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "assembly_examples")
+
+
+def timeit(func, *args, repeat=5):
+    """Return the best wall time (in seconds) over <repeat> calls of func(*args)"""
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def get_free_address(address_list):
+    """Get the smallest integer not in the list <address_list> (former allocator, kept as a reference)"""
+    addresses = np.array(address_list)
+    addresses.sort()
+    first_gap = np.argmax( (addresses[1:] - addresses[:-1]) > 1)
+    addr = addresses[first_gap] + 1
+    return addr
+
+
+def read_symbols(asm_file):
+    """Return the symbols of the A-instructions of an assembly file, in order, and the set of its labels"""
+    symbols, labels = [], set()
+    with open(asm_file, "r") as fd_in:
+        for line in fd_in:
+            line = line.strip()
+            if line.startswith("("):
+                labels.add(line[1:-1])
+            elif line.startswith("@") and not line[1:].isdigit():
+                symbols.append(line[1:])
+    return [s for s in symbols if s not in labels], labels
+
+
+def allocate_legacy(symbols):
+    """Allocate the variables the way the assembler used to"""
+    table = dict(zip([f"R{i}" for i in range(16)], list(range(16))))
+    table["SCREEN"] = 16384
+    table["KBD"] = 24576
+    for s in symbols:
+        if s not in table:
+            table[s] = get_free_address(list(table.values()))
+    return table
+
+
+def allocate_symbol_table(symbols):
+    """Allocate the variables with the SymbolTable running counter"""
+    table = SymbolTable()
+    for s in symbols:
+        if not table.contains(s):
+            table.addVariable(s)
+    return table
+
+
+def bench_symbol_allocation():
+    """Compare the former allocator and the SymbolTable on Pong.asm and on a program with many statics"""
+    pong_symbols, _ = read_symbols(os.path.join(EXAMPLES_DIR, "Pong.asm"))
+    statics = [f"Main.{i}" for i in range(5000)]
+
+    print("Symbol allocation")
+    for name, symbols in [("Pong.asm", pong_symbols), ("5000 statics", statics)]:
+        t_legacy = timeit(allocate_legacy, symbols, repeat=1)
+        t_table = timeit(allocate_symbol_table, symbols)
+        print(f"  {name:<14} get_free_address : {t_legacy*1e3:9.2f} ms | SymbolTable : {t_table*1e3:7.2f} ms | x{t_legacy/t_table:.0f}")
+
+
+def bench_batch_assembly(n_programs=50):
+    """Compare one process per program against a single reused Assembler on a batch of small programs"""
+    sources = [os.path.join(EXAMPLES_DIR, f) for f in ["Add.asm", "Max.asm", "MaxL.asm", "Rect.asm", "RectL.asm"]]
+    batch = [sources[i % len(sources)] for i in range(n_programs)]
+    assembler_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "my_assembler.py")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        copies = []
+        for i, src in enumerate(batch):
+            copies.append(shutil.copy(src, os.path.join(tmp_dir, f"prog{i}.asm")))
+
+        def spawn_per_program():
+            for path in copies:
+                subprocess.run([sys.executable, assembler_path, path], check=True, stdout=subprocess.DEVNULL)
+
+        def in_process():
+            assembler = Assembler()
+            for path in copies:
+                assembler.assemble_file(path)
+
+        t_spawn = timeit(spawn_per_program, repeat=1)
+        t_batch = timeit(in_process)
+
+    print(f"Batch of {n_programs} programs")
+    print(f"  one process per program : {t_spawn*1e3:9.2f} ms | one Assembler : {t_batch*1e3:7.2f} ms | x{t_spawn/t_batch:.0f}")
+
+
+
+def write_binhack_legacy(binary, filename):
+    """Write the .binhack file through one big bit string (former implementation, kept as a reference)"""
+    binary_string = "".join(f"{instruction:016b}" for instruction in binary)
+    binary_data = int(binary_string, 2).to_bytes((len(binary_string) + 7) // 8, byteorder="big")
+    with open(filename, "wb") as binary_file:
+        binary_file.write(binary_data)
+
+
+def bench_output(scale=10):
+    """Compare the writing of the .binhack file through a bit string and from the array('H') buffer"""
+    binary = Assembler().assemble_file(os.path.join(EXAMPLES_DIR, "Pong.asm"))
+
+    print(".binhack output")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        out = os.path.join(tmp_dir, "prog.binhack")
+        for name, program in [("Pong", binary), (f"Pong x{scale}", binary * scale)]:
+            t_legacy = timeit(write_binhack_legacy, program, out, repeat=1)
+            t_buffer = timeit(write_binhack, program, out)
+            t_hack = timeit(write_hack, program, out)
+            print(f"  {name:<9} bit string : {t_legacy*1e3:8.2f} ms | buffer : {t_buffer*1e3:6.2f} ms | x{t_legacy/t_buffer:.0f} (.hack text : {t_hack*1e3:.2f} ms)")
+
+
+
+def front_end_legacy(asm_file):
+    """Read and clean an assembly file with the former per-line regular expressions (kept as a reference)"""
+    with open(asm_file, "r") as infile:
+        lines = infile.readlines()
+    lines = [line.replace("\n","") for line in lines]
+    lines = [
+        line for line in lines
+        if not re.match(r'^\s*(//|$)', line)
+    ]
+    lines = [re.sub(r'\s+', '', line) for line in lines]
+    for l in lines:
+        if l[0] not in "(@":
+            re.match(r"^(?:(?P<dest>[A-Z]+)=)?(?P<comp>[^;=]+)(?:;(?P<jump>[A-Z]+))?$", l)
+    return lines
+
+
+def front_end_tokenize(asm_file):
+    """Read and tokenize an assembly file in a single pass"""
+    with open(asm_file, "r") as infile:
+        return list(tokenize(infile.read()))
+
+
+def bench_front_end():
+    """Compare the throughput of the former per-line front end and of the single-pass tokenizer on Pong.asm"""
+    pong = os.path.join(EXAMPLES_DIR, "Pong.asm")
+    n_lines = sum(1 for _ in open(pong))
+
+    t_legacy = timeit(front_end_legacy, pong)
+    t_tokenize = timeit(front_end_tokenize, pong)
+    print("Front end on Pong.asm")
+    print(f"  per-line regex : {t_legacy*1e3:6.2f} ms ({n_lines/t_legacy/1e6:.2f} Mlines/s) | tokenize : {t_tokenize*1e3:6.2f} ms ({n_lines/t_tokenize/1e6:.2f} Mlines/s) | x{t_legacy/t_tokenize:.1f}")
+
+
+def edit_line(source, i):
+    """Return the source with its <i>-th D=M instruction changed into D=A"""
+    lines = source.split("\n")
+    line = [k for k, l in enumerate(lines) if l.strip() == "D=M"][i]
+    lines[line] = "D=A"
+    return "\n".join(lines)
+
+
+def bench_incremental_assembly(n_edits=10):
+    """Compare the full assembly of Pong.asm after a one-line edit with the incremental assembly, in-process
+    and through the cache file (loaded and saved at each run, as from the command line)"""
+    with open(os.path.join(EXAMPLES_DIR, "Pong.asm"), "r") as fd_in:
+        source = fd_in.read()
+    edited = [edit_line(source, 100 * i) for i in range(n_edits)]
+
+    def full():
+        for src in edited:
+            Assembler().assemble_source(src)
+
+    assembler = IncrementalAssembler()
+    assembler.assemble_source(source)
+
+    def incremental():
+        for src in edited:
+            assembler.assemble_source(src)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cache_path = os.path.join(tmp_dir, "Pong.asmcache")
+        IncrementalAssembler(cache_path).assemble_source(source)
+
+        def incremental_cache_file():
+            for src in edited:
+                IncrementalAssembler(cache_path).assemble_source(src)
+
+        for src in edited:
+            if IncrementalAssembler(cache_path).assemble_source(src) != Assembler().assemble_source(src):
+                raise Exception("The incremental assembly differs from the full one")
+        t_file = timeit(incremental_cache_file) / n_edits
+
+    t_full = timeit(full) / n_edits
+    t_incremental = timeit(incremental) / n_edits
+    print("Reassembly of Pong.asm after a one-line edit")
+    print(f"  full : {t_full*1e3:6.2f} ms | incremental : {t_incremental*1e3:6.2f} ms (x{t_full/t_incremental:.0f}) | incremental with cache file : {t_file*1e3:6.2f} ms (x{t_full/t_file:.1f})")
+
+
+def disassemble_loop(hack_file):
+    """Disassemble a .hack file line by line, decoding the fields of each instruction string (reference for the comparison)"""
+    comp_text = {code : text for text, code in reversed(COMP_CODE.items())}
+    dest_text = {code : text for text, code in reversed(DEST_CODE.items())}
+    jump_text = {code : text for text, code in reversed(JUMP_CODE.items())}
+    lines = []
+    with open(hack_file, "r") as fd_in:
+        for line in fd_in:
+            if line[0] == "0":
+                lines.append(f"@{int(line, 2)}")
+            else:
+                dest, jump = dest_text[int(line[10:13], 2)], jump_text[int(line[13:16], 2)]
+                lines.append((dest + "=" if dest else "") + comp_text[int(line[3:10], 2)] + (";" + jump if jump else ""))
+    return lines
+
+
+def bench_disassembly():
+    """Compare the disassembly of Pong.hack line by line and with the vectorized decoder (with and without the
+    relabeling of the jump targets), and time the static statistics"""
+    hack_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "binaries", "Pong.hack")
+    if disassemble_loop(hack_file) != disassemble(load_words(hack_file), relabel=False):
+        raise Exception("The vectorized disassembly differs from the reference one")
+
+    t_loop = timeit(disassemble_loop, hack_file)
+    t_vectorized = timeit(lambda: disassemble(load_words(hack_file), relabel=False))
+    t_relabel = timeit(lambda: disassemble(load_words(hack_file)))
+    t_stats = timeit(lambda: instruction_stats(load_words(hack_file)))
+    print("Disassembly of Pong.hack")
+    print(f"  line by line : {t_loop*1e3:6.2f} ms | vectorized : {t_vectorized*1e3:5.2f} ms (x{t_loop/t_vectorized:.0f}) | "
+          f"with labels : {t_relabel*1e3:5.2f} ms | statistics : {t_stats*1e3:5.2f} ms")
+
+
+if __name__ == "__main__":
+
+    bench_symbol_allocation()
+    bench_batch_assembly()
+    bench_output()
+    bench_front_end()
+    bench_incremental_assembly()
+    bench_disassembly()
@@ -3,192 +3,432 @@
 
 import sys, os
 import re 
-import numpy as np 
+import pickle
+from array import array
 
-pattern_c_inst = r"^(?:(?P<dest>[A-Z]+)=)?(?P<comp>[^;=]+)(?:;(?P<jump>[A-Z]+))?$"
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(REPO_DIR, "hack_emulator"))
 
+from SourceMap import SourceMap, write_source_map
+
+# The codes are stored as integer bitfields, a C-instruction being 111a cccc ccdd djjj
 JUMP_CODE = {
-    "JGT" : "001",
-    "JEQ" : "010",
-    "JGE" : "011",
-    "JLT" : "100",
-    "JNE" : "101",
-    "JLE" : "110",
-    "JMP" : "111",
-    ""    : "000"
+    "JGT" : 0b001,
+    "JEQ" : 0b010,
+    "JGE" : 0b011,
+    "JLT" : 0b100,
+    "JNE" : 0b101,
+    "JLE" : 0b110,
+    "JMP" : 0b111,
+    ""    : 0b000
 }
 
 DEST_CODE = {
-    "M"     : "001",
-    "D"     : "010",
-    "DM"    : "011",
-    "MD"    : "011",
-    "A"     : "100",
-    "AM"    : "101",
-    "MA"    : "101",
-    "AD"    : "110",
-    "DA"    : "110",
-    "ADM"   : "111",
-    "AMD"   : "111",
-    "DMA"   : "111",
-    "DAM"   : "111",
-    "MAD"   : "111",
-    "MDA"   : "111",
-    ""      : "000"
+    "M"     : 0b001,
+    "D"     : 0b010,
+    "DM"    : 0b011,
+    "MD"    : 0b011,
+    "A"     : 0b100,
+    "AM"    : 0b101,
+    "MA"    : 0b101,
+    "AD"    : 0b110,
+    "DA"    : 0b110,
+    "ADM"   : 0b111,
+    "AMD"   : 0b111,
+    "DMA"   : 0b111,
+    "DAM"   : 0b111,
+    "MAD"   : 0b111,
+    "MDA"   : 0b111,
+    ""      : 0b000
 }
 
 COMP_CODE = {
-    "0"   : "0101010",
-    "1"   : "0111111",
-    "-1"  : "0111010",
-    "D"   : "0001100",
-    "A"   : "0110000",
-    "!D"  : "0001101",
-    "!A"  : "0110011",
-    "D+1" : "0011111",
-    "1+D" : "0011111",
-    "A+1" : "0110111",
-    "1+A" : "0110111",
-    "D-1" : "0001110",
-    "A-1" : "0110010",
-    "D+A" : "0000010",
-    "A+D" : "0000010",
-    "D-A" : "0010011",
-    "A-D" : "0000111",
-    "D&A" : "0000000",
-    "A&D" : "0000000",
-    "D|A" : "0010101",
-    "A|D" : "0010101",
-    "M"   : "1110000",
-    "!M"  : "1110001",
-    "-M"  : "1110011",
-    "M+1" : "1110111",
-    "1+M" : "1110111",
-    "M-1" : "1110010",
-    "D+M" : "1000010",
-    "M+D" : "1000010",
-    "D-M" : "1010011",
-    "M-D" : "1000111",
-    "D&M" : "1000000",
-    "M&D" : "1000000",
-    "D|M" : "1010101",
-    "M|D" : "1010101"
+    "0"   : 0b0101010,
+    "1"   : 0b0111111,
+    "-1"  : 0b0111010,
+    "D"   : 0b0001100,
+    "A"   : 0b0110000,
+    "!D"  : 0b0001101,
+    "!A"  : 0b0110001,
+    "-D"  : 0b0001111,
+    "-A"  : 0b0110011,
+    "D+1" : 0b0011111,
+    "1+D" : 0b0011111,
+    "A+1" : 0b0110111,
+    "1+A" : 0b0110111,
+    "D-1" : 0b0001110,
+    "A-1" : 0b0110010,
+    "D+A" : 0b0000010,
+    "A+D" : 0b0000010,
+    "D-A" : 0b0010011,
+    "A-D" : 0b0000111,
+    "D&A" : 0b0000000,
+    "A&D" : 0b0000000,
+    "D|A" : 0b0010101,
+    "A|D" : 0b0010101,
+    "M"   : 0b1110000,
+    "!M"  : 0b1110001,
+    "-M"  : 0b1110011,
+    "M+1" : 0b1110111,
+    "1+M" : 0b1110111,
+    "M-1" : 0b1110010,
+    "D+M" : 0b1000010,
+    "M+D" : 0b1000010,
+    "D-M" : 0b1010011,
+    "M-D" : 0b1000111,
+    "D&M" : 0b1000000,
+    "M&D" : 0b1000000,
+    "D|M" : 0b1010101,
+    "M|D" : 0b1010101
 }
 
-def get_free_address(address_list):
-    """Get the smallest integer not in the list <address_list>"""
-    addresses = np.array(address_list)
-    addresses.sort()
-    first_gap = np.argmax( (addresses[1:] - addresses[:-1]) > 1)
-    addr = addresses[first_gap] + 1
-    return addr
-
-
-if __name__ == "__main__":
-
-    # Initializing the data structures
-    variables_address_table = dict(zip([f"R{i}" for i in range(16)], list(range(16))))
-    variables_address_table["SCREEN"] = 16384
-    variables_address_table["KBD"] = 24576
-    labels_table = {}
-
-    # Load the .asm file provided in the command line
-    if len(sys.argv) != 2:
-        print("Usage : python assembler.py <prog.asm>")
-        exit()
-
-    with open(sys.argv[1], "r") as infile:
-        lines = infile.readlines()
-
-    # We store our binary file as a list of strings
-    binary = []
-
-    # Remove the ending newline character
-    lines = [line.replace("\n","") for line in lines]
-
-    # Filter out empty lines and comment lines
-    lines = [
-        line for line in lines
-        if not re.match(r'^\s*(//|$)', line)
-    ]
-
-    # Step 2: Remove all tabs and whitespaces from remaining lines
-    lines = [re.sub(r'\s+', '', line) for line in lines]
-
-    # First iteration to get all the labels
-    n_labels = 0
-    for i,l in  enumerate(lines):
-        if l[0] == "(":
-            label_line_number = i - n_labels
-            labels_table[l[1:-1]] = label_line_number
-            n_labels += 1
-
-    # Iterating over the lines
-    for l in  lines:
-        if l[0] == "(":
-            # Label -> pass
-            pass
-
-        else :
-            # -> instruction
-            # Getting isf it starts with @
-            if l[0] == "@":
-                # A-instruction
-                address = l[1:]
-                try:
-                    # We try to convert it to int
-                    address_int = int(address)
-                except ValueError:
-                    # It is not an int -> it is a variable
-                    var_name = address
+PREDEFINED_SYMBOLS = {
+    **{f"R{i}" : i for i in range(16)},
+    "SP"     : 0,
+    "LCL"    : 1,
+    "ARG"    : 2,
+    "THIS"   : 3,
+    "THAT"   : 4,
+    "SCREEN" : 16384,
+    "KBD"    : 24576
+}
 
-                    if var_name in variables_address_table.keys():
-                        address_int = variables_address_table[var_name]
+# First RAM address available for the variables
+VARIABLES_BASE_ADDRESS = 16
+
+class SymbolTable:
+
+    def __init__(self):
+        """Initiate the table with the predefined symbols, the variables are then allocated from address 16 upward"""
+        self.table = dict(PREDEFINED_SYMBOLS)
+        self.next_address = VARIABLES_BASE_ADDRESS
+
+    def contains(self, symbol):
+        """Return boolean if the symbol is in the table"""
+        return symbol in self.table
+
+    def addEntry(self, symbol, address):
+        """Add the pair (symbol, address) to the table"""
+        self.table[symbol] = address
+
+    def getAddress(self, symbol):
+        """Return the address associated with the symbol"""
+        return self.table[symbol]
+
+    def addVariable(self, symbol):
+        """Allocate the next free RAM address to the variable <symbol> and return it (O(1), from a running counter)"""
+        address = self.next_address
+        self.table[symbol] = address
+        self.next_address += 1
+        return address
+
+
+def build_c_instruction_table():
+    """Precompute the binary code of every valid C-instruction, indexed by its text (dest=comp;jump without whitespaces)"""
+    table = {}
+    for dest, dest_code in DEST_CODE.items():
+        for comp, comp_code in COMP_CODE.items():
+            for jump, jump_code in JUMP_CODE.items():
+                text = (dest + "=" if dest else "") + comp + (";" + jump if jump else "")
+                table[text] = 0b111 << 13 | comp_code << 6 | dest_code << 3 | jump_code
+    return table
+
+# Shared by all the Assembler instances, built once at import
+C_INSTRUCTION_CODE = build_c_instruction_table()
+
+# Text representation of each byte, an instruction in a .hack file being the concatenation of its two bytes
+BYTE_BITS = [f"{i:08b}" for i in range(256)]
+
+# Largest constant of an A-instruction @value
+MAX_CONSTANT = 0x7FFF
+
+
+# Each match is one source line : an optional label / A-instruction / C-instruction, an optional trailing comment
+# and, in the <error> group, whatever could not be read
+TOKEN_PATTERN = re.compile(r"""
+    [^\S\n]*
+    (?:
+        \([^\S\n]*(?P<label>[^\s()/]+)[^\S\n]*\)
+      | @[^\S\n]*(?P<address>[^\s/]+)
+      | (?P<c_inst>[^\s/()@](?:[^\n/]*[^\s/])?)
+    )?
+    [^\S\n]*
+    (?://[^\n]*)?
+    (?P<error>[^\n]*)
+    (?:\n|\Z)
+""", re.VERBOSE)
+
+
+def parse_constant(value, line):
+    """Value of the numeric operand of an A-instruction, None if it is a symbol
+    The value must fit in the 15 bits of an A-instruction, the most significant bit telling a C-instruction"""
+    try:
+        constant = int(value)
+    except ValueError:
+        return None
+    if not 0 <= constant <= MAX_CONSTANT:
+        raise Exception(f"Line {line} : constant out of range (0-{MAX_CONSTANT}) : {value}")
+    return constant
+
+
+def tokenize(source, first_line=1):
+    """Scan a Hack assembly source (a single string) in one pass and yield its tokens as (kind, value, line number) tuples,
+    kind being among : LABEL, A_INSTRUCTION, C_INSTRUCTION. Comments and whitespaces are dropped"""
+    for line, (label, address, c_inst, error) in enumerate(TOKEN_PATTERN.findall(source), first_line):
+        if error:
+            raise Exception(f"Line {line} : syntax error : {error}")
+        if address:
+            yield ("A_INSTRUCTION", address, line)
+        elif c_inst:
+            # Whitespaces are allowed inside a C-instruction (eg D = M)
+            if " " in c_inst or "\t" in c_inst:
+                c_inst = "".join(c_inst.split())
+            yield ("C_INSTRUCTION", c_inst, line)
+        elif label:
+            yield ("LABEL", label, line)
+
+
+class Assembler:
+
+    def __init__(self):
+        """Initiate an assembler, it can be reused to assemble any number of programs"""
+        self.symbol_table = None
+        self.labels_table = None
+        # Source line of each instruction of the last program
+        self.instruction_lines = None
+
+    def assemble_lines(self, lines):
+        """Assemble an iterable of Hack assembly lines (eg an opened file) and return the 16-bit instructions as an array('H')"""
+        return self.assemble_source("\n".join(line.rstrip("\n") for line in lines))
+
+    def assemble_file(self, path):
+        """Assemble the .asm file <path> and return the 16-bit instructions as an array('H')"""
+        with open(path, "r") as infile:
+            return self.assemble_source(infile.read())
+
+    def assemble_source(self, source):
+        """Assemble a Hack assembly program given as a single string and return the 16-bit instructions as an array('H')"""
+
+        # Initializing the data structures
+        self.symbol_table = SymbolTable()
+        self.labels_table = {}
+        self.instruction_lines = array("I")
+
+        tokens = list(tokenize(source))
+
+        # First iteration to get all the labels
+        n_instructions = 0
+        for kind, value, _ in tokens:
+            if kind == "LABEL":
+                self.labels_table[value] = n_instructions
+            else:
+                n_instructions += 1
 
-                    elif var_name in labels_table.keys():
-                        address_int = labels_table[var_name]
+        # We store our binary program as a buffer of unsigned 16-bit integers
+        binary = array("H")
 
-                    else:
-                        address_int = get_free_address(list(variables_address_table.values()))
-                        variables_address_table[var_name] = address_int
+        # Iterating over the tokens
+        for kind, value, line in tokens:
+            if kind != "LABEL":
+                self.instruction_lines.append(line)
 
-                # Appending the instruction bin code
-                binary.append("0" + f"{address_int:015b}")  
+            if kind == "A_INSTRUCTION":
+                binary.append(self._getAddress(value, line))
 
-            else:
-                # C-instruction
+            elif kind == "C_INSTRUCTION":
                 # Among  dest=comp comp;jump dest=comp;jump
-                match = re.match(pattern_c_inst, l)
-                if match:
-                    dest = match.group("dest") or ""
-                    comp = match.group("comp") or ""
-                    jump = match.group("jump") or ""
-                    
-                    # Appending the instruction bin code
-                    binary.append("111" + COMP_CODE[comp] + DEST_CODE[dest] + JUMP_CODE[jump])  
-
-                else: 
-                    raise Exeption("C instruction not matched : " + l)
-
-    print(variables_address_table)
+                try:
+                    binary.append(C_INSTRUCTION_CODE[value])
+                except KeyError:
+                    raise Exception(f"Line {line} : C instruction not matched : {value}")
+
+        return binary
+
+    def _getAddress(self, address, line):
+        """Resolve the operand of an A-instruction at the line <line> : integer constant, variable or label"""
+        constant = parse_constant(address, line)
+        if constant is not None:
+            return constant
+        # It is not an int -> it is a variable
+        var_name = address
+
+        if self.symbol_table.contains(var_name):
+            return self.symbol_table.getAddress(var_name)
+
+        if var_name in self.labels_table:
+            return self.labels_table[var_name]
+
+        return self.symbol_table.addVariable(var_name)
+
+    def sourceMap(self, filename):
+        """SourceMap of the last program, <filename> being its assembly file : one entry per instruction,
+        giving its line in the assembly source"""
+        source_map = SourceMap()
+        for address, line in enumerate(self.instruction_lines):
+            source_map.addEntry(filename, line, None, line, address)
+        source_map.n_asm_lines = self.instruction_lines[-1] if self.instruction_lines else 0
+        source_map.n_instructions = len(self.instruction_lines)
+        return source_map
+
+
+# A label line starts a new section of the source
+SECTION_PATTERN = re.compile(r"^(?=[^\S\n]*\()", re.MULTILINE)
+
+
+def encode_section(tokens, first_line=1):
+    """Encode the tokens of a section (starting at the line <first_line>) independently of the rest of the program, return :
+    - the 16-bit instructions as an array('H'), the symbolic A-instructions being left to 0
+    - the symbolic references as a list of (offset, symbol)
+    - the labels as a list of (label, offset)
+    - the line of each instruction, relative to the first line of the section, as an array('I')"""
+    words = array("H")
+    references = []
+    labels = []
+    lines = array("I")
+    for kind, value, line in tokens:
+        if kind != "LABEL":
+            lines.append(line - first_line)
+
+        if kind == "A_INSTRUCTION":
+            constant = parse_constant(value, line)
+            if constant is None:
+                references.append((len(words), value))
+                constant = 0
+            words.append(constant)
+
+        elif kind == "C_INSTRUCTION":
+            try:
+                words.append(C_INSTRUCTION_CODE[value])
+            except KeyError:
+                raise Exception(f"Line {line} : C instruction not matched : {value}")
+
+        else:
+            labels.append((value, len(words)))
+    return words, references, labels, lines
+
+
+# Version of the encoded sections saved in the cache file : a cache of another version is ignored
+ASMCACHE_VERSION = 2
+
+
+class IncrementalAssembler(Assembler):
+
+    def __init__(self, cache_path=None):
+        """Assembler keeping the encoded sections (parts of the source starting at a label) of the last program :
+        on the next program only the sections whose text changed are encoded, the others being only linked
+        With <cache_path>, the encoded sections are loaded from and saved to this file, to be reused between runs"""
+        super().__init__()
+        self.sections = {}
+        self.cache_path = cache_path
+        self.encoded_sections = 0
+        if cache_path is not None and os.path.exists(cache_path):
+            with open(cache_path, "rb") as fd_in:
+                cached = pickle.load(fd_in)
+            if isinstance(cached, tuple) and cached[0] == ASMCACHE_VERSION:
+                self.sections = cached[1]
+
+    def assemble_source(self, source):
+        """Assemble a Hack assembly program given as a single string and return the 16-bit instructions as an array('H')"""
+        sections = {}
+        program = []
+        first_lines = []
+        first_line = 1
+        self.encoded_sections = 0
+
+        for text in SECTION_PATTERN.split(source):
+            section = sections.get(text) or self.sections.get(text)
+            if section is None:
+                section = encode_section(tokenize(text, first_line), first_line)
+                self.encoded_sections += 1
+            sections[text] = section
+            program.append(section)
+            first_lines.append(first_line)
+            first_line += text.count("\n")
+
+        # Only the sections of the last program are kept
+        changed = self.encoded_sections > 0 or len(sections) != len(self.sections)
+        self.sections = sections
+        if self.cache_path is not None and changed:
+            with open(self.cache_path, "wb") as fd_out:
+                pickle.dump((ASMCACHE_VERSION, sections), fd_out, protocol=pickle.HIGHEST_PROTOCOL)
+
+        return self._link(program, first_lines)
+
+    def _link(self, program, first_lines):
+        """Place the encoded sections (starting at the lines <first_lines>) one after the other and patch their symbolic references"""
+        self.symbol_table = SymbolTable()
+        self.labels_table = {}
+        self.instruction_lines = array("I")
+
+        # Address of the labels
+        starts = []
+        n_instructions = 0
+        for words, _, labels, _ in program:
+            starts.append(n_instructions)
+            for label, offset in labels:
+                self.labels_table[label] = n_instructions + offset
+            n_instructions += len(words)
+
+        binary = array("H")
+        for (words, _, _, lines), first_line in zip(program, first_lines):
+            binary += words
+            self.instruction_lines += array("I", [first_line + line for line in lines])
+
+        # Symbols : predefined symbol, label or variable allocated in order of first appearance
+        symbol_table = self.symbol_table
+        labels_table = self.labels_table
+        for start, (_, references, _, _) in zip(starts, program):
+            for offset, symbol in references:
+                if symbol_table.contains(symbol):
+                    address = symbol_table.getAddress(symbol)
+                elif symbol in labels_table:
+                    address = labels_table[symbol]
+                else:
+                    address = symbol_table.addVariable(symbol)
+                binary[start + offset] = address
+
+        return binary
+
+
+def write_hack(binary, filename):
+    """Save the assembled program in a .hack file (text file, one instruction per line)"""
+    with open(filename, "w") as f_out:
+        f_out.write("\n".join([BYTE_BITS[instruction >> 8] + BYTE_BITS[instruction & 0xFF] for instruction in binary]))
+
+
+def write_binhack(binary, filename):
+    """Save the assembled program in a .binhack file (binary file, big-endian 16-bit words)"""
+    binary_data = array("H", binary)
+    if sys.byteorder == "little":
+        binary_data.byteswap()
+
+    # Write the buffer as is to the file
+    with open(filename, "wb") as binary_file:
+        binary_data.tofile(binary_file)
 
-    # Save the produced file in a .hack file (text file)
-    with open(sys.argv[1].replace(".asm",".hack"), "w") as f_out:
-        for line in binary[:-1]:
-            f_out.write(line)
-            f_out.write("\n")
-        f_out.write(binary[-1])
 
-    # Save the produced file in a .binhack file (binary file)
-    # Convert the string to bytes
-    binary_string = "".join(binary)
-    binary_data = int(binary_string, 2).to_bytes((len(binary_string) + 7) // 8, byteorder="big")
+if __name__ == "__main__":
 
-    # Write the binary data to a file
-    with open(sys.argv[1].replace(".asm",".binhack"), "wb") as binary_file:
-        binary_file.write(binary_data)
+    # Load the .asm file provided in the command line
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("-")]
+    options = [arg for arg in sys.argv[1:] if arg.startswith("-")]
+    if len(args) != 1 or any(option not in ["--incremental", "--source-map"] for option in options):
+        print("Usage : python assembler.py <prog.asm> [--incremental] [--source-map]")
+        print("  --incremental : only encode the sections changed since the last run (cached in <prog>.asmcache)")
+        print("  --source-map : write the assembly line of each ROM address in <prog>.hack.map")
+        exit()
+    src_path = args[0]
 
+    if "--incremental" in options:
+        assembler = IncrementalAssembler(src_path.replace(".asm", ".asmcache"))
+    else:
+        assembler = Assembler()
+    binary = assembler.assemble_file(src_path)
 
-        
+    print(assembler.symbol_table.table)
 
+    write_hack(binary, src_path.replace(".asm",".hack"))
+    write_binhack(binary, src_path.replace(".asm",".binhack"))
 
+    if "--source-map" in options:
+        write_source_map(assembler.sourceMap(os.path.basename(src_path)), src_path.replace(".asm", ".hack.map"))
@@ -0,0 +1,156 @@
+#! /bin/python3
+# Disassembler of the Hack binary code (.hack / .binhack) to Hack assembly, the whole ROM being decoded at once with NumPy
+
+import sys, os
+import numpy as np
+
+from my_assembler import COMP_CODE, DEST_CODE, JUMP_CODE
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(REPO_DIR, "hack_emulator"))
+
+from HackCPU import map_binhack
+
+# Fields of a C-instruction 111a cccc ccdd djjj
+C_PREFIX_MASK = 0b111 << 13
+COMP_MASK = 0b1111111 << 6
+DEST_MASK = 0b111 << 3
+JUMP_MASK = 0b111
+
+
+def build_inverse_table(codes, size):
+    """Inverse of a code table of the assembler as an array of texts indexed by code (None for the invalid codes),
+    the first text of each code in the table being kept"""
+    table = np.full(size, None, dtype=object)
+    for text, code in codes.items():
+        if table[code] is None:
+            table[code] = text
+    return table
+
+
+COMP_TEXT = build_inverse_table(COMP_CODE, 128)
+DEST_TEXT = build_inverse_table(DEST_CODE, 8)
+JUMP_TEXT = build_inverse_table(JUMP_CODE, 8)
+
+
+def build_c_text_table():
+    """Text of every C-instruction indexed by its 13 low bits (a, comp, dest and jump fields), None if its comp is invalid"""
+    table = np.full(1 << 13, None, dtype=object)
+    for comp_code, comp in enumerate(COMP_TEXT):
+        if comp is None:
+            continue
+        for dest_code, dest in enumerate(DEST_TEXT):
+            for jump_code, jump in enumerate(JUMP_TEXT):
+                table[comp_code << 6 | dest_code << 3 | jump_code] = (dest + "=" if dest else "") + comp + (";" + jump if jump else "")
+    return table
+
+
+# Built once at import, like C_INSTRUCTION_CODE in the assembler
+C_TEXT = build_c_text_table()
+A_TEXT = np.array([f"@{value}" for value in range(1 << 15)], dtype=object)
+
+
+def load_hack_array(path):
+    """Read a .hack file (text, one 16-bit instruction per line) as a NumPy array of uint16, without a loop over the lines"""
+    with open(path, "rb") as fd_in:
+        data = fd_in.read().replace(b"\r", b"").strip()
+    if not data:
+        return np.zeros(0, dtype=np.uint16)
+    chars = np.frombuffer(data + b"\n", dtype=np.uint8)
+    if chars.size % 17:
+        raise Exception(f"{path} : lines of 16 bits expected")
+    chars = chars.reshape(-1, 17)
+    bits = chars[:, :16] - ord("0")
+    if (bits > 1).any() or (chars[:, 16] != ord("\n")).any():
+        raise Exception(f"{path} : lines of 16 bits expected")
+    return (bits.astype(np.uint16) << np.arange(15, -1, -1, dtype=np.uint16)).sum(axis=1, dtype=np.uint16)
+
+
+def load_words(path):
+    """Read a .hack or a .binhack file as a NumPy array of the instructions"""
+    if path.endswith(".binhack"):
+        return map_binhack(path).astype(np.uint16)
+    return load_hack_array(path)
+
+
+def jump_targets(words):
+    """Addresses (sorted, unique) loaded in A right before a jump instruction, and the indices of these A-instructions"""
+    is_a = words & 0x8000 == 0
+    is_jump = ~is_a & (words & JUMP_MASK != 0)
+    # A-instructions followed by a jump
+    loads = np.flatnonzero(is_a[:-1] & is_jump[1:])
+    return np.unique(words[loads]), loads
+
+
+def disassemble(words, labels=None, relabel=True):
+    """Disassemble an array of 16-bit instructions into a list of assembly lines
+    With <relabel>, the jump targets get a label (named from <labels> : {address : label} if given, else LABEL_<address>)
+    and the A-instructions loading them before a jump use it. Invalid instructions are written as comments"""
+    words = np.asarray(words, dtype=np.uint16)
+    is_a = words & 0x8000 == 0
+    is_c = ~is_a & (words & C_PREFIX_MASK == C_PREFIX_MASK)
+
+    lines = np.empty(words.size, dtype=object)
+    lines[is_a] = A_TEXT[words[is_a]]
+    lines[is_c] = C_TEXT[words[is_c] & 0x1FFF]
+    invalid = np.flatnonzero(~is_a & ~is_c | (lines == None))
+    for i in invalid:
+        lines[i] = f"// invalid instruction {int(words[i]):016b}"
+
+    if relabel and words.size:
+        targets, loads = jump_targets(words)
+        targets = targets[targets < words.size]
+        labels = labels or {}
+        names = np.array([labels.get(int(t), f"LABEL_{t}") for t in targets], dtype=object)
+        # A-instructions before a jump : the label of their target, when it is in the program
+        loaded = words[loads]
+        in_program = loaded < words.size
+        lines[loads[in_program]] = "@" + names[np.searchsorted(targets, loaded[in_program])]
+        lines = np.insert(lines, targets.astype(np.intp), "(" + names + ")")
+
+    return lines.tolist()
+
+
+def instruction_stats(words):
+    """Static statistics of a program : counts of A/C-instructions, of the jumps by condition, of the jump targets
+    and of the computations (instruction mix)"""
+    words = np.asarray(words, dtype=np.uint16)
+    is_a = words & 0x8000 == 0
+    c_words = words[~is_a]
+    jumps = np.bincount(c_words & JUMP_MASK, minlength=8)
+    comps = np.bincount((c_words & COMP_MASK) >> 6, minlength=128)
+    dests = np.bincount((c_words & DEST_MASK) >> 3, minlength=8)
+    targets, _ = jump_targets(words)
+    return {
+        "instructions" : int(words.size),
+        "A" : int(is_a.sum()),
+        "C" : int(c_words.size),
+        "jumps" : int(jumps[1:].sum()),
+        "jumps by condition" : {JUMP_TEXT[code] : int(jumps[code]) for code in range(1, 8) if jumps[code]},
+        "jump targets" : int(targets.size),
+        "writes to" : {DEST_TEXT[code] : int(dests[code]) for code in range(1, 8) if dests[code]},
+        "computations" : {COMP_TEXT[code] or f"{code:07b}" : int(comps[code]) for code in np.argsort(-comps, kind="stable") if comps[code]}
+    }
+
+
+if __name__ == "__main__":
+
+    # Disassemble the .hack/.binhack file provided in the command line into <prog>.dis.asm
+    if len(sys.argv) not in [2, 3] or (len(sys.argv) == 3 and sys.argv[2] != "--stats"):
+        print("Usage : python my_disassembler.py <prog.hack | prog.binhack> [--stats]")
+        exit()
+
+    words = load_words(sys.argv[1])
+    lines = disassemble(words)
+
+    fileout = os.path.splitext(sys.argv[1])[0] + ".dis.asm"
+    with open(fileout, "w") as fd_out:
+        fd_out.write("\n".join(lines))
+    print(f"{words.size} instructions disassembled in {fileout}")
+
+    if len(sys.argv) == 3:
+        stats = instruction_stats(words)
+        print(f"A-instructions : {stats['A']} ({stats['A']/max(stats['instructions'], 1):.1%}) | C-instructions : {stats['C']}")
+        print(f"Jumps : {stats['jumps']} {stats['jumps by condition']} to {stats['jump targets']} targets")
+        print(f"Writes to : {stats['writes to']}")
+        print(f"Computations : {dict(list(stats['computations'].items())[:10])}")
@@ -0,0 +1,17 @@
+// Tests CompareTest.vm on the VM emulator : gt and lt on operands whose difference overflows 16 bits.
+
+load CompareTest.vm,
+compare-to CompareTest.cmp,
+
+set RAM[0] 256,  // initializes the stack pointer
+
+repeat 47 {      // CompareTest.vm has 47 VM commands
+  vmstep;
+}
+
+// Outputs the stack pointer and the stack contents: RAM[256]-RAM[266]
+output-list RAM[0]%D2.6.2
+        RAM[256]%D2.6.2 RAM[257]%D2.6.2 RAM[258]%D2.6.2 RAM[259]%D2.6.2 RAM[260]%D2.6.2 RAM[261]%D2.6.2;
+output;
+output-list RAM[262]%D2.6.2 RAM[263]%D2.6.2 RAM[264]%D2.6.2 RAM[265]%D2.6.2 RAM[266]%D2.6.2;
+output;
@@ -0,0 +1,289 @@
+#! /bin/python3
+# Interpreter of the VM language : executes .vm programs directly on the RAM, without translation to assembly
+
+import sys, os
+import time
+import numpy as np
+
+from VMTranslator import Parser, list_vm_files
+
+RAM_SIZE = 32768
+
+# Opcodes of the decoded commands
+OP_PUSH_CONSTANT = 0
+OP_PUSH_SEGMENT = 1   # local, argument, this, that : operand = address of the base pointer, index
+OP_PUSH_ADDRESS = 2   # temp, pointer, static : operand = RAM address
+OP_POP_SEGMENT = 3
+OP_POP_ADDRESS = 4
+OP_ADD = 5
+OP_SUB = 6
+OP_NEG = 7
+OP_EQ = 8
+OP_GT = 9
+OP_LT = 10
+OP_AND = 11
+OP_OR = 12
+OP_NOT = 13
+OP_GOTO = 14          # operand = index of the target command
+OP_IF_GOTO = 15
+OP_FUNCTION = 16      # operand = number of local variables
+OP_CALL = 17          # operand = index of the called function, number of arguments
+OP_RETURN = 18
+
+ARITHMETIC_OPCODE = {
+    "add" : OP_ADD,
+    "sub" : OP_SUB,
+    "neg" : OP_NEG,
+    "eq" : OP_EQ,
+    "gt" : OP_GT,
+    "lt" : OP_LT,
+    "and" : OP_AND,
+    "or" : OP_OR,
+    "not" : OP_NOT
+}
+
+# RAM address of the base pointer of the pointed segments
+SEGMENT_POINTER = {
+    "local" : 1,
+    "argument" : 2,
+    "this" : 3,
+    "that" : 4
+}
+
+# Base address of the fixed segments
+SEGMENT_BASE = {
+    "pointer" : 3,
+    "temp" : 5
+}
+
+STATIC_BASE_ADDRESS = 16
+
+
+class VMInterpreter:
+
+    def __init__(self, program=None):
+        """Initiate the VM with an empty RAM, <program> being a .vm file or a directory of .vm files"""
+        self.RAM = np.zeros(RAM_SIZE, dtype=np.int16)
+        self.commands = []
+        self.functions = {}
+        self.static_addresses = {}
+        self.pc = 0
+        self.steps = 0
+        if program is not None:
+            self.load(program)
+
+    def load(self, program):
+        """Parse the VM files of the program and decode its commands into (opcode, operand 1, operand 2) tuples,
+        the labels, functions and static variables being resolved"""
+        commands = [] # (opcode, operand 1, operand 2), symbolic operands being resolved at the end
+        labels = {}
+        self.functions = {}
+        self.static_addresses = {}
+
+        for path in list_vm_files(program):
+            filename = os.path.basename(path)[:-3]
+            parser = Parser(path)
+            current_function = None
+            while True:
+                parser.commandType()
+                command_type = parser.current_type
+
+                if command_type == "C_ARITHMETIC":
+                    if parser.arg1() not in ARITHMETIC_OPCODE:
+                        raise Exception(f"{path}:{parser.lineNumber()} : unknown command {parser.arg1()}")
+                    commands.append((ARITHMETIC_OPCODE[parser.arg1()], 0, 0))
+
+                elif command_type in ["C_PUSH", "C_POP"]:
+                    commands.append(self._decodePushPop(command_type, parser.arg1(), int(parser.arg2()), filename))
+
+                elif command_type == "C_LABEL":
+                    # Labels are not commands, they point to the next command. They are scoped by file and function,
+                    # as in the translator (see CodeWriter._getFullLabel)
+                    labels[(filename, current_function, parser.arg1())] = len(commands)
+
+                elif command_type == "C_GOTO":
+                    commands.append((OP_GOTO, (filename, current_function, parser.arg1()), 0))
+
+                elif command_type == "C_IF":
+                    commands.append((OP_IF_GOTO, (filename, current_function, parser.arg1()), 0))
+
+                elif command_type == "C_FUNCTION":
+                    current_function = parser.arg1()
+                    self.functions[current_function] = len(commands)
+                    commands.append((OP_FUNCTION, int(parser.arg2()), 0))
+
+                elif command_type == "C_CALL":
+                    commands.append((OP_CALL, parser.arg1(), int(parser.arg2())))
+
+                elif command_type == "C_RETURN":
+                    commands.append((OP_RETURN, 0, 0))
+
+                if parser.hasMoreLines():
+                    parser.advance()
+                else:
+                    break
+
+        # Resolve the jump targets and the called functions
+        for i, (opcode, operand1, operand2) in enumerate(commands):
+            if opcode in [OP_GOTO, OP_IF_GOTO]:
+                if operand1 not in labels:
+                    raise Exception(f"Unknown label : {operand1[2]}")
+                commands[i] = (opcode, labels[operand1], 0)
+            elif opcode == OP_CALL:
+                if operand1 not in self.functions:
+                    raise Exception(f"Unknown function : {operand1}")
+                commands[i] = (opcode, self.functions[operand1], operand2)
+
+        self.commands = commands
+        self.reset()
+
+    def _decodePushPop(self, command_type, segment, index, filename):
+        """Decode a push/pop command, resolving the address of the fixed segments"""
+        push = command_type == "C_PUSH"
+        if segment == "constant":
+            if not push:
+                raise Exception("Can't pop to the constant segment")
+            return (OP_PUSH_CONSTANT, index & 0xFFFF, 0)
+        if segment in SEGMENT_POINTER:
+            return (OP_PUSH_SEGMENT if push else OP_POP_SEGMENT, SEGMENT_POINTER[segment], index)
+        if segment in SEGMENT_BASE:
+            address = SEGMENT_BASE[segment] + index
+        elif segment == "static":
+            # Static variables are allocated from address 16, in order of first appearance, like the assembler does
+            key = (filename, index)
+            if key not in self.static_addresses:
+                self.static_addresses[key] = STATIC_BASE_ADDRESS + len(self.static_addresses)
+            address = self.static_addresses[key]
+        else:
+            raise Exception(f"Unknown segment : {segment}")
+        return (OP_PUSH_ADDRESS if push else OP_POP_ADDRESS, address, 0)
+
+    def reset(self):
+        """Start over at Sys.init if the program has one, else at its first command (the RAM is left as is)"""
+        self.pc = self.functions.get("Sys.init", 0)
+        self.steps = 0
+
+    def step(self):
+        """Execute a single VM command"""
+        return self.run(1)
+
+    def run(self, max_steps):
+        """Execute up to <max_steps> VM commands (stopping at the end of the program) and return the number of executed commands"""
+        ram_view = self.RAM.view(np.uint16)
+        ram = ram_view.tolist()
+        try:
+            self.pc, executed = self._execute(ram, self.pc, max_steps)
+        finally:
+            ram_view[:] = ram
+        self.steps += executed
+        return executed
+
+    def _execute(self, ram, pc, max_steps):
+        """Interpreter loop on the RAM as a list of unsigned 16-bit integers, return the final pc and the number of executed commands"""
+        commands = self.commands
+        n_commands = len(commands)
+        executed = 0
+
+        while executed < max_steps and pc < n_commands:
+            opcode, x, y = commands[pc]
+            executed += 1
+            pc += 1
+
+            if opcode == OP_PUSH_CONSTANT:
+                sp = ram[0]
+                ram[sp] = x
+                ram[0] = sp + 1
+            elif opcode == OP_PUSH_SEGMENT:
+                sp = ram[0]
+                ram[sp] = ram[(ram[x] + y) & 0xFFFF]
+                ram[0] = sp + 1
+            elif opcode == OP_PUSH_ADDRESS:
+                sp = ram[0]
+                ram[sp] = ram[x]
+                ram[0] = sp + 1
+            elif opcode == OP_POP_SEGMENT:
+                sp = ram[0] - 1
+                ram[(ram[x] + y) & 0xFFFF] = ram[sp]
+                ram[0] = sp
+            elif opcode == OP_POP_ADDRESS:
+                sp = ram[0] - 1
+                ram[x] = ram[sp]
+                ram[0] = sp
+            elif opcode <= OP_NOT:
+                sp = ram[0]
+                top = ram[sp - 1]
+                if opcode == OP_NEG:
+                    ram[sp - 1] = -top & 0xFFFF
+                elif opcode == OP_NOT:
+                    ram[sp - 1] = top ^ 0xFFFF
+                else:
+                    below = ram[sp - 2]
+                    if opcode == OP_ADD:
+                        result = (below + top) & 0xFFFF
+                    elif opcode == OP_SUB:
+                        result = (below - top) & 0xFFFF
+                    elif opcode == OP_AND:
+                        result = below & top
+                    elif opcode == OP_OR:
+                        result = below | top
+                    else:
+                        # Comparisons are done on the signed values
+                        below -= (below & 0x8000) << 1
+                        top -= (top & 0x8000) << 1
+                        if opcode == OP_EQ:
+                            result = 0xFFFF if below == top else 0
+                        elif opcode == OP_GT:
+                            result = 0xFFFF if below > top else 0
+                        else:
+                            result = 0xFFFF if below < top else 0
+                    ram[sp - 2] = result
+                    ram[0] = sp - 1
+            elif opcode == OP_GOTO:
+                pc = x
+            elif opcode == OP_IF_GOTO:
+                sp = ram[0] - 1
+                ram[0] = sp
+                if ram[sp]:
+                    pc = x
+            elif opcode == OP_FUNCTION:
+                sp = ram[0]
+                ram[sp:sp + x] = [0] * x
+                ram[0] = sp + x
+            elif opcode == OP_CALL:
+                # Push the return address and the frame of the caller, then jump to the function
+                sp = ram[0]
+                ram[sp:sp + 5] = [pc, ram[1], ram[2], ram[3], ram[4]]
+                ram[2] = sp - y
+                ram[1] = sp + 5
+                ram[0] = sp + 5
+                pc = x
+            elif opcode == OP_RETURN:
+                frame = ram[1]
+                return_address = ram[frame - 5]
+                arg = ram[2]
+                ram[arg] = ram[ram[0] - 1]
+                ram[0] = arg + 1
+                ram[4], ram[3], ram[2], ram[1] = ram[frame - 1], ram[frame - 2], ram[frame - 3], ram[frame - 4]
+                pc = return_address
+
+        return pc, executed
+
+
+if __name__ == "__main__":
+
+    # Run a VM program for a given number of steps, the stack pointer being initialized to 256
+    if len(sys.argv) not in [2, 3]:
+        print(f"Usage : {sys.argv[0]} <prog.vm | progDirectory> [n_steps]")
+        exit()
+
+    n_steps = int(sys.argv[2]) if len(sys.argv) == 3 else 1_000_000
+
+    vm = VMInterpreter(sys.argv[1])
+    vm.RAM[0] = 256
+    t0 = time.perf_counter()
+    executed = vm.run(n_steps)
+    elapsed = time.perf_counter() - t0
+
+    print(f"{executed} VM commands in {elapsed:.3f} s")
+    print(f"RAM[0:16] = {vm.RAM[:16].tolist()}")
+    print(f"Stack = {vm.RAM[256:vm.RAM[0]].tolist()}")
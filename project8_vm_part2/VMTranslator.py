@@ -3,56 +3,113 @@
 
 import sys, os
 import re 
+import hashlib
 import numpy as np 
+from concurrent.futures import ProcessPoolExecutor
 
-class Parser:
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(REPO_DIR, "hack_emulator"))
 
-    def __init__(self, file):
-        """Initiate the parser on a VM script file"""
+from SourceMap import SourceMap, write_source_map
 
-        # Reading it as a list of lines
-        with open(file, "r") as fd_in:
-            lines = fd_in.readlines()
+# Command type of each VM keyword, anything else being an arithmetic/logical command
+COMMAND_TYPE = {
+    "push" : "C_PUSH",
+    "pop" : "C_POP",
+    "label" : "C_LABEL",
+    "goto" : "C_GOTO",
+    "if-goto" : "C_IF",
+    "function" : "C_FUNCTION",
+    "call" : "C_CALL",
+    "return" : "C_RETURN"
+}
 
-        # Remove the ending newline character
-        lines = [line.replace("\n","") for line in lines]
+# Each match is one source line : an optional command of up to 3 words, an optional trailing comment
+# and, in the <error> group, whatever could not be read
+TOKEN_PATTERN = re.compile(r"""
+    [^\S\n]*
+    (?:
+        (?P<command>[^\s/]+)
+        (?:[^\S\n]+(?P<arg1>[^\s/]+))?
+        (?:[^\S\n]+(?P<arg2>[^\s/]+))?
+    )?
+    [^\S\n]*
+    (?://[^\n]*)?
+    (?P<error>[^\n]*)
+    (?:\n|\Z)
+""", re.VERBOSE)
 
-        # Filter out empty lines and comment lines
-        lines = [
-            line for line in lines
-            if not re.match(r'^\s*(//|$)', line)
-        ]
 
-        # We split on spaces 
-        lines_splitted = [re.split(r'\s+', line.strip()) for line in lines]
+def tokenize(source, first_line=1):
+    """Scan a VM source (a single string) in one pass and yield its tokens as (command type, words of the command, line number)
+    tuples. Comments and whitespaces are dropped"""
+    for line, (command, arg1, arg2, error) in enumerate(TOKEN_PATTERN.findall(source), first_line):
+        if error:
+            raise Exception(f"Line {line} : syntax error : {error}")
+        if command:
+            words = [command, arg1, arg2] if arg2 else [command, arg1] if arg1 else [command]
+            yield (COMMAND_TYPE.get(command, "C_ARITHMETIC"), words, line)
+
+
+# Size (in characters) of the chunks in which the VM files are read
+READ_CHUNK_SIZE = 1 << 20
+
+
+def read_chunks(fd_in, size=READ_CHUNK_SIZE):
+    """Read a text file by chunks of about <size> characters, each chunk ending at the end of a line"""
+    rest = ""
+    while True:
+        chunk = fd_in.read(size)
+        if not chunk:
+            if rest:
+                yield rest
+            return
+        chunk = rest + chunk
+        end = chunk.rfind("\n") + 1
+        rest = chunk[end:]
+        if end:
+            yield chunk[:end]
+
 
-        self.lines = lines_splitted # Declare it as an object
-        self.current_i = 0 # Pointer to the current instruction
-        self.current = self.lines[0] # Current instruction
+def stream_tokens(path):
+    """Yield the tokens of a VM file (see tokenize), the file being read by chunks and never held in memory as a whole"""
+    with open(path, "r") as fd_in:
+        first_line = 1
+        for chunk in read_chunks(fd_in):
+            yield from tokenize(chunk, first_line)
+            first_line += chunk.count("\n")
+
+
+class Parser:
+
+    def __init__(self, file):
+        """Initiate the parser on a VM script file, its commands being read on demand from stream_tokens"""
+        self.tokens = stream_tokens(file)
+        self.next_token = next(self.tokens, None) # Read ahead, to know if there are more lines
+        self.current_token = None
+        self.current = None # Current instruction
         self.current_type = ""
+        self.advance()
 
     def hasMoreLines(self):
         """Return boolean if there is more lines to go through"""
-        return self.current_i < len(self.lines) - 1
+        return self.next_token is not None
 
     def advance(self):
         """Read the next instruction and make it the current instruction"""
-        self.current_i += 1
-        self.current = self.lines[self.current_i]
+        self.current_token = self.next_token
+        self.next_token = next(self.tokens, None)
+        if self.current_token is not None:
+            self.current = self.current_token[1]
         return
 
     def commandType(self):
         """Read the current VM instruction and return its type, among : C_ARITHMETIC, C_PUSH, C-POP, C_LABEL, C_GOTO, C_IF, C_FUNCTION, C_RETURN, C_CALL"""
-        match self.current[0]:
-            case "push" : self.current_type = "C_PUSH"
-            case "pop" : self.current_type = "C_POP"
-            case "label" : self.current_type = "C_LABEL"
-            case "goto" : self.current_type = "C_GOTO"
-            case "if-goto" : self.current_type = "C_IF"
-            case "function" : self.current_type = "C_FUNCTION"
-            case "call" : self.current_type = "C_CALL"
-            case "return" : self.current_type = "C_RETURN"
-            case _: self.current_type = "C_ARITHMETIC"
+        self.current_type = self.current_token[0]
+
+    def lineNumber(self):
+        """Return the line number of the current command in the VM file"""
+        return self.current_token[2]
 
     def arg1(self):
         """Return the first argument of the current command (note, for C_ARITHMETIC returns the command itself as a string)"""
@@ -66,21 +123,439 @@ class Parser:
             return self.current[2]
         return
 
+# Push template ending with the store of the pushed value : value in D, or 0/1 computed by the ALU
+PUSH_STORE = {
+    "M=D" : (),
+    "M=0" : ("D=0",),
+    "M=1" : ("D=1",)
+}
+
+# Peephole rules : (pattern, replacement) on consecutive assembly commands
+PEEPHOLE_RULES = [
+    # Increment immediately followed by a decrement of the same register
+    (("M=M+1", "M=M-1"), ()),
+    (("M=M-1", "M=M+1"), ())
+] + [
+    rule
+    for store, load in PUSH_STORE.items()
+    for rule in [
+        # Pushed value popped straight back into D (pop to a segment) : the store and SP moves are dead
+        (("@SP", "AM=M+1", "A=A-1", store, "@SP", "AM=M-1", "D=M"), load),
+        # Pushed value popped into D by a binary operation (add, sub, eq, and...) which then reads the new top of the stack
+        (("@SP", "AM=M+1", "A=A-1", store, "@SP", "M=M-1", "A=M", "D=M"), load),
+        # Pushed value modified in place by a unary operation (neg, not) : A already points to the top of the stack
+        (("@SP", "AM=M+1", "A=A-1", store, "@SP", "A=M-1"), ("@SP", "AM=M+1", "A=A-1", store))
+    ]
+]
+
+# Number of commands looked back to find if an A-instruction is a reload of the current value of A
+PEEPHOLE_WINDOW = 8
+
+# Number of optimized commands held back when streaming, as the rewrites of the tail can reach them
+PEEPHOLE_KEEP = 256
+
+# Number of assembly commands buffered by the CodeWriter before being written to the output file
+WRITE_BUFFER_SIZE = 1 << 14
+
+
+# Rules indexed by the last command of their pattern, so that an appended command is only matched against its rules
+PEEPHOLE_RULES_BY_LAST = {}
+for _pattern, _replacement in PEEPHOLE_RULES:
+    PEEPHOLE_RULES_BY_LAST.setdefault(_pattern[-1], []).append((list(_pattern), list(_replacement), len(_pattern)))
+
+
+def _writesA(command):
+    """Return boolean if an assembly command (neither a label nor an A-instruction) assigns A"""
+    equal = command.find("=")
+    return equal > 0 and "A" in command[:equal]
+
+
+def _loadedAddress(asm_commands):
+    """A-instruction holding the value of A at the end of asm_commands and the number of commands after it, (None, 0)
+    when A is not known (assigned by a computation, or a label within the last PEEPHOLE_WINDOW commands)"""
+    for since, command in enumerate(reversed(asm_commands[-PEEPHOLE_WINDOW:])):
+        if command[0] == "(":
+            # A label can be reached from anywhere
+            return None, 0
+        if command[0] == "@":
+            return command, since
+        if _writesA(command):
+            return None, 0
+    return None, 0
+
+
+class PeepholeOptimizer:
+
+    def __init__(self):
+        """Peephole optimizer fed one assembly command at a time : the redundant reloads of A are dropped and a push fused
+        with the pop or the operation that consumes it"""
+        self.optimized = []
+        # A-instruction whose value A holds (None if unknown) and number of commands appended since
+        self.a_command = None
+        self.a_since = 0
+        # Whether each C-instruction met so far assigns A
+        self.writes_a = {}
+
+    def feed(self, command):
+        """Append a command to the optimized commands, and rewrite their tail as long as a rule matches"""
+        optimized = self.optimized
+        first = command[0]
+        if first == "@":
+            # A reload is redundant if A holds the address since at most PEEPHOLE_WINDOW commands
+            if command == self.a_command and self.a_since < PEEPHOLE_WINDOW:
+                return
+            self.a_command, self.a_since = command, 0
+        elif first == "(":
+            self.a_command = None
+        else:
+            writes_a = self.writes_a.get(command)
+            if writes_a is None:
+                writes_a = self.writes_a[command] = _writesA(command)
+            if writes_a:
+                self.a_command = None
+            self.a_since += 1
+        optimized.append(command)
+
+        rules = PEEPHOLE_RULES_BY_LAST.get(command)
+        while rules:
+            for pattern, replacement, n in rules:
+                if optimized[-n:] == pattern:
+                    optimized[-n:] = replacement
+                    break
+            else:
+                break
+            # The tail changed : the value of A is found again, and the new last command can end another pattern
+            self.a_command, self.a_since = _loadedAddress(optimized)
+            rules = PEEPHOLE_RULES_BY_LAST.get(optimized[-1]) if optimized else None
+
+    def flush(self, keep=0):
+        """Remove and return the optimized commands, except the last <keep> ones that later rewrites can still modify"""
+        commands = self.optimized
+        n = len(commands) - keep
+        if n <= 0:
+            return []
+        # The returned list is the former buffer, only the kept tail being copied
+        self.optimized = commands[n:]
+        del commands[n:]
+        return commands
+
+
+def peephole(asm_commands):
+    """Optimize a list of assembly commands (see PeepholeOptimizer) and return the new list of commands"""
+    optimizer = PeepholeOptimizer()
+    for command in asm_commands:
+        optimizer.feed(command)
+    return optimizer.optimized
+
+
+def command_addresses(asm_commands):
+    """ROM address of each assembly command, a label getting the address of the next instruction"""
+    is_instruction = np.fromiter((command[0] != "(" for command in asm_commands), dtype=np.int64, count=len(asm_commands))
+    return np.cumsum(is_instruction) - is_instruction
+
+
+def count_instructions(asm_commands):
+    """Number of instructions (ie without the labels) of a list of assembly commands"""
+    return len(asm_commands) - [command[0] for command in asm_commands].count("(")
+
+
+# Return from a function : frame (R13) <- LCL ; return address (R14) <- frame[-5] ; *ARG <- pop ; SP <- ARG+1 ;
+# THAT, THIS, ARG, LCL restored from the frame ; jump to the return address
+RETURN_CODE = [
+    "@LCL",
+    "D=M",
+    "@R13",
+    "M=D",
+    "@5",
+    "A=D-A",
+    "D=M",
+    "@R14",
+    "M=D",
+    "@SP",
+    "AM=M-1",
+    "D=M",
+    "@ARG",
+    "A=M",
+    "M=D",
+    "@ARG",
+    "D=M+1",
+    "@SP",
+    "M=D"
+] + [
+    command
+    for pointer in ["THAT", "THIS", "ARG", "LCL"]
+    for command in ["@R13", "AM=M-1", "D=M", f"@{pointer}", "M=D"]
+] + [
+    "@R14",
+    "A=M",
+    "0;JMP"
+]
+
+
+# Table of the RAM block base address :
+BASE_ADDRESS_POINTER = {
+    "local" : "LCL",
+    "argument" : "ARG",
+    "this" : "THIS",
+    "that" : "THAT"
+}
+
+# Address of the fixed segments : temp is the RAM block 5-12, pointer 0/1 are THIS/THAT
+FIXED_ADDRESS = {
+    "temp" : lambda index: str(5 + int(index)),
+    "pointer" : lambda index: {'0' : "THIS", '1' : "THAT"}[index]
+}
+
+# Push of the value of D : RAM[SP] <- D ; SP++
+PUSH_D = [
+    "@SP",
+    "AM=M+1",
+    "A=A-1",
+    "M=D"
+]
+
+# Pop into D : SP-- ; D <- RAM[SP]
+POP_D = [
+    "@SP",
+    "AM=M-1",
+    "D=M"
+]
+
+# Largest index of a pop to local/argument/this/that whose address is computed by increments of A (index + 5 instructions),
+# the larger ones going through R13 (11 instructions)
+POP_INCREMENT_MAX_INDEX = 5
+
+
+def compare_code(label):
+    """Assembly code of gt/lt computing in D a value of the sign of x - y, y being in D and in R13 and x at RAM[SP-1] :
+    x - y when x and y have the same sign, else x (x < 0 <= y) or 1 (y < 0 <= x), as D=M-D would overflow
+    The labels of the code are label.format(name)"""
+    return [
+        f"@{label.format('Y_NEG')}",
+        "D;JLT",
+        "@SP",
+        "A=M-1",
+        "D=M",
+        f"@{label.format('SIGN')}",
+        "D;JLT",
+        f"@{label.format('SUB')}",
+        "0;JMP",
+        f"({label.format('Y_NEG')})",
+        "@SP",
+        "A=M-1",
+        "D=M",
+        f"@{label.format('SUB')}",
+        "D;JLT",
+        "D=1",
+        f"@{label.format('SIGN')}",
+        "0;JMP",
+        f"({label.format('SUB')})",
+        "@R13",
+        "D=M",
+        "@SP",
+        "A=M-1",
+        "D=M-D",
+        f"({label.format('SIGN')})"
+    ]
+
+
+# Labels of the routines written once by the shared mode, the use sites jumping to them with the return address in D
+SHARED_ROUTINE = {
+    "eq" : "VM$EQ",
+    "gt" : "VM$GT",
+    "lt" : "VM$LT",
+    "call" : "VM$CALL",
+    "return" : "VM$RETURN"
+}
+
+
+def shared_routines():
+    """Assembly code of the shared comparison, call and return routines"""
+    asm_code = []
+
+    # Comparisons : D = return address, the result replaces the two values on top of the stack
+    # (gt and lt through compare_code, as D=M-D would overflow)
+    for command, jump in [("eq", "JEQ"), ("gt", "JGT"), ("lt", "JLT")]:
+        asm_code += [
+            f"({SHARED_ROUTINE[command]})",
+            "@R15",
+            "M=D",
+            "@SP",
+            "AM=M-1",
+            "D=M"
+        ]
+        if command == "eq":
+            asm_code += [
+                "A=A-1",
+                "D=M-D"
+            ]
+        else:
+            asm_code += [
+                "@R13",
+                "M=D"
+            ] + compare_code(f"{SHARED_ROUTINE[command]}_{{}}")
+        asm_code += [
+            "@SP",
+            "A=M-1",
+            "M=-1",
+            "@VM$COMPARE_END",
+            f"D;{jump}",
+            "@SP",
+            "A=M-1",
+            "M=0",
+            "@VM$COMPARE_END",
+            "0;JMP"
+        ]
+    asm_code += [
+        "(VM$COMPARE_END)",
+        "@R15",
+        "A=M",
+        "0;JMP"
+    ]
+
+    # Call : D = return address, R13 = number of arguments, R14 = address of the called function
+    asm_code += [
+        f"({SHARED_ROUTINE['call']})",
+        "@SP",
+        "AM=M+1",
+        "A=A-1",
+        "M=D"
+    ]
+    for pointer in ["LCL", "ARG", "THIS", "THAT"]:
+        asm_code += [
+            f"@{pointer}",
+            "D=M",
+            "@SP",
+            "AM=M+1",
+            "A=A-1",
+            "M=D"
+        ]
+    asm_code += [
+        # ARG <- SP - 5 - number of arguments ; LCL <- SP
+        "@R13",
+        "D=M",
+        "@5",
+        "D=D+A",
+        "@SP",
+        "D=M-D",
+        "@ARG",
+        "M=D",
+        "@SP",
+        "D=M",
+        "@LCL",
+        "M=D",
+        "@R14",
+        "A=M",
+        "0;JMP"
+    ]
+
+    # Return : the same code as the inline one
+    asm_code += [f"({SHARED_ROUTINE['return']})"] + RETURN_CODE
+    return asm_code
+
+
 class CodeWriter:
 
-    def __init__(self, filename, fileout):
-        """Initiate the list of assembly commands, take as input the name of the file (without suffix and path) and the output file name"""
+    def __init__(self, filename, fileout, optimize=False, shared=False, source_map=False, register_cache=False):
+        """Initiate the list of assembly commands, take as input the name of the file (without suffix and path) and the output file name
+        The commands are buffered in self.asm_commands and written by blocks (see flush), without output file they are all kept there
+        With <optimize>, the peephole optimizer is run on the assembly commands before writing them
+        With <shared>, eq/gt/lt, call and return jump to routines written once (see writeInit and writeSharedRoutines)
+        instead of being inlined : smaller ROM, more cycles
+        With <source_map>, the origin of the assembly commands is kept in self.source_map (see addSourceEntry) and
+        saved next to the output file, in <fileout>.map (see sourceMap)
+        With <register_cache>, the top of the stack is kept in D from a command to the next and only pushed to the RAM
+        before the labels, jumps, calls and returns (see spillTop) : fewer memory accesses and cycles"""
+        if optimize and source_map:
+            raise Exception("The source map can't be built with the peephole optimizer (it refers to the commands before the optimization)")
         self.asm_commands = []
         self.fn = filename
         self.asm_filename = fileout
+        self.optimize = optimize
+        self.shared = shared
+        self.register_cache = register_cache
+        # Register caching mode : the top of the stack is in D and not in the RAM (SP doesn't count it)
+        self.top_in_d = False
         self.logic_label_index = 0
 
+        # The output is written to a temporary file, renamed when closed
+        self.fd_out = None if fileout is None else open(fileout + ".tmp", "w")
+        self.peephole_optimizer = PeepholeOptimizer()
+        self.n_instructions = 0
+        self.n_flushed_commands = 0
+        self.n_written_instructions = 0
+        self.n_written_commands = 0
+
         # variables for naming of labels
         self.current_function = None
         self.ith_function_call = 0
 
+        # Origin of the assembly commands : (index of the first command, VM file, VM line, VM function) entries
+        self.source_map = [] if source_map else None
+        # ROM address of the entries whose commands have been flushed
+        self.source_addresses = []
+
+    def commandCount(self):
+        """Number of assembly commands written so far (before the peephole optimization)"""
+        return self.n_flushed_commands + len(self.asm_commands)
+
+    def addSourceEntry(self, start, line, filename=None, function=None):
+        """Record that the assembly commands from index <start> come from the line <line> of the current VM file,
+        in the current function (or from <filename> and <function> when given, eg for the bootstrap code)"""
+        if self.source_map is not None:
+            self.source_map.append((start, filename or self.fn, line, function or self.current_function))
+
+    def _sourceEntryAddresses(self, commands, first_command, first_instruction):
+        """ROM addresses of the source map entries (from the first one without address) starting in <commands>,
+        these commands starting at command index <first_command> and at ROM address <first_instruction>"""
+        addresses = command_addresses(commands)
+        entry_addresses = []
+        end = first_command + len(commands)
+        for start, _, _, _ in self.source_map[len(self.source_addresses):]:
+            if start >= end:
+                break
+            entry_addresses.append(first_instruction + int(addresses[start - first_command]))
+        return entry_addresses
+
+    def sourceMap(self):
+        """SourceMap of the commands written so far : VM file and line -> assembly lines -> ROM addresses"""
+        n_commands = self.commandCount()
+        n_instructions = self.n_instructions + count_instructions(self.asm_commands)
+        addresses = self.source_addresses + self._sourceEntryAddresses(self.asm_commands, self.n_flushed_commands, self.n_instructions)
+        # Entries without any command at the end of the program
+        addresses += [n_instructions] * (len(self.source_map) - len(addresses))
+
+        source_map = SourceMap()
+        for (start, filename, line, function), address in zip(self.source_map, addresses):
+            source_map.addEntry(f"{filename}.vm", line, function, start + 1, address)
+        source_map.n_asm_lines = n_commands
+        source_map.n_instructions = n_instructions
+        return source_map
+
+    def setFileName(self, filename):
+        """Inform that the translation of a new VM file (name without suffix and path) has started"""
+        self.fn = filename
+        self.current_function = None
+
     def writeArithmetic(self, command):
         """Convert a VM arithmetic command into assembly code (ie apply an arithmetic/logical command on the stack)"""
+        if self.register_cache and not (self.shared and command in ["eq", "gt", "lt"]):
+            self._writeArithmeticInD(command)
+            return
+
+        self.spillTop()
+        if self.shared and command in ["eq", "gt", "lt"]:
+            self.logic_label_index += 1
+            return_label = f"{self.fn}.LOGIC_RET.{self.logic_label_index}"
+            self.asm_commands += [
+                f"@{return_label}",
+                "D=A",
+                f"@{SHARED_ROUTINE[command]}",
+                "0;JMP",
+                f"({return_label})"
+            ]
+            return
+
         match command:
             case "add":
                 asm_code = [
@@ -132,43 +607,16 @@ class CodeWriter:
                     "M=-1",
                     f"({self.fn}.LOGIC_NO.{i})"
                 ]
-            case "gt":
+            case "gt" | "lt":
+                # y is popped into D and R13, the comparison result replaces x
                 self.logic_label_index += 1
                 i = self.logic_label_index
-                asm_code = [
-                    "@SP",
-                    "M=M-1",
-                    "A=M",
-                    "D=M",
-                    "@SP",
-                    "A=M-1",
-                    "D=M-D",
-                    f"@{self.fn}.LOGIC_YES.{i}",
-                    "D;JGT",
-                    "@SP",
-                    "A=M-1",
-                    "M=0",
-                    f"@{self.fn}.LOGIC_NO.{i}",
-                    "0;JMP",
-                    f"({self.fn}.LOGIC_YES.{i})",
-                    "@SP",
-                    "A=M-1",
-                    "M=-1",
-                    f"({self.fn}.LOGIC_NO.{i})"
-                ]
-            case "lt":
-                self.logic_label_index += 1
-                i = self.logic_label_index
-                asm_code = [
-                    "@SP",
-                    "M=M-1",
-                    "A=M",
-                    "D=M",
-                    "@SP",
-                    "A=M-1",
-                    "D=M-D",
+                asm_code = POP_D + [
+                    "@R13",
+                    "M=D"
+                ] + compare_code(f"{self.fn}.COMPARE_{{}}.{i}") + [
                     f"@{self.fn}.LOGIC_YES.{i}",
-                    "D;JLT",
+                    f"D;J{command.upper()}",
                     "@SP",
                     "A=M-1",
                     "M=0",
@@ -223,138 +671,183 @@ class CodeWriter:
         - argument : RAM block whose base address is kept in address ARG
         - this : RAM block whose base address is kept in address THIS
         - that : RAM block whose base address is kept in address THAT
-        - static : RAM block whose base address is 16
+        - static : assembly variables <filename>.<index>, allocated by the assembler from address 16
         - temp : RAM block of length 8 and whose base address is 5
-        - pointer : more on that later
+        - pointer : THIS (index 0) and THAT (index 1)
+        A push loads the value in D then pushes D, a pop pops into D then stores D (see _loadSegment and _storeSegment)
+        In register caching mode, the pushed value is left in D and a pop takes it from there (see spillTop)
         """
-
-        # Table of the RAM block base address :
-        BASE_ADDRESS_POINTER = {
-            "local" : "LCL",
-            "argument" : "ARG",
-            "this" : "THIS",
-            "that" : "THAT"
-        }
-
-        BASE_ADDRESS = {
-            "static" : "16",
-            "temp" : "5"
-        }
-
-        # Pushing a constant
-        if segment == "constant":
-            if command == "C_PUSH":
+        if command == "C_PUSH":
+            if self.register_cache:
+                self.spillTop()
+                self.asm_commands += self._loadSegment(segment, index)
+                self.top_in_d = True
+                return
+            if segment == "constant" and index in ["0", "1"]:
+                # 0 and 1 are computed by the ALU : no need to load them in D
                 asm_code = [
-                    f"@{index}",
-                    "D=A",
-                    "@SP",
-                    "A=M",
-                    "M=D",
                     "@SP",
-                    "M=M+1",
+                    "AM=M+1",
+                    "A=A-1",
+                    f"M={index}"
                 ]
-            else : 
-                print(f"Can't use command {command} on segment {segment}")
-        
-        # Pushing from / popping to a RAM block
-        elif segment in ["local", "argument", "this", "that"]:
-            base_ad = BASE_ADDRESS_POINTER[segment]
-            if command == "C_PUSH":
-                # D <- RAM[base_ad] + index ; RAM[SP] <- D ; SP++ ; 
+            else:
+                asm_code = self._loadSegment(segment, index) + PUSH_D
+
+        else :
+            # C_POP
+            store_code = self._storeSegment(segment, index)
+            if store_code is None:
+                # R13 <- RAM[base_ad] + index ; SP-- ; RAM[R13] <- RAM[SP]  (the base pointer is left unchanged)
+                self.spillTop()
                 asm_code = [
                     f"@{index}",
                     "D=A",
-                    f"@{base_ad}",
-                    "A=D+M",
-                    "D=M",
-                    "@SP",
+                    f"@{BASE_ADDRESS_POINTER[segment]}",
+                    "D=D+M",
+                    "@R13",
+                    "M=D"
+                ] + POP_D + [
+                    "@R13",
                     "A=M",
-                    "M=D",
-                    "@SP",
-                    "M=M+1",
+                    "M=D"
                 ]
-            else :
-                # C_POP
-                # BA += i ; SP-- ; D <- RAM[SP] ; RAM[BA] <- D ; BA -= i
-                asm_code = [
-                    f"@{index}",
-                    "D=A",
-                    f"@{base_ad}",
-                    "M=D+M",
-                    "@SP",
-                    "M=M-1",
-                    "A=M",
-                    "D=M",
-                    f"@{base_ad}",
-                    "A=M",
-                    "M=D",
-                    f"@{index}",
-                    "D=A",
+            else:
+                asm_code = ([] if self.top_in_d else POP_D) + store_code
+            self.top_in_d = False
+
+        self.asm_commands += asm_code
+
+    def _loadSegment(self, segment, index):
+        """Assembly code loading the value of <segment> <index> into D"""
+        if segment == "constant":
+            if index in ["0", "1"]:
+                return [f"D={index}"]
+            return [
+                f"@{index}",
+                "D=A"
+            ]
+
+        # D <- RAM[RAM[base_ad] + index], the address being computed by the ALU for index 0 and 1
+        if segment in BASE_ADDRESS_POINTER:
+            base_ad = BASE_ADDRESS_POINTER[segment]
+            if index in ["0", "1"]:
+                return [
                     f"@{base_ad}",
-                    "M=M-D",
+                    "A=M" if index == "0" else "A=M+1",
+                    "D=M"
                 ]
+            return [
+                f"@{index}",
+                "D=A",
+                f"@{base_ad}",
+                "A=D+M",
+                "D=M"
+            ]
 
-        # Pushing from / popping to a RAM block
-        elif segment in ["temp", "static"]:
-            base_ad = BASE_ADDRESS[segment]
-            if command == "C_PUSH":
-                # D <- RAM[base_ad+index] ; RAM[SP] <- D ; SP++ ; 
-                asm_code = [
-                    f"@{index}",
-                    "D=A",
-                    f"@{base_ad}",
-                    "A=D+A",
-                    "D=M",
-                    "@SP",
-                    "A=M",
-                    "M=D",
+        # Static variables : one assembly symbol per file and index, so that the files don't share them
+        if segment == "static":
+            return [
+                f"@{self.fn}.{index}",
+                "D=M"
+            ]
+
+        # Fixed segments : the address of temp i and pointer i is known at translation time
+        if segment in FIXED_ADDRESS:
+            return [
+                f"@{FIXED_ADDRESS[segment](index)}",
+                "D=M"
+            ]
+
+        raise Exception(f"Unknown segment : {segment}")
+
+    def _storeSegment(self, segment, index):
+        """Assembly code storing D into <segment> <index>, None when the address has to be computed with D
+        (local/argument/this/that beyond POP_INCREMENT_MAX_INDEX)"""
+        if segment == "constant":
+            raise Exception("Can't pop to the constant segment")
+
+        if segment in BASE_ADDRESS_POINTER:
+            if int(index) > POP_INCREMENT_MAX_INDEX:
+                return None
+            # The value is kept in D while the address is incremented from the base : A=M, A=M+1, A=M+1 A=A+1...
+            return [
+                f"@{BASE_ADDRESS_POINTER[segment]}",
+                "A=M" if index == "0" else "A=M+1"
+            ] + ["A=A+1"] * (int(index) - 1) + [
+                "M=D"
+            ]
+
+        if segment == "static":
+            return [
+                f"@{self.fn}.{index}",
+                "M=D"
+            ]
+
+        if segment in FIXED_ADDRESS:
+            return [
+                f"@{FIXED_ADDRESS[segment](index)}",
+                "M=D"
+            ]
+
+        raise Exception(f"Unknown segment : {segment}")
+
+    def spillTop(self):
+        """Register caching mode : push the top of the stack kept in D, before the code that expects the whole stack
+        in the RAM (labels, jumps, calls, returns...)"""
+        if self.top_in_d:
+            self.asm_commands += PUSH_D
+            self.top_in_d = False
+
+    def _writeArithmeticInD(self, command):
+        """Register caching mode : apply an arithmetic/logical command with the top of the stack in D (popped into D if
+        it is in the RAM), the result being left in D"""
+        asm_code = [] if self.top_in_d else list(POP_D)
+        if command in ["neg", "not"]:
+            asm_code += ["D=-D" if command == "neg" else "D=!D"]
+
+        elif command in ["add", "sub", "and", "or"]:
+            # D <- RAM[SP-1] op D ; SP--
+            asm_code += [
+                "@SP",
+                "AM=M-1",
+                {"add" : "D=D+M", "sub" : "D=M-D", "and" : "D=D&M", "or" : "D=D|M"}[command]
+            ]
+
+        elif command in ["eq", "gt", "lt"]:
+            self.logic_label_index += 1
+            i = self.logic_label_index
+            if command == "eq":
+                asm_code += [
                     "@SP",
-                    "M=M+1"
+                    "AM=M-1",
+                    "D=M-D"
                 ]
-            else :
-                # C_POP
-                # R13 <- base + index ; RAM[R13] <- RAM[SP-1] ; SP--
-                asm_code = [
-                    f"@{index}",
-                    "D=A",
-                    f"@{base_ad}",
-                    "D=D+A",
-                    "@R13",
-                    "M=D",
-                    "@SP",
-                    "M=M-1",
-                    "A=M",
-                    "D=M",
+            else:
+                # y is kept in R13 by compare_code, as D=M-D would overflow
+                asm_code += [
                     "@R13",
-                    "A=M",
                     "M=D"
-                ]
-        elif segment == "pointer":
-            dest = {'0' : "THIS", '1' : "THAT"}[index]
-            if command == "C_PUSH":
-                asm_code = [
-                    f"@{dest}",
-                    "D=M",
-                    "@SP",
-                    "A=M",
-                    "M=D",
+                ] + compare_code(f"{self.fn}.COMPARE_{{}}.{i}") + [
                     "@SP",
-                    "M=M+1",
-                ]
-            else : 
-                asm_code = [
-                    "@SP",
-                    "M=M-1",
-                    "A=M",
-                    "D=M",
-                    f"@{dest}",
-                    "M=D"
+                    "M=M-1"
                 ]
+            asm_code += [
+                f"@{self.fn}.LOGIC_YES.{i}",
+                f"D;J{command.upper()}",
+                "D=0",
+                f"@{self.fn}.LOGIC_NO.{i}",
+                "0;JMP",
+                f"({self.fn}.LOGIC_YES.{i})",
+                "D=-1",
+                f"({self.fn}.LOGIC_NO.{i})"
+            ]
 
-        else : 
-            print(f"Unknown segment : {segment}")
+        else:
+            raise Exception(f"Unknown arithmetic/logical command : {command}")
 
         self.asm_commands += asm_code
+        self.top_in_d = True
 
     def _getFullLabel(self, label):
         """Get the full label name : <filename>.<function>$<label>"""
@@ -367,11 +860,13 @@ class CodeWriter:
     def writeLabel(self, label):
         """Write a label in the VM code as a label in the assembly code""" 
         full_label = self._getFullLabel(label)       
+        self.spillTop()
         self.asm_commands.append(f"({full_label})")
 
     def writeGoto(self, label):
         """Write an unconditionnal goto"""
         full_label = self._getFullLabel(label) 
+        self.spillTop()
         asm_code = [
             f"@{full_label}",
             "0;JMP"
@@ -379,106 +874,574 @@ class CodeWriter:
         self.asm_commands += asm_code
 
     def writeIf(self, label):
-        """Write an unconditionnal goto : pop on the stack and do conditionnal JGT jump on it"""
+        """Write a conditionnal goto : pop on the stack and jump if the value is not false (ie not 0, true being -1)"""
         full_label = self._getFullLabel(label) 
-        asm_code = [
+        asm_code = [] if self.top_in_d else [
             "@SP",
             "M=M-1",
             "A=M",
-            "D=M",
+            "D=M"
+        ]
+        asm_code += [
             f"@{full_label}",
-            "D;JGT"
+            "D;JNE"
         ]
         self.asm_commands += asm_code
+        self.top_in_d = False
+
+    def writeFunction(self, function_name, n_vars):
+        """Write the entry point of a function and initialize its <n_vars> local variables to 0"""
+        self.spillTop()
+        self.current_function = function_name
+        self.asm_commands.append(f"({function_name})")
+        for _ in range(int(n_vars)):
+            self.asm_commands += [
+                "@SP",
+                "AM=M+1",
+                "A=A-1",
+                "M=0"
+            ]
+
+    def writeCall(self, function_name, n_args):
+        """Call a function : push the return address and the frame of the caller (LCL, ARG, THIS, THAT),
+        reposition ARG and LCL and jump to the function. The return label is <caller>$ret.<i>"""
+        self.ith_function_call += 1
+        caller = self.fn if self.current_function is None else self.current_function
+        return_label = f"{caller}$ret.{self.ith_function_call}"
+        self.spillTop()
+
+        if self.shared:
+            self.asm_commands += [
+                f"@{n_args}",
+                "D=A",
+                "@R13",
+                "M=D",
+                f"@{function_name}",
+                "D=A",
+                "@R14",
+                "M=D",
+                f"@{return_label}",
+                "D=A",
+                f"@{SHARED_ROUTINE['call']}",
+                "0;JMP",
+                f"({return_label})"
+            ]
+            return
+
+        asm_code = [
+            f"@{return_label}",
+            "D=A",
+            "@SP",
+            "AM=M+1",
+            "A=A-1",
+            "M=D"
+        ]
+        for pointer in ["LCL", "ARG", "THIS", "THAT"]:
+            asm_code += [
+                f"@{pointer}",
+                "D=M",
+                "@SP",
+                "AM=M+1",
+                "A=A-1",
+                "M=D"
+            ]
+        asm_code += [
+            # ARG <- SP - 5 - n_args ; LCL <- SP
+            "@SP",
+            "D=M",
+            f"@{int(n_args) + 5}",
+            "D=D-A",
+            "@ARG",
+            "M=D",
+            "@SP",
+            "D=M",
+            "@LCL",
+            "M=D",
+            f"@{function_name}",
+            "0;JMP",
+            f"({return_label})"
+        ]
+        self.asm_commands += asm_code
+
+    def writeReturn(self):
+        """Return from the current function to the caller"""
+        self.spillTop()
+        if self.shared:
+            self.asm_commands += [
+                f"@{SHARED_ROUTINE['return']}",
+                "0;JMP"
+            ]
+        else:
+            self.asm_commands += RETURN_CODE
+
+    def writeInit(self):
+        """Write the bootstrap code : SP <- 256 and call Sys.init (followed by the shared routines in shared mode)"""
+        self.addSourceEntry(self.commandCount(), 0, function="(bootstrap)")
+        self.asm_commands += [
+            "@256",
+            "D=A",
+            "@SP",
+            "M=D"
+        ]
+        self.writeCall("Sys.init", 0)
+        if self.shared:
+            # Sys.init never returns : the routines are only reached by the jumps of the use sites
+            self.addSourceEntry(self.commandCount(), 0, function="(shared routines)")
+            self.asm_commands += shared_routines()
+
+    def writeSharedRoutines(self):
+        """Write the shared routines for a program without bootstrap, preceded by a jump over them"""
+        self.addSourceEntry(self.commandCount(), 0, function="(shared routines)")
+        self.asm_commands += [
+            "@VM$START",
+            "0;JMP"
+        ]
+        self.asm_commands += shared_routines()
+        self.asm_commands.append("(VM$START)")
     
+    def flush(self, final=False):
+        """Write the buffered assembly commands to the output file once there are WRITE_BUFFER_SIZE of them (all of them if <final>)"""
+        if self.fd_out is None or (not final and len(self.asm_commands) < WRITE_BUFFER_SIZE):
+            return
+        commands = self.asm_commands
+        self.asm_commands = []
+        if self.source_map is not None:
+            self.source_addresses += self._sourceEntryAddresses(commands, self.n_flushed_commands, self.n_instructions)
+        self.n_flushed_commands += len(commands)
+        n_instructions = count_instructions(commands)
+        self.n_instructions += n_instructions
+
+        if self.optimize:
+            feed = self.peephole_optimizer.feed
+            for command in commands:
+                feed(command)
+            commands = self.peephole_optimizer.flush(0 if final else PEEPHOLE_KEEP)
+            n_instructions = count_instructions(commands)
+
+        if commands:
+            if self.n_written_commands:
+                self.fd_out.write("\n")
+            self.fd_out.write("\n".join(commands))
+            self.n_written_commands += len(commands)
+            self.n_written_instructions += n_instructions
+
     def close(self):
-        """Generate the assembly script"""
-        with open(self.asm_filename, "w") as fd_out:
-            for line in self.asm_commands[:-1]:
-                fd_out.write(line)
-                fd_out.write("\n")
-            fd_out.write(self.asm_commands[-1])
-            
+        """Write the remaining assembly commands and close the assembly script"""
+        self.flush(final=True)
+        self.fd_out.close()
+        os.replace(self.asm_filename + ".tmp", self.asm_filename)
+
+        if self.optimize:
+            n_before, n_after = self.n_instructions, self.n_written_instructions
+            print(f"Peephole optimization : {n_before} -> {n_after} instructions (-{100*(n_before-n_after)/max(n_before, 1):.1f}%)")
         print(f"Assembly code written in {self.asm_filename}")
 
-if __name__ == "__main__":
+        if self.source_map is not None:
+            write_source_map(self.sourceMap(), self.asm_filename + ".map")
+            print(f"Source map written in {self.asm_filename}.map")
 
-    # Getting the VM script path thought CL argument
-    if len(sys.argv) != 2:
-        print(f"Usage : {sys.argv[0]} <prog.vm | progDirectory>")
-        exit()
 
-    # Check if the input is a vm file or a directory
-    if sys.argv[1].endswith(".vm"):
-        usage_mode = "standalone_source_file"
+def write_command(code_writer, command_type, words):
+    """Write a VM command, given by its type and its words, with <code_writer>"""
+    if command_type == "C_ARITHMETIC":
+        code_writer.writeArithmetic(words[0])
+
+    elif command_type in ["C_PUSH", "C_POP"]:
+        code_writer.writePushPop(command_type, words[1], words[2])
+
+    elif command_type == "C_LABEL":
+        code_writer.writeLabel(words[1])
+
+    elif command_type == "C_GOTO":
+        code_writer.writeGoto(words[1])
+
+    elif command_type == "C_IF":
+        code_writer.writeIf(words[1])
+
+    elif command_type == "C_FUNCTION":
+        code_writer.writeFunction(words[1], words[2])
+
+    elif command_type == "C_CALL":
+        code_writer.writeCall(words[1], words[2])
+
+    elif command_type == "C_RETURN":
+        code_writer.writeReturn()
+
+
+def to_signed(value):
+    """Signed value of an unsigned 16-bit integer"""
+    return value - ((value & 0x8000) << 1)
+
+
+# Evaluation of the arithmetic/logical commands on constants (unsigned 16-bit integers), true being -1
+FOLD_UNARY = {
+    "neg" : lambda x: -x & 0xFFFF,
+    "not" : lambda x: x ^ 0xFFFF
+}
+FOLD_BINARY = {
+    "add" : lambda x, y: (x + y) & 0xFFFF,
+    "sub" : lambda x, y: (x - y) & 0xFFFF,
+    "and" : lambda x, y: x & y,
+    "or" : lambda x, y: x | y,
+    "eq" : lambda x, y: 0xFFFF if x == y else 0,
+    "gt" : lambda x, y: 0xFFFF if to_signed(x) > to_signed(y) else 0,
+    "lt" : lambda x, y: 0xFFFF if to_signed(x) < to_signed(y) else 0
+}
+
+
+class VMOptimizer:
+
+    def __init__(self, shared=False, register_cache=False, report=False):
+        """Optimizing pass on the VM commands, between the parser and the CodeWriter (see optimize) : constant folding,
+        constant branches and dead code elimination
+        The VM commands are counted before and after the pass. With <report>, the instructions they are translated to
+        (with the <shared> and <register_cache> options of the real CodeWriter) are counted too, which translates them again"""
+        self.report = report
+        self.n_commands_in = 0
+        self.n_commands_out = 0
+        self.n_instructions_in = 0
+        self.n_instructions_out = 0
+        # Translation of single commands, to count their instructions : one CodeWriter for each side of the pass,
+        # the translation of a command depending on the previous ones in the register caching mode
+        if report:
+            self.counter_in = CodeWriter("Counter", None, shared=shared, register_cache=register_cache)
+            self.counter_out = CodeWriter("Counter", None, shared=shared, register_cache=register_cache)
+
+    def _countInstructions(self, counter, command_type, words):
+        """Number of instructions of the translation of a VM command by the CodeWriter <counter>"""
+        write_command(counter, command_type, words)
+        n_instructions = count_instructions(counter.asm_commands)
+        counter.asm_commands = []
+        return n_instructions
+
+    def counts(self):
+        """Counters of the commands and instructions before and after the pass"""
+        return (self.n_commands_in, self.n_commands_out, self.n_instructions_in, self.n_instructions_out)
+
+    def addCounts(self, counts):
+        """Add the counters of another VMOptimizer (eg of a worker process)"""
+        self.n_commands_in += counts[0]
+        self.n_commands_out += counts[1]
+        self.n_instructions_in += counts[2]
+        self.n_instructions_out += counts[3]
+
+    def optimize(self, commands):
+        """Optimize a stream of (command type, words, line) VM commands (as yielded by stream_tokens) and yield the resulting commands"""
+        for command_type, words, line in self._optimize(self._countInput(commands)):
+            self.n_commands_out += 1
+            if self.report:
+                self.n_instructions_out += self._countInstructions(self.counter_out, command_type, words)
+            yield (command_type, words, line)
+
+    def _countInput(self, commands):
+        """Count the commands going into the pass"""
+        for command_type, words, line in commands:
+            self.n_commands_in += 1
+            if self.report:
+                self.n_instructions_in += self._countInstructions(self.counter_in, command_type, words)
+            yield (command_type, words, line)
+
+    def _optimize(self, commands):
+        """Optimizing pass proper :
+        - the constants pushed are held back : the arithmetic commands on them are evaluated, an if-goto on a constant
+          becomes a goto or nothing, and they are only pushed before any other command
+        - the commands after a goto or a return are dropped until the next label or function (they can't be reached)"""
+        constants = [] # (value, line) of the constants pushed and not written yet
+        reachable = True
+        for command_type, words, line in commands:
+            if not reachable:
+                if command_type not in ["C_LABEL", "C_FUNCTION"]:
+                    continue
+                reachable = True
+
+            if command_type == "C_PUSH" and words[1] == "constant" and len(words) == 3 and words[2].isdigit():
+                constants.append((int(words[2]) & 0xFFFF, line))
+                continue
+
+            if command_type == "C_ARITHMETIC" and words[0] in FOLD_UNARY and constants:
+                value, _ = constants.pop()
+                constants.append((FOLD_UNARY[words[0]](value), line))
+                continue
+
+            if command_type == "C_ARITHMETIC" and words[0] in FOLD_BINARY and len(constants) >= 2:
+                y, _ = constants.pop()
+                x, _ = constants.pop()
+                constants.append((FOLD_BINARY[words[0]](x, y), line))
+                continue
+
+            if command_type == "C_IF" and len(words) == 2 and constants:
+                value, _ = constants.pop()
+                yield from self._pushConstants(constants)
+                constants = []
+                if value:
+                    yield ("C_GOTO", ["goto", words[1]], line)
+                    reachable = False
+                continue
+
+            yield from self._pushConstants(constants)
+            constants = []
+            yield (command_type, words, line)
+            if command_type in ["C_GOTO", "C_RETURN"]:
+                reachable = False
+
+        yield from self._pushConstants(constants)
+
+    def _pushConstants(self, constants):
+        """Commands pushing constants, the values above 32767 (not allowed by push constant) being pushed as not(~value)"""
+        for value, line in constants:
+            if value <= 0x7FFF:
+                yield ("C_PUSH", ["push", "constant", str(value)], line)
+            else:
+                yield ("C_PUSH", ["push", "constant", str(value ^ 0xFFFF)], line)
+                yield ("C_ARITHMETIC", ["not"], line)
+
+
+def translate_file(path, code_writer, vm_optimizer=None):
+    """Parse the VM file <path> and write its commands with <code_writer>, streaming : the commands are read,
+    translated and written by blocks, so that the memory used doesn't depend on the size of the file
+    With a VMOptimizer <vm_optimizer>, the commands go through its optimizing pass"""
+    commands = stream_tokens(path)
+    if vm_optimizer is not None:
+        commands = vm_optimizer.optimize(commands)
+
+    for command_type, words, line in commands:
+        start = code_writer.commandCount()
+        write_command(code_writer, command_type, words)
+        code_writer.addSourceEntry(start, line)
+        code_writer.flush()
 
+    # The stack is left whole in the RAM at the end of the file (the code is part of the last command in the source map)
+    code_writer.spillTop()
+    code_writer.flush()
+
+
+def list_vm_files(path):
+    """List the .vm files of a program : the file itself, or the files of a directory with Sys.vm first"""
+    if path.endswith(".vm"):
+        return [path]
+    files = sorted(f for f in os.listdir(path) if f.endswith(".vm"))
+    if "Sys.vm" in files:
+        files.remove("Sys.vm")
+        files.insert(0, "Sys.vm")
+    return [os.path.join(path, f) for f in files]
+
+
+def _translate_file_commands(path, shared, source_map=False, fold=False, register_cache=False, fold_report=False):
+    """Translate a VM file with its own CodeWriter (and its own VMOptimizer with <fold>, counting the instructions with
+    <fold_report>) and return its assembly commands, its source map (None without <source_map>) and the counters of the
+    optimizer (None without <fold>) (run by the workers of translate_directory)"""
+    code_writer = CodeWriter(os.path.basename(path)[:-3], None, shared=shared, source_map=source_map, register_cache=register_cache)
+    vm_optimizer = VMOptimizer(shared, register_cache, fold_report) if fold else None
+    translate_file(path, code_writer, vm_optimizer)
+    return code_writer.asm_commands, code_writer.source_map, None if vm_optimizer is None else vm_optimizer.counts()
+
+
+# Version of the generated code, part of the keys of the translation cache : it is the hash of this file,
+# so that any change of the translator invalidates the cached translations
+with open(__file__, "rb") as fd:
+    TRANSLATOR_VERSION = hashlib.sha256(fd.read()).hexdigest()[:16]
+
+CACHE_DIRECTORY = ".vmcache"
+CACHE_MAX_SIZE = 64 * 1024 * 1024
+
+
+class TranslationCache:
+
+    def __init__(self, directory, max_size=CACHE_MAX_SIZE):
+        """On-disk cache of the assembly commands of translated VM files, one <key>.asm file per translation,
+        the least recently used ones being removed when the total size exceeds <max_size> bytes"""
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, path, shared, fold=False, register_cache=False):
+        """Key of the translation of a VM file : hash of its name (part of the labels), of its source, of the modes and of the translator version"""
+        with open(path, "rb") as fd_in:
+            source = fd_in.read()
+        header = f"{TRANSLATOR_VERSION}:{int(shared)}:{int(fold)}:{int(register_cache)}:{os.path.basename(path)}:".encode()
+        return hashlib.sha256(header + source).hexdigest()
+
+    def get(self, key):
+        """Return the cached assembly commands, or None"""
+        path = os.path.join(self.directory, f"{key}.asm")
+        try:
+            with open(path, "r") as fd_in:
+                asm_commands = fd_in.read().split("\n")
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        # The modification time is the time of last use
+        os.utime(path)
+        self.hits += 1
+        return asm_commands if asm_commands != [""] else []
+
+    def put(self, key, asm_commands):
+        """Store the assembly commands of a translation (written to a temporary file then renamed, so that a reader never sees a partial file)"""
+        path = os.path.join(self.directory, f"{key}.asm")
+        with open(path + ".tmp", "w") as fd_out:
+            fd_out.write("\n".join(asm_commands))
+        os.replace(path + ".tmp", path)
+
+    def evict(self):
+        """Remove the least recently used translations until the cache fits in its maximum size"""
+        entries = []
+        for f in os.listdir(self.directory):
+            if f.endswith(".asm"):
+                stat = os.stat(os.path.join(self.directory, f))
+                entries.append((stat.st_mtime, stat.st_size, f))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, f in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            os.remove(os.path.join(self.directory, f))
+            total_size -= size
+
+
+def translate_directory(src_dir, code_writer, processes=None, cache=None, vm_optimizer=None):
+    """Write the bootstrap code and the translation of the VM files of <src_dir> (Sys.vm first, then the others by name)
+    with <code_writer>. The files are translated in parallel on a pool of <processes> workers (all the cores by default),
+    each with its own CodeWriter, and joined in order
+    With a TranslationCache <cache>, only the files that are not in the cache are translated (the cache is not used
+    when <code_writer> builds a source map)
+    With a VMOptimizer <vm_optimizer>, the files go through the optimizing pass and the counters of the translated files
+    (not of the ones from the cache) are added to it"""
+    code_writer.writeInit()
+    vm_files = list_vm_files(src_dir)
+    translations = [None] * len(vm_files)
+    source_map = code_writer.source_map is not None
+    fold = vm_optimizer is not None
+    if source_map:
+        cache = None
+
+    if cache is not None:
+        keys = [cache.key(path, code_writer.shared, fold, code_writer.register_cache) for path in vm_files]
+        translations = [cache.get(key) for key in keys]
+        translations = [None if asm_commands is None else (asm_commands, None, None) for asm_commands in translations]
+
+    missing = [i for i, translation in enumerate(translations) if translation is None]
+    missing_files = [vm_files[i] for i in missing]
+    shared = [code_writer.shared] * len(missing)
+    source_maps = [source_map] * len(missing)
+    folds = [fold] * len(missing)
+    register_caches = [code_writer.register_cache] * len(missing)
+    fold_reports = [fold and vm_optimizer.report] * len(missing)
+    if processes == 1 or len(missing) <= 1:
+        missing_translations = map(_translate_file_commands, missing_files, shared, source_maps, folds, register_caches, fold_reports)
     else:
-        if os.path.isdir(sys.argv[1]):
-            src_dir = sys.argv[1]
-            # List all the files ending with .vm
-            files = os.listdir(src_dir)
-            vm_files = []
-            for f in files:
-                if f.endswith(".vm"):
-                    vm_files.append(f.split("/")[-1]) # Get the file name, without the path
-
-            # Exit if no vm file found
-            if len(vm_files) == 0:
-                print("Error : no VM code file found in the supplied directory (must end with .vm)")
-                exit()
-            # Check if the Sys.vm file exists
-            if not("Sys.vm" in vm_files):
-                print("Error : no Sys.vm code file found in the supplied directory")
-                exit()
-            # Open the Sys.vm file and check for the presence of the Sys.init function
-            with open(os.path.join(src_dir, "Sys.vm")) as fd:
-                sys_code = ''.join(fd.readlines())
-                if not("function Sys.init" in sys_code):
-                    print("Error : the Sys.vm file does not contain a Sys.init function decalaration")
-                    exit()
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            missing_translations = list(pool.map(_translate_file_commands, missing_files, shared, source_maps, folds, register_caches,
+                                                 fold_reports))
+    for i, translation in zip(missing, missing_translations):
+        translations[i] = translation
+        if cache is not None:
+            cache.put(keys[i], translation[0])
+        if fold:
+            vm_optimizer.addCounts(translation[2])
 
-            # We have a Sys.vm file and it contains a Sys.init function
-            usage_mode = "bootstrap_and_sources"
+    if cache is not None and missing:
+        cache.evict()
 
-    print(usage_mode)
-    exit()
+    for asm_commands, file_source_map, _ in translations:
+        if source_map:
+            # The entries of the file are shifted by the number of commands written before it
+            offset = code_writer.commandCount()
+            code_writer.source_map += [(start + offset, filename, line, function) for start, filename, line, function in file_source_map]
+        code_writer.asm_commands += asm_commands
+        code_writer.flush()
 
-    # Construct Parser
-    parser = Parser(sys.argv[1])
 
-    # Initiate assembly code write
-    fileout = sys.argv[1].replace(".vm", ".asm")
-    filename = sys.argv[1].split("/")[-1][:-3]
-    code_writer = CodeWriter(filename, fileout)
+if __name__ == "__main__":
 
-    # Loop on lines
-    while True:
+    # Getting the VM script path and the options thought CL arguments
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("-")]
+    options = [arg for arg in sys.argv[1:] if arg.startswith("-")]
+    if len(args) != 1 or any(option not in ["-O", "--fold", "--fold-report", "--register-cache", "--shared", "--no-cache", "--source-map"]
+                             for option in options):
+        print(f"Usage : {sys.argv[0]} <prog.vm | progDirectory> [-O] [--fold [--fold-report]] [--register-cache] [--shared] [--no-cache] [--source-map]")
+        print("  -O : run the peephole optimizer on the generated code")
+        print("  --fold : fold the constant expressions and branches and drop the unreachable VM commands before the translation")
+        print("  --fold-report : also count the instructions of the VM commands before and after the folding (translates them again)")
+        print("  --register-cache : keep the top of the stack in D between the commands, pushing it only before labels, jumps and calls")
+        print("  --shared : jump to shared routines for eq/gt/lt, call and return instead of inlining them")
+        print(f"  --no-cache : translate all the files of a directory, without reading or updating <progDirectory>/{CACHE_DIRECTORY}")
+        print("  --source-map : write the origin of the code (VM file:line -> assembly lines -> ROM addresses) in <prog>.asm.map")
+        exit()
+    src_path = args[0]
 
-        parser.commandType()
+    # Check if the input is a vm file or a directory
+    if src_path.endswith(".vm"):
+        usage_mode = "standalone_source_file"
 
-        print(parser.current_type)
+    elif os.path.isdir(src_path):
+        src_dir = src_path
+        # List all the files ending with .vm
+        files = os.listdir(src_dir)
+        vm_files = []
+        for f in files:
+            if f.endswith(".vm"):
+                vm_files.append(f.split("/")[-1]) # Get the file name, without the path
 
-        if parser.current_type == "C_ARITHMETIC":
-            code_writer.writeArithmetic(parser.arg1())
+        # Exit if no vm file found
+        if len(vm_files) == 0:
+            print("Error : no VM code file found in the supplied directory (must end with .vm)")
+            exit()
+        # Check if the Sys.vm file exists
+        if not("Sys.vm" in vm_files):
+            print("Error : no Sys.vm code file found in the supplied directory")
+            exit()
+        # Open the Sys.vm file and check for the presence of the Sys.init function
+        with open(os.path.join(src_dir, "Sys.vm")) as fd:
+            sys_code = ''.join(fd.readlines())
+            if not("function Sys.init" in sys_code):
+                print("Error : the Sys.vm file does not contain a Sys.init function decalaration")
+                exit()
 
-        elif parser.current_type in ["C_PUSH", "C_POP"]:
-            code_writer.writePushPop(parser.current_type, parser.arg1(), parser.arg2())
+        # We have a Sys.vm file and it contains a Sys.init function
+        usage_mode = "bootstrap_and_sources"
 
-        elif parser.current_type == "C_LABEL":
-            code_writer.writeLabel(parser.arg1())
+    else:
+        print(f"Error : {src_path} is neither a .vm file nor a directory")
+        exit()
 
-        elif parser.current_type == "C_GOTO":
-            code_writer.writeGoto(parser.arg1())
+    optimize = "-O" in options
+    shared = "--shared" in options
+    source_map = "--source-map" in options
+    register_cache = "--register-cache" in options
+    vm_optimizer = VMOptimizer(shared, register_cache, "--fold-report" in options) if "--fold" in options else None
+    if optimize and source_map:
+        print("Error : -O and --source-map can't be used together")
+        exit()
 
-        elif parser.current_type == "C_IF":
-            code_writer.writeIf(parser.arg1())
+    if usage_mode == "standalone_source_file":
+        # Initiate assembly code write
+        fileout = src_path.replace(".vm", ".asm")
+        filename = src_path.split("/")[-1][:-3]
+        code_writer = CodeWriter(filename, fileout, optimize=optimize, shared=shared, source_map=source_map, register_cache=register_cache)
+        if shared:
+            code_writer.writeSharedRoutines()
+        translate_file(src_path, code_writer, vm_optimizer)
 
-        if parser.hasMoreLines() :
-            parser.advance()
-        else : 
-            break
+    else:
+        # <dir>/<dir>.asm : bootstrap, Sys.vm then the other files
+        dir_name = os.path.basename(os.path.normpath(src_dir))
+        fileout = os.path.join(src_dir, f"{dir_name}.asm")
+        code_writer = CodeWriter("Bootstrap", fileout, optimize=optimize, shared=shared, source_map=source_map, register_cache=register_cache)
+        # Translations of the unchanged files are reused from <dir>/.vmcache (not when building a source map)
+        cache = None if "--no-cache" in options or source_map else TranslationCache(os.path.join(src_dir, CACHE_DIRECTORY))
+        translate_directory(src_dir, code_writer, cache=cache, vm_optimizer=vm_optimizer)
+        if cache is not None:
+            print(f"Translation cache : {cache.hits} files reused, {cache.misses} translated")
 
-    code_writer.close()
-    
-    
+    if vm_optimizer is not None:
+        n_commands_in, n_commands_out, n_instructions_in, n_instructions_out = vm_optimizer.counts()
+        # The files reused from the cache are not counted
+        scope = " (translated files)" if usage_mode == "bootstrap_and_sources" and cache is not None else ""
+        report = f"VM optimization{scope} : {n_commands_in} -> {n_commands_out} commands"
+        if vm_optimizer.report:
+            report += (f", {n_instructions_in} -> {n_instructions_out} instructions"
+                       f" (-{100*(n_instructions_in-n_instructions_out)/max(n_instructions_in, 1):.1f}%)")
+        print(report)
 
+    code_writer.close()
@@ -0,0 +1,373 @@
+#! /bin/python3
+# Benchmarks of the VM translator on the test programs of projects 7 and 8
+
+import sys, os
+import time
+import tracemalloc
+import shutil
+import tempfile
+import contextlib
+import io
+import numpy as np
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(REPO_DIR, "project6_assembler"))
+sys.path.append(os.path.join(REPO_DIR, "hack_emulator"))
+
+from my_assembler import Assembler
+from HackCPU import HackCPU
+from VMTranslator import CodeWriter, TranslationCache, VMOptimizer, translate_file, translate_directory, peephole, CACHE_DIRECTORY
+from TestScript import ScriptRunner, translate_vm_program, parse_script, parse_int, DEFAULT_TEST_DIRS
+from Profiler import translate_for_profiling, read_vm_lines, vm_regions
+
+def run_to_halt(cpu, max_cycles=1_000_000):
+    """Run the program loaded in <cpu> until it reaches the end of the ROM or a halt loop and return the number of
+    executed cycles"""
+    if cpu.halt_loops:
+        cpu.run(max_cycles)
+        if cpu.halt_cycle is not None:
+            return cpu.halt_cycle
+        raise Exception(f"Program not halted after {max_cycles} cycles")
+
+    # Without halt loop, the program is run cycle by cycle up to the end of the ROM
+    rom = cpu.rom
+    ram_view = cpu.RAM.view("uint16")
+    ram = ram_view.tolist()
+    a, d, pc = cpu.A, cpu.D, cpu.PC
+    for cycle in range(max_cycles):
+        if pc >= len(rom):
+            ram_view[:] = ram
+            cpu.A, cpu.D, cpu.PC = a, d, pc
+            return cycle
+        a, d, pc, _ = cpu._execute(ram, a, d, pc, 1)
+    raise Exception(f"Program not halted after {max_cycles} cycles")
+
+
+def set_script_ram(cpu, script):
+    """Set the RAM of <cpu> as the set commands of a test script do"""
+    with open(script, "r") as fd_in:
+        for command in parse_script(fd_in.read()):
+            if command[0] == "set":
+                cpu.RAM[int(command[1][4:-1])] = parse_int(command[2])
+
+
+def cycles_to_halt(rom, script, max_cycles=1_000_000):
+    """Number of cycles executed by the program from the RAM set up by the test script until it reaches
+    the end of the ROM or an infinite loop on itself"""
+    cpu = HackCPU(rom)
+    set_script_ram(cpu, script)
+    return run_to_halt(cpu, max_cycles)
+
+
+def profile_to_halt(rom, script):
+    """Number of executions of each instruction of the program until it halts (see cycles_to_halt)"""
+    cpu = HackCPU(rom, profile=True)
+    set_script_ram(cpu, script)
+    cpu.run(cycles_to_halt(rom, script))
+    return cpu.profile_counts()[:len(rom)]
+
+
+def memory_accesses(rom, counts):
+    """Number of RAM accesses of a run : executed C-instructions reading M (a-bit) or writing M (d3 bit)"""
+    words = np.asarray(rom, dtype=np.uint16)
+    is_c = words & 0x8000 != 0
+    access_m = is_c & ((words & 0x1000 != 0) | (words & 0x0008 != 0))
+    return int(counts[access_m].sum())
+
+
+def find_programs():
+    """List the test programs (directory, CPU test script) of projects 7 and 8"""
+    programs = []
+    for test_dir in DEFAULT_TEST_DIRS:
+        for name in sorted(os.listdir(test_dir)):
+            script = os.path.join(test_dir, name, f"{name}.tst")
+            if os.path.exists(script):
+                programs.append((os.path.join(test_dir, name), script))
+    return programs
+
+
+def check_program(program_dir, script, asm_commands):
+    """Run the test script of the program on the translated code, in a copy of its directory"""
+    name = os.path.basename(program_dir)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        copy_dir = shutil.copytree(program_dir, os.path.join(tmp_dir, name))
+        with open(os.path.join(copy_dir, f"{name}.asm"), "w") as fd_out:
+            fd_out.write("\n".join(asm_commands))
+        runner = ScriptRunner(os.path.join(copy_dir, os.path.basename(script)))
+        runner.run()
+        return "PASS" if runner.compare() is None else "FAIL"
+
+
+def bench_shared_routines():
+    """Compare the ROM size and the cycle count of the inline and shared translations of the test programs"""
+    print("ROM size (instructions) and cycles to halt : inline | shared routines")
+    for program_dir, script in find_programs():
+        results = []
+        for shared in [False, True]:
+            asm_commands = translate_vm_program(program_dir, os.path.basename(program_dir), shared)
+            rom = Assembler().assemble_lines(asm_commands)
+            results.append((len(rom), cycles_to_halt(rom, script), check_program(program_dir, script, asm_commands)))
+        (size, cycles, status), (shared_size, shared_cycles, shared_status) = results
+        print(f"  {os.path.basename(program_dir):<18} ROM {size:5} | {shared_size:5} ({(shared_size - size)/size:+6.1%})"
+              f"   cycles {cycles:6} | {shared_cycles:6} ({(shared_cycles - cycles)/cycles:+6.1%})   {status} | {shared_status}")
+
+
+def bench_peephole():
+    """Compare the ROM size and the cycle count of the test programs translated without and with the peephole optimizer,
+    failing if the optimizer removes nothing (its rules matching the code writer templates no longer)"""
+    print("ROM size (instructions) and cycles to halt : plain | peephole optimizer")
+    total, total_optimized = 0, 0
+    for program_dir, script in find_programs():
+        results = []
+        asm_commands = translate_vm_program(program_dir, os.path.basename(program_dir))
+        for optimized_commands in [asm_commands, peephole(asm_commands)]:
+            rom = Assembler().assemble_lines(optimized_commands)
+            results.append((len(rom), cycles_to_halt(rom, script), check_program(program_dir, script, optimized_commands)))
+        (size, cycles, status), (optimized_size, optimized_cycles, optimized_status) = results
+        total += size
+        total_optimized += optimized_size
+        print(f"  {os.path.basename(program_dir):<18} ROM {size:5} | {optimized_size:5} ({(optimized_size - size)/size:+6.1%})"
+              f"   cycles {cycles:6} | {optimized_cycles:6} ({(optimized_cycles - cycles)/cycles:+6.1%})   {status} | {optimized_status}")
+    if total_optimized >= total:
+        raise Exception("The peephole optimizer removes no instruction from the test programs")
+
+
+def timeit(func, *args, repeat=3):
+    """Return the best wall time (in seconds) over <repeat> calls of func(*args)"""
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def translate_commands(src_dir, processes, cache=None):
+    """Assembly commands of the translation of a directory"""
+    code_writer = CodeWriter("Bootstrap", None)
+    translate_directory(src_dir, code_writer, processes, cache)
+    return code_writer.asm_commands
+
+
+def write_classes(tmp_dir, n_files, n_functions):
+    """Write a program of <n_files> classes, each made of <n_functions> copies of Main.fibonacci (FibonacciElement)"""
+    program_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "FibonacciElement")
+    with open(os.path.join(program_dir, "Main.vm"), "r") as fd_in:
+        fibonacci = fd_in.read()
+    shutil.copy(os.path.join(program_dir, "Sys.vm"), tmp_dir)
+    for i in range(n_files):
+        with open(os.path.join(tmp_dir, f"Class{i}.vm"), "w") as fd_out:
+            for j in range(n_functions):
+                fd_out.write(fibonacci.replace("Main.fibonacci", f"Class{i}.fibonacci{j}"))
+
+
+def bench_directory_translation(n_files=48, n_functions=40):
+    """Compare the serial and the parallel translation of a directory of <n_files> classes"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        write_classes(tmp_dir, n_files, n_functions)
+        serial = translate_commands(tmp_dir, 1)
+        if translate_commands(tmp_dir, None) != serial:
+            raise Exception("The parallel translation differs from the serial one")
+        t_serial = timeit(translate_commands, tmp_dir, 1)
+        t_parallel = timeit(translate_commands, tmp_dir, None)
+
+    print(f"Directory of {n_files} files ({len(serial)} assembly commands, {os.cpu_count()} cores)")
+    print(f"  serial : {t_serial*1e3:8.2f} ms | process pool : {t_parallel*1e3:8.2f} ms | x{t_serial/t_parallel:.1f}")
+
+
+def bench_translation_cache(n_files=48, n_functions=40):
+    """Time the translation of a directory without cache, with all its files in the cache and after the edit of one file"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        write_classes(tmp_dir, n_files, n_functions)
+        reference = translate_commands(tmp_dir, 1)
+        t_full = timeit(translate_commands, tmp_dir, 1)
+
+        cache = TranslationCache(os.path.join(tmp_dir, CACHE_DIRECTORY))
+        translate_commands(tmp_dir, 1, cache)
+        t_warm = timeit(translate_commands, tmp_dir, 1, cache)
+        if translate_commands(tmp_dir, 1, cache) != reference:
+            raise Exception("The cached translation differs from the full one")
+
+        def edit_and_translate():
+            with open(os.path.join(tmp_dir, "Class0.vm"), "a") as fd_out:
+                fd_out.write("// edit\n")
+            translate_commands(tmp_dir, 1, cache)
+
+        t_edit = timeit(edit_and_translate)
+
+    print(f"Translation cache ({n_files} files)")
+    print(f"  no cache : {t_full*1e3:8.2f} ms | all cached : {t_warm*1e3:7.2f} ms (x{t_full/t_warm:.0f}) | one file edited : {t_edit*1e3:7.2f} ms (x{t_full/t_edit:.0f})")
+
+
+def peak_memory(func, *args):
+    """Return the wall time and the peak of memory allocated (in bytes) during func(*args)"""
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    func(*args)
+    elapsed = time.perf_counter() - t0
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def translate_in_memory(vm_file, asm_file, optimize):
+    """Translate a VM file keeping all its assembly commands in memory, then write them"""
+    code_writer = CodeWriter("Big", None)
+    translate_file(vm_file, code_writer)
+    asm_commands = peephole(code_writer.asm_commands) if optimize else code_writer.asm_commands
+    with open(asm_file, "w") as fd_out:
+        fd_out.write("\n".join(asm_commands))
+
+
+def translate_streaming(vm_file, asm_file, optimize):
+    """Translate a VM file through the streaming pipeline"""
+    code_writer = CodeWriter("Big", asm_file, optimize=optimize)
+    translate_file(vm_file, code_writer)
+    code_writer.close()
+
+
+def bench_streaming(size_mb=4):
+    """Compare the peak memory of an in-memory and of a streaming translation of a VM file of about <size_mb> MB
+    (the test programs of project 7 and 8 concatenated again and again)"""
+    sources = []
+    for test_dir in DEFAULT_TEST_DIRS:
+        for root, _, files in sorted(os.walk(test_dir)):
+            for f in sorted(files):
+                if f.endswith(".vm"):
+                    with open(os.path.join(root, f), "r") as fd_in:
+                        sources.append(fd_in.read())
+    program = "\n".join(sources)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        vm_file = os.path.join(tmp_dir, "Big.vm")
+        with open(vm_file, "w") as fd_out:
+            for _ in range(size_mb * 2**20 // len(program) + 1):
+                fd_out.write(program)
+        size = os.path.getsize(vm_file)
+
+        print(f"Translation of a {size/2**20:.1f} MB VM file (time under tracemalloc)")
+        for optimize in [False, True]:
+            memory_file = os.path.join(tmp_dir, "memory.asm")
+            streaming_file = os.path.join(tmp_dir, "streaming.asm")
+            t_memory, peak_memory_translation = peak_memory(translate_in_memory, vm_file, memory_file, optimize)
+            with contextlib.redirect_stdout(io.StringIO()):
+                t_streaming, peak_streaming = peak_memory(translate_streaming, vm_file, streaming_file, optimize)
+            with open(memory_file, "r") as fd_memory, open(streaming_file, "r") as fd_streaming:
+                if fd_memory.read() != fd_streaming.read():
+                    raise Exception("The streaming translation differs from the in-memory one")
+            print(f"  {'optimized' if optimize else 'plain':<9} in memory : {peak_memory_translation/2**20:7.1f} MB peak ({t_memory:5.2f} s) | "
+                  f"streaming : {peak_streaming/2**20:5.1f} MB peak ({t_streaming:5.2f} s)")
+
+        print(f"Throughput on the same file (without tracemalloc)")
+        for optimize in [False, True]:
+            t_memory = timeit(translate_in_memory, vm_file, os.path.join(tmp_dir, "memory.asm"), optimize)
+            with contextlib.redirect_stdout(io.StringIO()):
+                t_streaming = timeit(translate_streaming, vm_file, os.path.join(tmp_dir, "streaming.asm"), optimize)
+            print(f"  {'optimized' if optimize else 'plain':<9} in memory : {size/2**20/t_memory:5.2f} MB/s ({t_memory:5.2f} s) | "
+                  f"streaming : {size/2**20/t_streaming:5.2f} MB/s ({t_streaming:5.2f} s) | x{t_memory/t_streaming:.2f}")
+
+
+def write_constant_program(path, n_blocks):
+    """Write a VM program made of the constant expressions and branches of compiled Jack code : let x = 2 + 3,
+    let y = -1, if (true) {...} else {...}, while (false) {...}, ending in an infinite loop"""
+    with open(path, "w") as fd_out:
+        fd_out.write("function Sys.init 2\n")
+        for i in range(n_blocks):
+            fd_out.write(f"push constant 2\npush constant 3\nadd\npop static {i % 8}\n")
+            fd_out.write("push constant 1\nneg\npop local 0\n")
+            fd_out.write(f"push constant 0\nnot\nnot\nif-goto IF_FALSE{i}\npush local 1\npush constant 1\nadd\npop local 1\n"
+                         f"goto IF_END{i}\nlabel IF_FALSE{i}\npush local 1\npush constant 1\nsub\npop local 1\nlabel IF_END{i}\n")
+            fd_out.write(f"label WHILE_EXP{i}\npush constant 0\nnot\nif-goto WHILE_END{i}\npush constant 1\npop local 1\n"
+                         f"goto WHILE_EXP{i}\nlabel WHILE_END{i}\n")
+        fd_out.write("label END\ngoto END\n")
+
+
+def bench_vm_optimizer(n_blocks=100):
+    """Compare the ROM size and the cycle count of the test programs and of a program of constant expressions and branches
+    translated without and with the optimizing pass on the VM commands"""
+    print("ROM size (instructions) and cycles to halt : plain | constant folding and dead code elimination")
+    for program_dir, script in find_programs():
+        results = []
+        for fold in [False, True]:
+            asm_commands = translate_vm_program(program_dir, os.path.basename(program_dir), vm_optimizer=VMOptimizer() if fold else None)
+            rom = Assembler().assemble_lines(asm_commands)
+            results.append((len(rom), cycles_to_halt(rom, script), check_program(program_dir, script, asm_commands)))
+        (size, cycles, status), (fold_size, fold_cycles, fold_status) = results
+        print(f"  {os.path.basename(program_dir):<18} ROM {size:5} | {fold_size:5} ({(fold_size - size)/size:+6.1%})"
+              f"   cycles {cycles:6} | {fold_cycles:6} ({(fold_cycles - cycles)/cycles:+6.1%})   {status} | {fold_status}")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        vm_file = os.path.join(tmp_dir, "Sys.vm")
+        write_constant_program(vm_file, n_blocks)
+        results = []
+        for vm_optimizer in [None, VMOptimizer()]:
+            code_writer = CodeWriter("Sys", None)
+            translate_file(vm_file, code_writer, vm_optimizer)
+            rom = Assembler().assemble_lines(code_writer.asm_commands)
+            cpu = HackCPU(rom)
+            cpu.RAM[0:3] = [256, 256, 256] # SP, LCL, ARG
+            cycles = run_to_halt(cpu)
+            results.append((len(rom), cycles, cpu.RAM[:32].tolist()))
+        (size, cycles, ram), (fold_size, fold_cycles, fold_ram) = results
+        if ram != fold_ram:
+            raise Exception("The optimized translation doesn't compute the same values")
+        n_commands_in, n_commands_out, n_instructions_in, n_instructions_out = vm_optimizer.counts()
+        print(f"  {'Constants':<18} ROM {size:5} | {fold_size:5} ({(fold_size - size)/size:+6.1%})"
+              f"   cycles {cycles:6} | {fold_cycles:6} ({(fold_cycles - cycles)/cycles:+6.1%})   "
+              f"VM commands {n_commands_in} -> {n_commands_out}")
+
+
+def bench_register_cache():
+    """Compare the ROM size, the cycle count and the RAM accesses of the test programs translated with the top of
+    the stack in the RAM and in D (register caching)"""
+    print("ROM size, cycles to halt and RAM accesses : stack in RAM | top of the stack in D")
+    for program_dir, script in find_programs():
+        results = []
+        for register_cache in [False, True]:
+            asm_commands = translate_vm_program(program_dir, os.path.basename(program_dir), register_cache=register_cache)
+            rom = Assembler().assemble_lines(asm_commands)
+            counts = profile_to_halt(rom, script)
+            results.append((len(rom), int(counts.sum()), memory_accesses(rom, counts), check_program(program_dir, script, asm_commands)))
+        (size, cycles, accesses, status), (cache_size, cache_cycles, cache_accesses, cache_status) = results
+        print(f"  {os.path.basename(program_dir):<18} ROM {size:5} | {cache_size:5} ({(cache_size - size)/size:+6.1%})"
+              f"   cycles {cycles:6} | {cache_cycles:6} ({(cache_cycles - cycles)/cycles:+6.1%})"
+              f"   RAM {accesses:6} | {cache_accesses:6} ({(cache_accesses - accesses)/accesses:+6.1%})   {status} | {cache_status}")
+
+
+def bench_vm_op_cycles():
+    """Cycles per execution of each kind of VM command (push/pop by segment, other commands by keyword), over the runs
+    of all the test programs : the cycles of the code of each command are counted by the profiler and divided by the
+    number of executions of its first instruction"""
+    cycles = {}
+    executions = {}
+    for program_dir, script in find_programs():
+        name = os.path.basename(program_dir)
+        path = program_dir if os.path.exists(os.path.join(program_dir, "Sys.vm")) else os.path.join(program_dir, f"{name}.vm")
+        asm_commands, source_map, vm_files = translate_for_profiling(path)
+        rom = Assembler().assemble_lines(asm_commands)
+
+        counts = profile_to_halt(rom, script)
+
+        starts, _, _, commands = vm_regions(source_map, read_vm_lines(vm_files))
+        ends = np.append(starts[1:], len(rom))
+        for start, end, command in zip(starts, ends, commands):
+            if start < end:
+                cycles[command] = cycles.get(command, 0) + int(counts[start:end].sum())
+                executions[command] = executions.get(command, 0) + int(counts[start])
+
+    print("Cycles per VM command (test programs of projects 7 and 8)")
+    for command in sorted(executions, key=lambda command: -cycles[command]):
+        if executions[command]:
+            print(f"  {command:<18} {executions[command]:6} executions {cycles[command]/executions[command]:7.1f} cycles")
+
+
+if __name__ == "__main__":
+
+    bench_shared_routines()
+    bench_peephole()
+    bench_vm_optimizer()
+    bench_vm_op_cycles()
+    bench_register_cache()
+    bench_directory_translation()
+    bench_translation_cache()
+    bench_streaming()